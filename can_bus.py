@@ -0,0 +1,253 @@
+import heapq
+from itertools import islice
+import numpy as np
+
+from glob_def import CarEvent, CAN_DATA_RATE
+from event_scheduler import iter_event_rows
+
+# Bits of a CAN data frame besides its data bytes: SOF, arbitration and
+# control field, CRC with delimiter, ACK, EOF and the interframe space, of
+# standard (11 bit ID) and extended (29 bit ID) frames
+CAN_FRAME_OVERHEAD = {False: 47, True: 67}
+# bits of a frame subject to bit stuffing besides its data bytes, SOF
+# through CRC
+CAN_STUFFED_OVERHEAD = {False: 34, True: 54}
+CAN_CRC_POLY = 0x4599
+
+# data length of frames of IDs not in the database, e.g. diagnostics
+UNKNOWN_FRAME_DLC = 8
+
+
+def get_worst_stuff_bits(dlc, extended=False):
+    # most stuff bits of frames of dlc data bytes
+    return (CAN_STUFFED_OVERHEAD[extended] + 8*np.asarray(dlc) - 1) // 4
+
+
+def _get_frame_header_bits(can_id, dlc, extended):
+    # bits from SOF through DLC of data frames, as an (N, M) array
+    can_id = np.asarray(can_id, dtype=np.int64)
+    if extended:
+        fields = [(0, 1), (can_id >> 18, 11), (1, 1), (1, 1),
+                  (can_id, 18), (0, 3), (dlc, 4)]
+    else:
+        fields = [(0, 1), (can_id, 11), (0, 3), (dlc, 4)]
+    bits = []
+    for value, width in fields:
+        value = np.broadcast_to(np.asarray(value, dtype=np.int64),
+                                can_id.shape)
+        bits += [(value >> i) & 1 for i in range(width-1, -1, -1)]
+    return np.stack(bits, axis=1).astype(np.uint8)
+
+
+def get_stuff_bits(can_id, dlc, payload, extended=False):
+    # Exact number of stuff bits of data frames: the CRC is computed and
+    # every run of five equal bits from SOF through the CRC is counted,
+    # stuff bits taking part in the runs after them. payload is an (N, 8)
+    # uint8 array of which the first dlc bytes are sent. Frames are
+    # processed with numpy, grouped by their DLC.
+    can_id = np.asarray(can_id, dtype=np.int64)
+    dlc = np.asarray(dlc, dtype=np.int64)
+    payload = np.asarray(payload, dtype=np.uint8)
+    stuff = np.zeros(len(can_id), dtype=np.int64)
+    for n in np.unique(dlc).tolist():
+        group = np.flatnonzero(dlc == n)
+        bits = np.concatenate(
+            [_get_frame_header_bits(can_id[group], n, extended),
+             np.unpackbits(payload[group, :n], axis=1)], axis=1)
+        crc = np.zeros(len(group), dtype=np.int64)
+        for k in range(bits.shape[1]):
+            feedback = bits[:, k] ^ (crc >> 14)
+            crc = ((crc << 1) & 0x7fff) ^ np.where(feedback, CAN_CRC_POLY, 0)
+        bits = np.concatenate(
+            [bits, ((crc[:, None] >> np.arange(14, -1, -1)) & 1)
+             .astype(np.uint8)], axis=1)
+        last = np.full(len(group), 2, dtype=np.uint8)
+        run = np.zeros(len(group), dtype=np.int64)
+        count = np.zeros(len(group), dtype=np.int64)
+        for k in range(bits.shape[1]):
+            bit = bits[:, k]
+            run = np.where(bit == last, run + 1, 1)
+            last = bit
+            stuffed = run == 5
+            # a stuff bit of the opposite value starts the next run
+            count += stuffed
+            last = np.where(stuffed, 1 - bit, last)
+            run = np.where(stuffed, 1, run)
+        stuff[group] = count
+    return stuff
+
+
+def get_frame_bits(dlc, extended=False, stuff_bits=None):
+    # bits on the bus of data frames of dlc data bytes with stuff_bits
+    # stuff bits, the worst case by default
+    if stuff_bits is None:
+        stuff_bits = get_worst_stuff_bits(dlc, extended)
+    return CAN_FRAME_OVERHEAD[extended] + 8*np.asarray(dlc) + stuff_bits
+
+
+class CanBus:
+    # Discrete-event model of a CAN bus: every event of a vehicle is a data
+    # frame queued for transmission at its timestamp. Whenever the bus gets
+    # idle the queued frame of the lowest CAN ID wins the arbitration
+    # (frames of the same ID in their queuing order) and occupies the bus
+    # for its bits, by DLC with worst case or exact (exact_stuffing) bit
+    # stuffing. A frame is delivered at the end of its transmission, its
+    # latency from queuing covers the wait for the bus and the arbitration
+    # lost as well as its transmission time. Events of IDs not in the
+    # database are sent with their event ID as CAN ID, CAR_EVENT_FREE
+    # events are no frames and pass without delay.
+
+    def __init__(self, car, bitrate=CAN_DATA_RATE, extended=False,
+                 exact_stuffing=False):
+        self.codec = car.dbc_data.get_batch_codec()
+        self.bit_time = 1.0 / bitrate
+        self.extended = extended
+        self.exact_stuffing = exact_stuffing
+        self.bus_free = -np.inf
+        self.last_time = -np.inf
+        self.frame_num = 0
+        self.busy_bits = 0
+        self.first_time = None
+        self.latency = {}
+        self.__pending = []
+        self.__arrivals = []
+        self.__pushed = []
+        self.__seq = 0
+
+    def get_frames(self, ID, value):
+        # CAN IDs and bits on the bus of frames of events
+        ID = np.asarray(ID, dtype=np.int64)
+        slot = self.codec.get_slot(ID)
+        known = slot < len(self.codec.event_ids)
+        can_id = np.where(known, self.codec.can_id[slot], ID)
+        dlc = np.where(known, self.codec.byte_len[slot], UNKNOWN_FRAME_DLC)
+        stuff_bits = None
+        if self.exact_stuffing:
+            stuff_bits = get_stuff_bits(
+                can_id, dlc, self.codec.encode(ID, value), self.extended)
+        return can_id, get_frame_bits(dlc, self.extended, stuff_bits)
+
+    def __queue(self, release, can_id, bits, row, pushed):
+        # queue a frame for the arbitration, the bus is taken as free from
+        # its release on if nothing was queued
+        if not self.__pending:
+            self.bus_free = max(self.bus_free, release)
+        self.__seq += 1
+        heapq.heappush(self.__pending,
+                       (can_id, self.__seq, release, bits, row, pushed))
+
+    def push(self, timestamp, ID, value, label=0):
+        # queue an event sent in the course of iter_delivered(), e.g. a
+        # reply of the vehicle. It's delivered to take_pushed() instead of
+        # the stream. An event pushed later than its timestamp contends
+        # from the push on.
+        can_id, bits = self.get_frames([ID], [value])
+        arrival = (timestamp, int(can_id[0]), int(bits[0]),
+                   (timestamp, ID, value, label))
+        if timestamp <= self.bus_free and self.__pending:
+            self.__queue(*arrival, True)
+        else:
+            self.__seq += 1
+            heapq.heappush(self.__arrivals, (timestamp, self.__seq, arrival))
+
+    def take_pushed(self):
+        # rows of pushed events delivered so far, in delivery order
+        rows, self.__pushed = self.__pushed, []
+        return rows
+
+    def __transmit(self):
+        # send the frame winning the arbitration, return its row at the
+        # delivery time or None for a pushed one
+        can_id, _, release, bits, row, pushed = \
+            heapq.heappop(self.__pending)
+        end = self.bus_free + bits * self.bit_time
+        self.bus_free = self.last_time = end
+        self.frame_num += 1
+        self.busy_bits += bits
+        latency = end - release
+        stats = self.latency.get(can_id)
+        if stats is None:
+            self.latency[can_id] = [1, latency, latency]
+        else:
+            stats[0] += 1
+            stats[1] += latency
+            if latency > stats[2]:
+                stats[2] = latency
+        row = (end,) + tuple(row[1:])
+        if pushed:
+            self.__pushed.append(row)
+            return None
+        return row
+
+    def iter_delivered(self, source, chunk_size=4096, clock_interval=None):
+        # Send the events of a time sorted source over the bus, and yield
+        # their (timestamp, ID, value, label) rows at delivery time, in
+        # delivery order. Events are converted to frames chunk_size at a
+        # time. With a clock_interval [s], a clock row (timestamp, None,
+        # None, None) is yielded before the bus moves on by that much, for
+        # a consumer to catch up to the time and push its events in time.
+        rows = iter_event_rows(source)
+        chunk, can_ids, bits, i = [], [], [], 0
+        free_id = CarEvent.CAR_EVENT_FREE
+        pending, arrivals = self.__pending, self.__arrivals
+        clock_time = -np.inf
+        while True:
+            if i == len(chunk):
+                chunk, i = list(islice(rows, chunk_size)), 0
+                if chunk:
+                    columns = list(zip(*chunk))
+                    can_ids, bits = self.get_frames(columns[1], columns[2])
+                    can_ids, bits = can_ids.tolist(), bits.tolist()
+            # the next frame queued, of the source or pushed
+            release = chunk[i][0] if i < len(chunk) else np.inf
+            if arrivals and arrivals[0][0] < release:
+                release = arrivals[0][0]
+            # the next transmission starts before it
+            sending = pending and self.bus_free < release
+            if not sending and release == np.inf:
+                break
+            next_time = self.bus_free if sending else release
+            if clock_interval and next_time >= clock_time + clock_interval:
+                clock_time = next_time
+                yield (next_time, None, None, None)
+                continue
+            if sending:
+                row = self.__transmit()
+                if row is not None:
+                    yield row
+                continue
+
+            if self.first_time is None:
+                self.first_time = release
+            if arrivals and arrivals[0][0] == release:
+                self.__queue(*heapq.heappop(arrivals)[2], True)
+                continue
+            row = chunk[i]
+            if row[1] == free_id:
+                self.last_time = max(self.last_time, release)
+                yield (self.last_time,) + tuple(row[1:])
+            else:
+                self.__queue(release, can_ids[i], bits[i], row, False)
+            i += 1
+
+    def flush(self):
+        # send the pushed events still queued, when the stream has ended
+        while self.__arrivals or self.__pending:
+            if self.__arrivals and (not self.__pending or
+                                    self.__arrivals[0][0] <= self.bus_free):
+                self.__queue(*heapq.heappop(self.__arrivals)[2], True)
+            else:
+                self.__transmit()
+
+    def get_stats(self):
+        # bus load and the latency [s] of frames of every CAN ID
+        elapsed = self.last_time - self.first_time \
+            if self.first_time is not None else 0.0
+        busy_time = self.busy_bits * self.bit_time
+        return {"frame_num": self.frame_num,
+                "busy_time": busy_time,
+                "bus_load": busy_time / elapsed if elapsed > 0 else 0.0,
+                "latency": {can_id: {"count": n, "mean": total / n,
+                                     "max": worst}
+                            for can_id, (n, total, worst)
+                            in sorted(self.latency.items())}}
@@ -1,18 +1,36 @@
 import sys
+import os
 import struct
 import configparser
 import logging
+import multiprocessing
+from time import perf_counter
 
 from vehicle_model import Vehicle
 from vehicle_model import generate_constant_event, generate_sporadic_event
-from vehicle_model import car_set_gear
-from vehicle_model import generate_empty_event, generate_query_event
+from vehicle_model import car_set_gear, stream_profile_event
+from vehicle_model import generate_query_event
 from vehicle_model import generate_DOS_attack_via_odbII
 from vehicle_model import toyota_prius_force_shutdown_engine
 
 from packet_proc import write_car_event_to_can_packet
 from packet_proc import write_car_event_to_udp_packet
 from packet_proc import read_car_event_from_udp_packet
+from packet_proc import iter_car_event_from_udp_packet
+from packet_proc import export_car_event, CanPacketOutput, UdpPacketOutput
+from packet_proc import RawFrameOutput
+from pcap_file import PcapFileWriter, BackgroundCaptureWriter, LINKTYPE_IPV4
+from can_bus import CanBus
+from intrusion_detection import IdsEngine, iter_capture_frames
+from intrusion_detection import get_default_detectors, TimingDetector
+from intrusion_detection import get_frame_columns
+from canou_stream import iter_canou_frames
+from timing_profile import TimingProfile, learn_timing_profile
+from feature_dataset import export_features, write_manifest
+from feature_dataset import iter_labelled_capture_frames
+
+from event_table import EventTable
+from event_scheduler import EventScheduler, iter_event_rows
 
 from visulization_proc import draw_timed_sequence, draw_animation
 from visulization_proc import visual_setup, visual_teardown
@@ -27,6 +45,10 @@ import numpy as np
 
 
 def sort_event_by_timestamp(event_list):
+    if isinstance(event_list, EventTable):
+        event_list.sort_by_timestamp()
+        return
+
     def customer_key(event):
         return event.timestamp
 
@@ -36,28 +58,44 @@ def sort_event_by_timestamp(event_list):
 
 def drive_the_car(car, event_list):
     # generate regular query during driving
-    rt_event_list = []
+    event_list = EventTable.from_events(event_list)
+    rt_event_list = EventTable()
     last_query_time = -100
     query_interval = 0.01  # query vehicle status every 10ms
 
-    for event in event_list:
-        if event.ID == CarEvent.CAR_EVENT_GAS_PEDAL:
-            car.record_gas_pedal_action(event.timestamp, event.value)
-        elif event.ID == CarEvent.CAR_EVENT_BRAKE_PEDAL:
-            car.record_brake_pedal_action(event.timestamp, event.value)
-        elif event.ID == CarEvent.CAR_EVENT_FREE:
-            car.record_no_action(event.timestamp)
+    for timestamp, event_id, value, _ in event_list.rows():
+        if event_id == CarEvent.CAR_EVENT_GAS_PEDAL:
+            car.record_gas_pedal_action(timestamp, value)
+        elif event_id == CarEvent.CAR_EVENT_BRAKE_PEDAL:
+            car.record_brake_pedal_action(timestamp, value)
+        elif event_id == CarEvent.CAR_EVENT_FREE:
+            car.record_no_action(timestamp)
 
-        if event.timestamp-last_query_time > query_interval:
-            last_query_time = event.timestamp
+        if timestamp-last_query_time > query_interval:
+            last_query_time = timestamp
             speed, enginespeed, torque = car.query_vehicle_status()
-            rt_event_list.extend(
-                generate_query_event(event.timestamp, speed, enginespeed,
-                                     torque))
+            generate_query_event(timestamp, speed, enginespeed, torque,
+                                 rt_event_list)
 
     return rt_event_list
 
 
+def get_query_records(event_list, record_interval=None):
+    # collect [timestamp, value] records of queried speed, engine speed and
+    # torque from events, which could also be a stream. With record_interval
+    # (in s) set, at most one record per interval is kept for each of them
+    query_ids = (CarEvent.CAR_EVENT_QUERY_SPEED, CarEvent.CAR_EVENT_QUERY_RPM,
+                 CarEvent.CAR_EVENT_QUERY_TORQUE)
+    records = {i: [] for i in query_ids}
+    next_time = dict.fromkeys(query_ids, -np.inf)
+    for timestamp, event_id, value, _ in iter_event_rows(event_list):
+        if event_id in records and timestamp >= next_time[event_id]:
+            records[event_id].append([timestamp, value])
+            if record_interval:
+                next_time[event_id] = timestamp + record_interval
+    return tuple(np.array(records[i]).reshape(-1, 2) for i in query_ids)
+
+
 def read_attack_config():
     attack_list = []
     conf = configparser.ConfigParser()
@@ -107,6 +145,141 @@ def read_attack_config():
     return attack_list
 
 
+def schedule_car_events(car, attack_model, sim_start, sim_time):
+    # set up the event sources of a simulation, which are merged by
+    # timestamp when the car is driven
+    scheduler = EventScheduler()
+
+    # Start the car
+    if attack_model.is_gearshift_check:
+        scheduler.add_source(car_set_gear(sim_start, GearShiftStatus.REVERSE))
+    else:
+        scheduler.add_source(car_set_gear(sim_start, GearShiftStatus.DRIVE))
+
+    # drive profile is set for every second
+    i = np.arange(sim_time)
+    profile_start, profile_stop = sim_start+i, sim_start+i+1
+
+    # generate constant events for every second
+    acceleration = ((i < 7) | ((12 <= i) & (i < 16))).astype(int)
+    scheduler.add_source(
+        stream_profile_event(generate_constant_event,
+                             profile_start, profile_stop, acceleration))
+
+    # generate braking events only on sparodic timing points
+    brake = (((10 <= i) & (i < 11)) | ((17 <= i) & (i < 18))).astype(int)
+    scheduler.add_source(
+        stream_profile_event(generate_sporadic_event,
+                             profile_start, profile_stop, brake))
+
+    # generate DOS attack scenario
+    '''
+    attack_dos = 0
+    attack_kill_engine = 0
+
+    if attack_dos:
+        attack_start_time = 15.0
+        attack_stop_time = 16.0
+        scheduler.add_source(
+            generate_DOS_attack_via_odbII(attack_start_time,
+                                          attack_stop_time))
+
+    if attack_kill_engine and car.get_car_model() == "Toyota_prius":
+        attack_start_time = 16.0
+        attack_stop_time = 17.0
+        scheduler.add_source(
+            toyota_prius_force_shutdown_engine(attack_start_time,
+                                               attack_stop_time))
+    '''
+    return scheduler
+
+
+def learn_clean_timing_profile(attack_model, sim_start, sim_time):
+    # timing profile of a run of the scenario of attack_model without the
+    # attack (no attack model registered), learned from its frames as they
+    # are written into captures
+    car = Vehicle("Toyota_prius", speed=0.0, record_interval=0.01,
+                  record_capacity=360000)
+    scheduler = schedule_car_events(car, attack_model, sim_start, sim_time)
+    bus = CanBus(car) if SIMULATION_BUS_ARBITRATION else None
+    event_list = car.drive_stream(scheduler, sim_start, sim_start+sim_time,
+                                  bus)
+    return learn_timing_profile(
+        get_frame_columns(car, frame)
+        for frame in iter_canou_frames(car, event_list))
+
+
+def get_scenario_seeds(scenario_num, base_seed=SIMULATION_RANDOM_SEED):
+    # independent and reproducible seeds of scenarios, which don't depend on
+    # the order the scenarios are run in
+    return [int(i.generate_state(1)[0]) for i in
+            np.random.SeedSequence(base_seed).spawn(scenario_num)]
+
+
+def get_status_changes(car):
+    # (timestamp, status name) of every car status change in the telemetry
+    status_record = car.get_status_record()
+    changed = np.flatnonzero(np.diff(status_record[:, 1])) + 1
+    return [(float(status_record[i, 0]),
+             CarStatus(int(status_record[i, 1])).name) for i in changed]
+
+
+def run_attack_scenario(scenario):
+    # simulate one attack scenario in a worker process, with its own seed
+    # and output file, and return a summary of the result
+    index, attack_model, random_seed, output_dir = scenario
+    start = perf_counter()
+
+    if SIMULATION_STREAMING:
+        car = Vehicle("Toyota_prius", speed=0.0, record_interval=0.01,
+                      record_capacity=360000, random_seed=random_seed)
+    else:
+        car = Vehicle("Toyota_prius", speed=0.0, random_seed=random_seed)
+    car.register_attack_model(attack_model)
+
+    sim_start = SIMULATION_START_TIME + TIME_OFFSET
+    sim_time = SIMULATION_DURATION
+    scheduler = schedule_car_events(car, attack_model, sim_start, sim_time)
+    bus = CanBus(car) if SIMULATION_BUS_ARBITRATION else None
+    event_list = car.drive_stream(scheduler, sim_start, sim_start+sim_time,
+                                  bus)
+
+    filename = os.path.join(output_dir, f"udp_packet_{index}.pcap")
+    write_car_event_to_udp_packet(car, event_list, filename=filename)
+
+    status_changes = get_status_changes(car)
+    speed_record = car.get_speedometer_record()
+
+    return {"index": index,
+            "attack_type": attack_model.type,
+            "strength": attack_model.strength,
+            "seed": random_seed,
+            "filename": filename,
+            "attack_event_num": car.attack_event_num,
+            "status_changes": status_changes,
+            "max_speed": float(speed_record[:, 1].max(initial=0.0)),
+            "final_speed": car.speed,
+            "final_status": car.status.name,
+            "elapsed_time": perf_counter() - start}
+
+
+def run_attack_scenarios(attack_list, process_num=None, output_dir=".",
+                         base_seed=SIMULATION_RANDOM_SEED):
+    # simulate attack scenarios in a pool of process_num worker processes
+    # (one per CPU by default), and return their summaries in the order of
+    # attack_list
+    seeds = get_scenario_seeds(len(attack_list), base_seed)
+    scenarios = [(i, attack_model, seeds[i], output_dir)
+                 for i, attack_model in enumerate(attack_list)]
+    if process_num == 1:
+        return [run_attack_scenario(i) for i in scenarios]
+
+    with multiprocessing.Pool(process_num) as pool:
+        results = list(pool.imap_unordered(run_attack_scenario, scenarios))
+    results.sort(key=lambda result: result["index"])
+    return results
+
+
 def main():
 
     attack_list = read_attack_config()
@@ -114,10 +287,24 @@ def main():
     for attack in attack_list:
         logging.info(attack)
 
-    for attack_model in attack_list:
+    if SIMULATION_PROCESS_NUM > 1:
+        start = perf_counter()
+        results = run_attack_scenarios(attack_list, SIMULATION_PROCESS_NUM)
+        logging.info(f"{len(results)} simulations done in "
+                     f"{perf_counter() - start:.1f}s")
+        for result in results:
+            logging.info(result)
+        return
+
+    for index, attack_model in enumerate(attack_list):
         logging.info(f"------ New simulation start ------")
 
-        car = Vehicle("Toyota_prius", speed=0.0)
+        if SIMULATION_STREAMING:
+            # keep the telemetry of the latest hour, one record per 10ms
+            car = Vehicle("Toyota_prius", speed=0.0,
+                          record_interval=0.01, record_capacity=360000)
+        else:
+            car = Vehicle("Toyota_prius", speed=0.0)
         # car = Vehicle("Toyota_prius", speed=80.0)
         logging.info(f"New car set up ...")
 
@@ -128,70 +315,44 @@ def main():
             # simulation_start = time.time()
             sim_start = SIMULATION_START_TIME + TIME_OFFSET
             sim_time = SIMULATION_DURATION
-            event_list = []
-
-            # Start the car
-            if attack_model.is_gearshift_check:
-                event_list.extend(
-                    car_set_gear(sim_start, GearShiftStatus.REVERSE)
-                )
+            scheduler = schedule_car_events(car, attack_model,
+                                            sim_start, sim_time)
+
+            # drive the car with scheduled events, real-time events generated
+            # during driving go straight into the event stream
+            # (idle time between events is coasted by the car itself)
+            bus = CanBus(car) if SIMULATION_BUS_ARBITRATION else None
+            event_list = car.drive_stream(scheduler, sim_start,
+                                          sim_start+sim_time, bus)
+            if not SIMULATION_STREAMING:
+                event_list = EventTable.from_rows(event_list)
+
+            # encode the events once for every capture exported
+            index_keys = CAPTURE_INDEX_STREAMING_KEYS \
+                if SIMULATION_STREAMING else True
+            if SIMULATION_STREAMING:
+                # write the capture in the background while driving
+                outputs = [UdpPacketOutput(pcap_writer=BackgroundCaptureWriter(
+                    PcapFileWriter("udp_packet.pcap", LINKTYPE_IPV4,
+                                   index_block_size=CAPTURE_INDEX_BLOCK_SIZE,
+                                   index_keys=index_keys)))]
             else:
-                event_list.extend(
-                    car_set_gear(sim_start, GearShiftStatus.DRIVE)
-                )
-
-            # generate constant events for every second
-            for i in range(sim_time):
-                acceleration = 1 if i < 7 or 12 <= i < 16 else 0
-                const_event = generate_constant_event(
-                    sim_start+i, sim_start+i+1, acceleration)
-                event_list.extend(const_event)
-
-            # generate braking events only on sparodic timing points
-            for i in range(sim_time):
-                brake = 1 if (10 <= i < 11) or (17 <= i < 18) else 0
-                sparodic_event = \
-                    generate_sporadic_event(sim_start+i, sim_start+i+1, brake)
-                event_list.extend(sparodic_event)
-
-            # mark every free time point
-            free_event = \
-                generate_empty_event(sim_start, sim_start+sim_time, event_list)
-            event_list.extend(free_event)
-
-            sort_event_by_timestamp(event_list)
-
-            # generate DOS attack scenario
-            '''
-            attack_dos = 0
-            attack_kill_engine = 0
-
-            if attack_dos:
-                attack_start_time = 15.0
-                attack_stop_time = 16.0
-                attack_list = \
-                    generate_DOS_attack_via_odbII(attack_start_time,
-                                                attack_stop_time)
-                event_list.extend(attack_list)
-                sort_event_by_timestamp(event_list)
-
-            if attack_kill_engine and car.get_car_model() == "Toyota_prius":
-                attack_start_time = 16.0
-                attack_stop_time = 17.0
-                attack_list = \
-                    toyota_prius_force_shutdown_engine(attack_start_time,
-                                                    attack_stop_time)
-                event_list.extend(attack_list)
-                sort_event_by_timestamp(event_list)
-            '''
-
-            # drive the car with preset events, and generate more real-time events
-            rt_event_list = car.drive_car(event_list)
-            # rt_event_list = drive_the_car(car, event_list)
-            event_list.extend(rt_event_list)
-            sort_event_by_timestamp(event_list)
-
-            write_car_event_to_udp_packet(car, event_list)
+                outputs = [UdpPacketOutput(
+                    index_block_size=CAPTURE_INDEX_BLOCK_SIZE)]
+            if SIMULATION_EXPORT_CAN_PACKET:
+                outputs.append(CanPacketOutput(
+                    index_block_size=CAPTURE_INDEX_BLOCK_SIZE,
+                    index_keys=index_keys))
+            if SIMULATION_EXPORT_RAW_FRAME:
+                outputs.append(RawFrameOutput())
+            export_car_event(car, event_list, outputs)
+            if bus is not None:
+                logging.info(f"CAN bus: {bus.get_stats()}")
+            if SIMULATION_EXPORT_FEATURES:
+                export_features(car, iter_labelled_capture_frames(car),
+                                SIMULATION_EXPORT_FEATURES,
+                                f"capture_{index}")
+                write_manifest(SIMULATION_EXPORT_FEATURES)
 
             # visualize the result
             visual_setup()
@@ -201,14 +362,33 @@ def main():
             visual_teardown()
 
         if SIMULATION_ANALYZE_CAR_DATA:
-            event_out = read_car_event_from_udp_packet(car)
-
-            speed_record = [[i.timestamp, i.value] for i in event_out
-                            if i.ID == CarEvent.CAR_EVENT_QUERY_SPEED]
-            rpm_record = [[i.timestamp, i.value] for i in event_out
-                          if i.ID == CarEvent.CAR_EVENT_QUERY_RPM]
-            torque_record = [[i.timestamp, i.value] for i in event_out
-                             if i.ID == CarEvent.CAR_EVENT_QUERY_TORQUE]
+            if SIMULATION_STREAMING:
+                # decode packets one by one, keep one record per second
+                event_out = iter_car_event_from_udp_packet(car)
+                record_interval = 1.0
+            else:
+                event_out = read_car_event_from_udp_packet(car)
+                record_interval = None
+
+            speed_record, rpm_record, torque_record = \
+                get_query_records(event_out, record_interval)
+
+            if SIMULATION_RUN_IDS:
+                # run the intrusion detection on the captured frames
+                detectors = get_default_detectors()
+                if SIMULATION_TIMING_PROFILE:
+                    if not os.path.exists(SIMULATION_TIMING_PROFILE):
+                        learn_clean_timing_profile(
+                            attack_model,
+                            SIMULATION_START_TIME + TIME_OFFSET,
+                            SIMULATION_DURATION).save(
+                                SIMULATION_TIMING_PROFILE)
+                    detectors.append(TimingDetector(
+                        TimingProfile.load(SIMULATION_TIMING_PROFILE)))
+                ids_engine = IdsEngine(detectors)
+                for alert in ids_engine.run(iter_capture_frames(car)):
+                    logging.info(alert)
+                logging.info(f"IDS: {ids_engine.get_stats()}")
 
             visual_setup()
             draw_timed_sequence(speed_record, "Retrived speed [kmph])", (-10, 180))
@@ -33,18 +33,27 @@ local DBC_DATABASE = {
         [0x07df] = {['bytelen']=8, ['bit_start']=15, ['bit_num']=16, ['scale']=1.0, ['offset']=0.0}
 }
 
+local label_set = {
+        [0] = "None",
+        [1] = "DOS attack",
+        [2] = "Reverse gas attack",
+        [3] = "Shut down engine"
+}
+
 local f_canid = ProtoField.uint32("canou.canid", "CAN Message Name", base.HEX, canid_set)
+local f_label = ProtoField.uint8("canou.label", "Attack Label", base.DEC, label_set)
 local f_canlen = ProtoField.uint8("canou.msglen", "Length of Byte", base.DEC)
 local f_canval = ProtoField.uint32("canou.msgval", "Value", base.DEC)
 local f_canmsg = ProtoField.string("canou.text", "Addi. Info")
 
-CANoU.fields = { f_canid, f_canlen, f_canval, f_canmsg }
+CANoU.fields = { f_canid, f_label, f_canlen, f_canval, f_canmsg }
 
 -- dissect packet
 function CANoU.dissector(buf, pkt, tree)
 
         local subtree = tree:add(CANoU, buf(0,24))
         subtree:add_le(f_canid, buf(8,4))
+        subtree:add(f_label, buf(12,1))
         subtree:add(f_canlen, buf(15,1))
 --        subtree:add(f_canval, buf(16,8))
 
@@ -0,0 +1,248 @@
+import asyncio
+import socket
+from time import perf_counter
+import numpy as np
+
+from vehicle_model import Vehicle
+from event_table import EventTable
+from event_scheduler import iter_event_chunks
+from packet_proc import CANOU_FRAME_DTYPE, EncodedEventChunk
+from packet_proc import decode_canou_frame
+
+CANOU_PORT = 0x0cb0
+
+# receive buffer of the collector socket, to ride out bursts
+COLLECTOR_RECEIVE_BUFFER = 1 << 22
+
+
+def get_frame_time(frame):
+    # timestamps [s] of CANoU frames
+    return ((frame['timestamp_upper'].astype(np.int64) << 32)
+            + frame['timestamp_lower']) * 1e-3
+
+
+def iter_canou_frames(car: Vehicle, event_list, chunk_size=4096):
+    # CANoU frames of events in chunks, as written into UDP captures (see
+    # UdpPacketOutput). event_list could also be a stream of event rows.
+    codec = car.dbc_data.get_batch_codec()
+    for timestamp, event_id, value, label in \
+            iter_event_chunks(event_list, chunk_size, with_label=True):
+        yield EncodedEventChunk(codec, timestamp, event_id, value,
+                                label).get_canou_frame()[1]
+
+
+def _get_datagram_bounds(timestamp, frames_per_datagram, max_delay):
+    # split frames into datagrams of up to frames_per_datagram frames, a
+    # frame shares the datagram of an earlier one only if its timestamp is
+    # at most max_delay [s] later
+    bounds = [0]
+    size = len(timestamp)
+    while bounds[-1] < size:
+        i = bounds[-1]
+        end = int(np.searchsorted(timestamp, timestamp[i] + max_delay,
+                                  'right'))
+        bounds.append(min(i + frames_per_datagram, max(end, i+1), size))
+    return bounds
+
+
+class _SenderProtocol(asyncio.DatagramProtocol):
+    # flow control and errors of the sending transport
+
+    def __init__(self):
+        self.error_num = 0
+        self.writable = asyncio.Event()
+        self.writable.set()
+
+    def error_received(self, exc):
+        self.error_num += 1
+
+    def pause_writing(self):
+        self.writable.clear()
+
+    def resume_writing(self):
+        self.writable.set()
+
+
+async def send_canou_frames(frames, host="127.0.0.1", port=CANOU_PORT,
+                            speed=1.0, frames_per_datagram=1,
+                            max_delay=0.001):
+    # Send CANoU frames (an array of CANOU_FRAME_DTYPE, or an iterable of
+    # such arrays in time order) as UDP datagrams, paced by their
+    # timestamps at speed times real time, or as fast as possible with
+    # speed None. Frames due within max_delay [s] of capture time are
+    # coalesced into datagrams of up to frames_per_datagram frames (the
+    # dissector canou.lua only shows the first frame of a datagram).
+    # Return a dict of statistics; datagrams failed on the socket are
+    # counted as dropped.
+    if isinstance(frames, np.ndarray):
+        frames = [frames]
+    loop = asyncio.get_event_loop()
+    transport, protocol = await loop.create_datagram_endpoint(
+        _SenderProtocol, remote_addr=(host, port))
+
+    frame_num = datagram_num = 0
+    first_time = start = None
+    begin = perf_counter()
+    try:
+        for frame in frames:
+            if not len(frame):
+                continue
+            timestamp = get_frame_time(frame)
+            if first_time is None:
+                first_time, start = timestamp[0], loop.time()
+            data = np.ascontiguousarray(frame).tobytes()
+            bounds = _get_datagram_bounds(timestamp, frames_per_datagram,
+                                          max_delay if speed else np.inf)
+            for i, end in zip(bounds[:-1], bounds[1:]):
+                if speed:
+                    delay = start + (timestamp[i] - first_time) / speed \
+                        - loop.time()
+                    await asyncio.sleep(max(delay, 0.0))
+                else:
+                    # let the loop run, e.g. a collector on loopback
+                    await asyncio.sleep(0)
+                if not protocol.writable.is_set():
+                    await protocol.writable.wait()
+                transport.sendto(data[i*CANOU_FRAME_DTYPE.itemsize:
+                                      end*CANOU_FRAME_DTYPE.itemsize])
+                frame_num += end - i
+                datagram_num += 1
+    finally:
+        transport.close()
+
+    elapsed = perf_counter() - begin
+    return {"frame_num": frame_num,
+            "datagram_num": datagram_num,
+            "dropped_datagram_num": protocol.error_num,
+            "elapsed_time": elapsed,
+            "frame_rate": frame_num / elapsed if elapsed else 0.0}
+
+
+class CanouCollector(asyncio.DatagramProtocol):
+    # Collector of CANoU datagrams. Datagrams are queued as received and
+    # decoded in batches, when events are taken with get_events() or
+    # iter_events(). Datagrams which are not whole CANoU frames are counted
+    # as malformed and dropped.
+
+    def __init__(self, car: Vehicle):
+        self.car = car
+        self.frame_num = 0
+        self.datagram_num = 0
+        self.malformed_num = 0
+        self.first_time = None
+        self.last_time = None
+        self.transport = None
+        self.__pending = []
+        self.__received = asyncio.Event()
+        self.__stop_frame_num = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if not data or len(data) % CANOU_FRAME_DTYPE.itemsize:
+            self.malformed_num += 1
+            return
+        self.last_time = perf_counter()
+        if self.first_time is None:
+            self.first_time = self.last_time
+        self.__pending.append(data)
+        self.frame_num += len(data) // CANOU_FRAME_DTYPE.itemsize
+        self.datagram_num += 1
+        self.__received.set()
+
+    def get_frames(self):
+        # the frames received since the last call, as an array of
+        # CANOU_FRAME_DTYPE
+        data = b''.join(self.__pending)
+        self.__pending = []
+        self.__received.clear()
+        return np.frombuffer(data, dtype=CANOU_FRAME_DTYPE)
+
+    def get_events(self):
+        # decode the frames received since the last call into arrays of
+        # timestamp, event ID and value
+        return decode_canou_frame(self.car, self.get_frames())
+
+    def stop_after(self, frame_num):
+        # end iter_events() once frame_num frames are received
+        self.__stop_frame_num = frame_num
+        self.__received.set()
+
+    async def iter_frames(self, idle_timeout=1.0):
+        # yield arrays of frames as they arrive, until none arrives for
+        # idle_timeout [s] or as set by stop_after()
+        while self.__stop_frame_num is None \
+                or self.frame_num < self.__stop_frame_num or self.__pending:
+            try:
+                await asyncio.wait_for(self.__received.wait(), idle_timeout)
+            except asyncio.TimeoutError:
+                return
+            if self.__pending:
+                yield self.get_frames()
+            else:
+                self.__received.clear()
+
+    async def iter_events(self, idle_timeout=1.0):
+        # yield (timestamp, ID, value) arrays of events as frames arrive,
+        # see iter_frames()
+        async for frame in self.iter_frames(idle_timeout):
+            yield decode_canou_frame(self.car, frame)
+
+    def get_stats(self):
+        elapsed = self.last_time - self.first_time \
+            if self.first_time is not None else 0.0
+        return {"frame_num": self.frame_num,
+                "datagram_num": self.datagram_num,
+                "malformed_datagram_num": self.malformed_num,
+                "elapsed_time": elapsed,
+                "frame_rate": self.frame_num / elapsed if elapsed else 0.0}
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+
+async def open_canou_collector(car: Vehicle, host="127.0.0.1",
+                               port=CANOU_PORT,
+                               receive_buffer=COLLECTOR_RECEIVE_BUFFER):
+    # a CanouCollector listening on (host, port)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer)
+    sock.bind((host, port))
+    _, collector = await asyncio.get_event_loop().create_datagram_endpoint(
+        lambda: CanouCollector(car), sock=sock)
+    return collector
+
+
+async def stream_car_event(car: Vehicle, event_list, host="127.0.0.1",
+                           port=CANOU_PORT, speed=None,
+                           frames_per_datagram=1, idle_timeout=1.0):
+    # Stream events as CANoU frames to a collector on (host, port) of this
+    # loop, and return the events collected as an EventTable, with the
+    # statistics of both sides. Frames lost in between are counted in
+    # "dropped_frame_num".
+    collector = await open_canou_collector(car, host, port)
+    events = []
+
+    async def collect():
+        async for columns in collector.iter_events(idle_timeout):
+            events.append(columns)
+
+    collecting = asyncio.ensure_future(collect())
+    try:
+        sender_stats = await send_canou_frames(
+            iter_canou_frames(car, event_list), host, port, speed,
+            frames_per_datagram)
+        collector.stop_after(sender_stats["frame_num"])
+        await collecting
+    finally:
+        collector.close()
+
+    columns = [np.concatenate(i) for i in zip(*events)] if events else \
+        [np.empty(0), np.empty(0, dtype=np.int64), np.empty(0)]
+    stats = {"sender": sender_stats,
+             "collector": collector.get_stats(),
+             "dropped_frame_num":
+                 sender_stats["frame_num"] - collector.frame_num}
+    return EventTable.from_columns(*columns, ""), stats
@@ -0,0 +1,228 @@
+import os
+import re
+import pickle
+import hashlib
+import logging
+
+# version of the compiled form, cached files of other versions are reparsed
+DBC_CACHE_VERSION = 1
+
+# attribute of a signal carrying the ID of the simulator event (CarEvent),
+# e.g. BA_ "EventID" SG_ 180 SPEED 770;
+DBC_EVENT_ID_ATTRIBUTE = "EventID"
+
+_message_pattern = re.compile(
+    r'BO_\s+(\d+)\s+(\w+)\s*:\s*(\d+)\s+(\w+)')
+_signal_pattern = re.compile(
+    r'SG_\s+(\w+)\s*(M|m\d+)?\s*:\s*(\d+)\|(\d+)@([01])([+-])\s*'
+    r'\(([^,]+),([^)]+)\)\s*\[([^|]*)\|([^\]]*)\]\s*"([^"]*)"')
+_attribute_pattern = re.compile(
+    r'BA_\s+"(\w+)"\s+SG_\s+(\d+)\s+(\w+)\s+([^;\s]+)\s*;')
+
+
+class DbcSignal:
+    # A signal of a dbc message, compiled into the mask and shift of its bit
+    # field. The field of a little endian (Intel) signal sits shift bits
+    # above the LSB of the message read as a little endian integer, that
+    # of a big endian (Motorola) signal shift bits above the LSB of the
+    # message read as a big endian integer.
+
+    def __init__(self, name, start_bit, bit_num, little_endian, signed,
+                 scale, offset, minimum=0.0, maximum=0.0, unit="",
+                 multiplexer=False, multiplex_value=None):
+        self.name = name
+        self.start_bit = start_bit
+        self.bit_num = bit_num
+        self.little_endian = little_endian
+        self.signed = signed
+        self.scale = scale
+        self.offset = offset
+        self.minimum = minimum
+        self.maximum = maximum
+        self.unit = unit
+        self.multiplexer = multiplexer
+        self.multiplex_value = multiplex_value
+        self.event_id = None
+        self.mask = (1 << bit_num) - 1
+        self.shift = 0
+
+    def compile(self, byte_len):
+        if self.little_endian:
+            self.shift = self.start_bit
+        else:
+            # start bit of a big endian signal is its MSB, bits are counted
+            # from the LSB of each byte
+            msb = self.start_bit // 8 * 8 + 7 - self.start_bit % 8
+            self.shift = byte_len*8 - msb - self.bit_num
+        assert(self.shift >= 0 and self.shift + self.bit_num <= byte_len*8)
+
+    def encode_raw(self, value):
+        # value rounded to the raw value of the field, in two's complement
+        raw = round((value-self.offset)/self.scale)
+        if self.signed:
+            assert(-(1 << self.bit_num-1) <= raw < (1 << self.bit_num-1))
+        else:
+            assert(0 <= raw <= self.mask)
+        return raw & self.mask
+
+    def decode_raw(self, raw):
+        if self.signed and raw >> (self.bit_num-1):
+            raw -= 1 << self.bit_num
+        return raw*self.scale + self.offset
+
+
+class DbcMessage:
+
+    def __init__(self, can_id, name, byte_len, sender=""):
+        # bit 31 of the dbc message ID flags an extended (29 bit) CAN ID
+        self.is_extended = bool(can_id & 0x80000000)
+        self.can_id = can_id & 0x1fffffff
+        self.name = name
+        self.byte_len = byte_len
+        self.sender = sender
+        self.signals = {}
+        self.multiplexer = None
+
+    def add_signal(self, signal):
+        signal.compile(self.byte_len)
+        self.signals[signal.name] = signal
+        if signal.multiplexer:
+            self.multiplexer = signal
+
+    def is_signal_present(self, signal, multiplex_value):
+        return signal.multiplex_value is None \
+            or signal.multiplex_value == multiplex_value
+
+    def encode(self, values):
+        # encode a dict of signal values into bytes, missing signals are 0
+        little = big = 0
+        for name, value in values.items():
+            signal = self.signals[name]
+            raw = signal.encode_raw(value) << signal.shift
+            if signal.little_endian:
+                little |= raw
+            else:
+                big |= raw
+        return (int.from_bytes(little.to_bytes(self.byte_len, 'little'),
+                               'big') | big).to_bytes(self.byte_len, 'big')
+
+    def decode(self, data):
+        # decode bytes of the message into a dict of signal values, signals
+        # multiplexed by other values of the multiplexer are left out
+        little = int.from_bytes(data[:self.byte_len], 'little')
+        big = int.from_bytes(data[:self.byte_len], 'big')
+        multiplex_value = None
+        if self.multiplexer is not None:
+            signal = self.multiplexer
+            multiplex_value = \
+                ((little if signal.little_endian else big) >> signal.shift) \
+                & signal.mask
+        values = {}
+        for name, signal in self.signals.items():
+            if not self.is_signal_present(signal, multiplex_value):
+                continue
+            raw = ((little if signal.little_endian else big) >> signal.shift) \
+                & signal.mask
+            values[name] = signal.decode_raw(raw)
+        return values
+
+
+class DbcFile:
+    # Messages of a .dbc file by CAN ID
+
+    def __init__(self, messages=(), filename=""):
+        self.filename = filename
+        self.messages = {i.can_id: i for i in messages}
+        self.__by_name = {i.name: i for i in messages}
+
+    def get_message_by_name(self, name):
+        return self.__by_name[name]
+
+    def get_event_signals(self):
+        # (message, signal) of every signal carrying a simulator event, by
+        # event ID
+        return {signal.event_id: (message, signal)
+                for message in self.messages.values()
+                for signal in message.signals.values()
+                if signal.event_id is not None}
+
+
+def parse_dbc(text, filename=""):
+    # parse the messages, signals and event ID attributes of a .dbc file.
+    # Value tables, comments and other attributes are skipped, extended
+    # multiplexing (SG_MUL_VAL_) isn't supported.
+    messages = []
+    message = None
+    event_ids = []
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith('BO_ '):
+            match = _message_pattern.match(line)
+            message = None
+            if match:
+                message = DbcMessage(int(match[1]), match[2], int(match[3]),
+                                     match[4])
+                messages.append(message)
+        elif line.startswith('SG_ ') and message is not None:
+            match = _signal_pattern.match(line)
+            if not match:
+                logging.warning(f"Unsupported dbc signal: {line}")
+                continue
+            mux = match[2]
+            message.add_signal(DbcSignal(
+                match[1], int(match[3]), int(match[4]),
+                little_endian=match[5] == '1', signed=match[6] == '-',
+                scale=float(match[7]), offset=float(match[8]),
+                minimum=float(match[9] or 0), maximum=float(match[10] or 0),
+                unit=match[11], multiplexer=mux == 'M',
+                multiplex_value=int(mux[1:]) if mux and mux != 'M' else None))
+        elif line.startswith('BA_ '):
+            message = None
+            match = _attribute_pattern.match(line)
+            if match and match[1] == DBC_EVENT_ID_ATTRIBUTE:
+                event_ids.append((int(match[2]) & 0x1fffffff, match[3],
+                                  int(match[4], 0)))
+        elif line:
+            message = None
+
+    dbc = DbcFile(messages, filename)
+    for can_id, name, event_id in event_ids:
+        message = dbc.messages.get(can_id)
+        signal = message.signals.get(name) if message else None
+        if signal is None:
+            logging.warning(f"Unknown dbc signal of {DBC_EVENT_ID_ATTRIBUTE}"
+                            f": {can_id:#x} {name}")
+            continue
+        signal.event_id = event_id
+    return dbc
+
+
+def load_dbc_file(filename, cache_dir=None):
+    # Load a .dbc file in its compiled form. With cache_dir set, the
+    # compiled form is cached there by the hash of the file content, so a
+    # file is only parsed once.
+    with open(filename, 'rb') as f:
+        content = f.read()
+    if cache_dir is None:
+        return parse_dbc(content.decode('cp1252', errors='replace'), filename)
+
+    digest = hashlib.sha256(content)
+    digest.update(str(DBC_CACHE_VERSION).encode())
+    cache_file = os.path.join(cache_dir, digest.hexdigest() + '.pickle')
+    try:
+        with open(cache_file, 'rb') as f:
+            dbc = pickle.load(f)
+        dbc.filename = filename
+        return dbc
+    except (OSError, pickle.UnpicklingError, EOFError):
+        pass
+
+    dbc = parse_dbc(content.decode('cp1252', errors='replace'), filename)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(cache_file + '.tmp', 'wb') as f:
+            pickle.dump(dbc, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(cache_file + '.tmp', cache_file)
+    except OSError as error:
+        logging.warning(f"Failed to cache dbc file {filename}: {error}")
+    return dbc
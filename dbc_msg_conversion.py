@@ -1,4 +1,8 @@
-from glob_def import CarEvent
+from glob_def import CarEvent, DBC_PATH, DBC_CACHE_PATH
+from dbc_file import load_dbc_file, DBC_EVENT_ID_ATTRIBUTE
+from types import MappingProxyType
+import numpy as np
+import os
 
 
 class SimpleMsg:
@@ -23,6 +27,221 @@ class SimpleMsg:
         self.unit = unit
 
 
+def get_default_msg(id):
+    # message layout of IDs not in the dbc database
+    return SimpleMsg(can_id=id, byte_len=8, bit_start_pos=16,
+                     bit_num=4, scale=1.0, offset=0.0)
+
+
+class SimpleMsgCodec:
+    # A SimpleMsg compiled into the constants of its bit field. Bit
+    # positions count from the MSB of the message (bit_start_pos 0 is the
+    # top bit of byte 0), so the value field of a message with byte_len
+    # bytes sits shift bits above its LSB, and payload_shift bits above the
+    # LSB of an 8 byte CAN payload.
+    __slots__ = ('can_id', 'byte_len', 'scale', 'offset', 'bit_num', 'mask',
+                 'shift', 'payload_shift')
+
+    # unsigned big endian field, the raw value is truncated
+    little_endian = False
+    signed = False
+    rounding = False
+    payload_base = 0
+
+    def __init__(self, msg):
+        self.can_id = msg.can_id
+        self.byte_len = msg.byte_len
+        self.scale = msg.scale
+        self.offset = msg.offset
+        self.bit_num = msg.bit_num
+        self.mask = (1 << msg.bit_num) - 1
+        self.shift = msg.byte_len*8 - msg.bit_start_pos - msg.bit_num
+        self.payload_shift = 64 - msg.bit_start_pos - msg.bit_num
+        assert(self.shift >= 0)
+
+    def encode_int(self, value):
+        # message as an integer of byte_len bytes
+        raw = int((value-self.offset)/self.scale)
+        assert(0 <= raw <= self.mask)
+        return raw << self.shift
+
+    def encode(self, value):
+        return self.encode_int(value).to_bytes(self.byte_len, 'big')
+
+    def decode_int(self, data, bit_len=64):
+        # data: the message as an integer of bit_len bits
+        return ((data >> (bit_len - 64 + self.payload_shift)) & self.mask) \
+            * self.scale + self.offset
+
+    def decode(self, data):
+        # data: 8 bytes of CAN payload, as bytes or memoryview
+        return ((int.from_bytes(data, 'big') >> self.payload_shift)
+                & self.mask) * self.scale + self.offset
+
+
+def _get_payload_word(raw, shift, little_endian):
+    # bit field of a CAN payload as a big endian 64 bit integer
+    if little_endian:
+        return int.from_bytes((raw << shift).to_bytes(8, 'little'), 'big')
+    return raw << shift
+
+
+class DbcSignalCodec:
+    # A signal of a DbcMessage (see dbc_file.py) carrying a simulator event,
+    # with the interface of SimpleMsgCodec. A multiplexed signal is encoded
+    # along with its value of the multiplexer (payload_base).
+    __slots__ = ('can_id', 'byte_len', 'scale', 'offset', 'bit_num', 'mask',
+                 'payload_shift', 'little_endian', 'signed', 'payload_base',
+                 'signal')
+
+    rounding = True
+
+    def __init__(self, message, signal):
+        assert(message.byte_len <= 8)
+        self.can_id = message.can_id
+        self.byte_len = message.byte_len
+        self.scale = signal.scale
+        self.offset = signal.offset
+        self.bit_num = signal.bit_num
+        self.mask = signal.mask
+        self.little_endian = signal.little_endian
+        self.signed = signal.signed
+        self.signal = signal
+        self.payload_shift = signal.shift
+        if not signal.little_endian:
+            self.payload_shift += 64 - message.byte_len*8
+
+        self.payload_base = 0
+        if signal.multiplex_value is not None:
+            mux = message.multiplexer
+            mux_shift = mux.shift
+            if not mux.little_endian:
+                mux_shift += 64 - message.byte_len*8
+            self.payload_base = _get_payload_word(
+                signal.multiplex_value, mux_shift, mux.little_endian)
+
+    def encode_int(self, value):
+        # message as an integer of byte_len bytes
+        word = _get_payload_word(self.signal.encode_raw(value),
+                                 self.payload_shift, self.little_endian)
+        return (word | self.payload_base) >> (64 - self.byte_len*8)
+
+    def encode(self, value):
+        return self.encode_int(value).to_bytes(self.byte_len, 'big')
+
+    def decode_int(self, data, bit_len=64):
+        # data: the message as an integer of bit_len bits
+        data = (data >> max(bit_len - 64, 0)) & 0xffffffffffffffff
+        return self.decode(data.to_bytes(8, 'big'))
+
+    def decode(self, data):
+        # data: 8 bytes of CAN payload, as bytes or memoryview
+        data = int.from_bytes(data, 'little' if self.little_endian else 'big')
+        return self.signal.decode_raw((data >> self.payload_shift)
+                                      & self.mask)
+
+
+class SimpleMsgBatchCodec:
+    # The message codecs of a dbc database compiled into tables of their
+    # bit field constants, to encode and decode arrays of events with
+    # numpy. Every event is mapped to the table slot of its codec, the last
+    # slot is the default layout of IDs not in the database.
+
+    def __init__(self, codecs):
+        self.event_ids = np.array(sorted(codecs), dtype=np.int64)
+        known = [codecs[i] for i in self.event_ids.tolist()]
+        codecs = known + [SimpleMsgCodec(get_default_msg(0))]
+
+        self.shift = np.array([i.payload_shift for i in codecs],
+                              dtype=np.uint64)
+        self.mask = np.array([i.mask for i in codecs], dtype=np.uint64)
+        self.scale = np.array([i.scale for i in codecs], dtype=np.float64)
+        self.offset = np.array([i.offset for i in codecs], dtype=np.float64)
+        self.bit_num = np.array([i.bit_num for i in codecs], dtype=np.int32)
+        self.little_endian = np.array([i.little_endian for i in codecs])
+        self.signed = np.array([i.signed for i in codecs])
+        self.rounding = np.array([i.rounding for i in codecs])
+        self.payload_base = np.array([i.payload_base for i in codecs],
+                                     dtype=np.uint64)
+        # as get_msg_length_in_byte() and get_msg_can_id() of unknown IDs
+        self.byte_len = np.array([i.byte_len for i in known] + [0],
+                                 dtype=np.uint8)
+        self.can_id = np.array([i.can_id for i in known] + [0xffff],
+                               dtype=np.uint32)
+
+        # reverse lookup of event IDs by CAN ID
+        order = np.argsort(self.can_id[:-1], kind='stable')
+        self.__sorted_can_id = self.can_id[:-1][order]
+        self.__can_id_event = self.event_ids[order]
+        for table in (self.event_ids, self.shift, self.mask, self.scale,
+                      self.offset, self.bit_num, self.little_endian,
+                      self.signed, self.rounding, self.payload_base,
+                      self.byte_len, self.can_id, self.__sorted_can_id,
+                      self.__can_id_event):
+            table.flags.writeable = False
+
+    def get_slot(self, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        unknown = len(self.event_ids)
+        slot = np.searchsorted(self.event_ids, ids)
+        slot[slot == unknown] = 0
+        slot[self.event_ids[slot] != ids] = unknown
+        return slot
+
+    def get_frame_id(self, ids, slot=None):
+        # CAN IDs of the frames of events on the bus: of their messages, or
+        # the event ID itself for events not in the database (e.g. attack
+        # frames), unlike get_msg_can_id()
+        ids = np.asarray(ids, dtype=np.int64)
+        if slot is None:
+            slot = self.get_slot(ids)
+        return np.where(slot < len(self.event_ids), self.can_id[slot], ids)
+
+    def encode(self, ids, values, slot=None):
+        # return the (N, 8) uint8 payloads of N events, slot: their table
+        # slots if already looked up
+        if slot is None:
+            slot = self.get_slot(ids)
+        raw = (np.asarray(values, dtype=np.float64) - self.offset[slot]) \
+            / self.scale[slot]
+        raw = np.where(self.rounding[slot], np.round(raw), np.trunc(raw))
+        # range of the field, signed fields in two's complement
+        sign_bit = np.where(self.signed[slot],
+                            np.ldexp(1.0, self.bit_num[slot]-1), 0.0)
+        assert(np.all((raw >= -sign_bit)
+                      & (raw <= self.mask[slot] - sign_bit)))
+        raw = np.where(raw < 0, raw + 2*sign_bit, raw).astype(np.uint64)
+
+        data = raw << self.shift[slot]
+        little_endian = self.little_endian[slot]
+        data[little_endian] = data[little_endian].byteswap()
+        data |= self.payload_base[slot]
+        return data.astype('>u8').view(np.uint8).reshape(-1, 8)
+
+    def decode(self, ids, payload):
+        # return values of N events from their (N, 8) uint8 payloads
+        slot = self.get_slot(ids)
+        data = np.ascontiguousarray(payload, dtype=np.uint8) \
+            .view('>u8').reshape(-1).astype(np.uint64)
+        little_endian = self.little_endian[slot]
+        data[little_endian] = data[little_endian].byteswap()
+
+        raw = ((data >> self.shift[slot]) & self.mask[slot]) \
+            .astype(np.float64)
+        sign_bit = np.where(self.signed[slot],
+                            np.ldexp(1.0, self.bit_num[slot]-1), np.inf)
+        raw = np.where(raw >= sign_bit, raw - 2*sign_bit, raw)
+        return raw * self.scale[slot] + self.offset[slot]
+
+    def get_event_id_by_can_id(self, can_ids):
+        # CAR_EVENT_UNKNOWN for CAN IDs not in the database
+        can_ids = np.asarray(can_ids, dtype=np.int64)
+        pos = np.searchsorted(self.__sorted_can_id, can_ids)
+        pos[pos == len(self.__sorted_can_id)] = 0
+        return np.where(self.__sorted_can_id[pos] == can_ids,
+                        self.__can_id_event[pos], CarEvent.CAR_EVENT_UNKNOWN)
+
+
 DBC_DATABASE_TOYOTA_PRIUS = {
     CarEvent.CAR_EVENT_GAS_ACC_VIA_ICE:
     SimpleMsg(can_id=0x37, byte_len=7,
@@ -82,77 +301,130 @@ DBC_DATABASE_TOYOTA_PRIUS = {
 }
 
 
+def find_dbc_file(model):
+    # .dbc file of a vehicle model, which is either a path to the file or
+    # the name of a file <model>.dbc (in any case) in DBC_PATH
+    if str(model).lower().endswith('.dbc') and os.path.isfile(model):
+        return model
+    name = str(model).lower() + '.dbc'
+    if os.path.isdir(DBC_PATH):
+        for i in sorted(os.listdir(DBC_PATH)):
+            if i.lower() == name:
+                return os.path.join(DBC_PATH, i)
+    return None
+
+
 class DbcMsgConvertor:
+    # Messages of a dbc database compiled into codecs, with hash indexes of
+    # CAN ID and message length by event ID and of event ID by CAN ID.
+    # The database is either a DBC_DATABASE_<MODEL> dict of SimpleMsg, or
+    # the signals with an EventID attribute in the .dbc file of the model.
+    # Convertors are read-only once set up, so that a single instance per
+    # vehicle model could be shared (see get_dbc_convertor()).
     vehicle_model = "unknown"
     dbc_database = None
+    dbc_file = None
 
     def __init__(self, model):
         self.vehicle_model = model
         database_name = "DBC_DATABASE_" + str(model).upper()
-        try:
-            self.dbc_database = eval(database_name)
-        except NameError:
-            print("DBC database %s doesn't exist!" % database_name)
-            # raise an error
-            assert(False)
+        dbc_database = globals().get(database_name)
+        if dbc_database is not None:
+            codecs = {i: SimpleMsgCodec(msg)
+                      for i, msg in dbc_database.items()}
+        else:
+            # signals carrying events in the .dbc file of the model
+            filename = find_dbc_file(model)
+            if filename is None:
+                print("DBC database %s doesn't exist!" % database_name)
+                # raise an error
+                assert(False)
+            self.dbc_file = load_dbc_file(filename, DBC_CACHE_PATH)
+            dbc_database = self.dbc_file.get_event_signals()
+            if not dbc_database:
+                # every event would be exported as an unknown ID
+                raise ValueError(
+                    f"{filename} maps no events, its signals need "
+                    f"BA_ \"{DBC_EVENT_ID_ATTRIBUTE}\" attributes")
+            codecs = {i: DbcSignalCodec(msg, signal)
+                      for i, (msg, signal) in dbc_database.items()}
+        self.dbc_database = MappingProxyType(dict(dbc_database))
 
-    def simple_msg_encode(self, id, value):
-        # convert value to pre-defined dbc format
-        # return value is string in hex represenation
+        self.__codecs = codecs
+        self.__batch_codec = SimpleMsgBatchCodec(codecs)
+        self.__msg_length = MappingProxyType(
+            {i: codec.byte_len for i, codec in codecs.items()})
+        self.__msg_can_id = MappingProxyType(
+            {i: codec.can_id for i, codec in codecs.items()})
+        event_id = {}
+        for i, codec in codecs.items():
+            event_id.setdefault(codec.can_id, i)
+        self.__event_id = MappingProxyType(event_id)
+        self.__frozen = True
 
-        if id in self.dbc_database:
-            msg = self.dbc_database[id]
-        else:
-            msg = SimpleMsg(can_id=id, byte_len=8, bit_start_pos=16,
-                            bit_num=4, scale=1.0, offset=0.0)
+    def __setattr__(self, name, value):
+        if getattr(self, '_DbcMsgConvertor__frozen', False):
+            raise AttributeError("DbcMsgConvertor is read-only")
+        super().__setattr__(name, value)
 
-        binstr = '0' * msg.byte_len * 8
+    def get_msg_codec(self, id):
+        codec = self.__codecs.get(id)
+        if codec is None:
+            # codecs of unknown IDs are created on demand, the dict is the
+            # only state changed after set up
+            codec = self.__codecs[id] = SimpleMsgCodec(get_default_msg(id))
+        return codec
 
-        # convert value to binary
-        binfmt = '0'+str(msg.bit_num)+'b'
-        data_value = format(int((value-msg.offset)/msg.scale), binfmt)
-        assert(len(data_value) <= msg.bit_num)
+    def simple_msg_encode_bytes(self, id, value):
+        # convert value to pre-defined dbc format
+        # return value is bytes of the message length
+        return self.get_msg_codec(id).encode(value)
 
-        # combine binary string
-        postzeronum = msg.byte_len*8-msg.bit_start_pos-msg.bit_num
-        binstr = '0'*msg.bit_start_pos + data_value + '0'*postzeronum
+    def simple_msg_decode_bytes(self, id, data):
+        # data is the 8 bytes payload of a CAN frame
+        return self.get_msg_codec(id).decode(data)
 
-        # convert binary to hex
-        hexfmt = '0'+str(msg.byte_len*2)+'x'
-        hexstr = format(int(binstr, 2), hexfmt)
+    def get_batch_codec(self):
+        return self.__batch_codec
 
-        return hexstr
+    def simple_msg_encode_batch(self, ids, values):
+        # encode arrays of event IDs and values into (N, 8) uint8 payloads
+        return self.get_batch_codec().encode(ids, values)
 
-    def simple_msg_decode(self, id, data):
-        if id in self.dbc_database:
-            msg = self.dbc_database[id]
-        else:
-            msg = SimpleMsg(can_id=id, byte_len=8, bit_start_pos=16,
-                            bit_num=4, scale=1.0, offset=0.0)
+    def simple_msg_decode_batch(self, ids, payload):
+        # decode (N, 8) uint8 payloads of events into an array of values
+        return self.get_batch_codec().decode(ids, payload)
 
-        bin_str = format(int(data, 16), '064b')
-        bin_value = bin_str[msg.bit_start_pos:msg.bit_start_pos+msg.bit_num]
-        value = int(bin_value, 2)*msg.scale+msg.offset
+    def simple_msg_encode(self, id, value):
+        # convert value to pre-defined dbc format
+        # return value is string in hex represenation
+        codec = self.get_msg_codec(id)
+        return format(codec.encode_int(value), '0%dx' % (codec.byte_len*2))
 
-        return value
+    def simple_msg_decode(self, id, data):
+        data = int(data, 16)
+        return self.get_msg_codec(id).decode_int(data,
+                                                 max(64, data.bit_length()))
 
     def get_msg_length_in_byte(self, id):
-        if id in self.dbc_database:
-            msg = self.dbc_database[id]
-            return msg.byte_len
-        else:
-            return 0
+        return self.__msg_length.get(id, 0)
 
     def get_msg_can_id(self, id):
-        if id in self.dbc_database:
-            msg = self.dbc_database[id]
-            return msg.can_id
-        else:
-            return 0xffff
+        return self.__msg_can_id.get(id, 0xffff)
 
     def get_event_id_by_can_id(self, can_id):
-        for i in self.dbc_database:
-            msg = self.dbc_database[i]
-            if msg.can_id == can_id:
-                return i
-        return CarEvent.CAR_EVENT_UNKNOWN
+        return self.__event_id.get(can_id, CarEvent.CAR_EVENT_UNKNOWN)
+
+
+# convertors of vehicle models, shared in the process
+_dbc_convertors = {}
+
+
+def get_dbc_convertor(model):
+    # the shared convertor of a vehicle model, the dbc database is loaded
+    # and compiled only once per process
+    key = str(model).upper()
+    convertor = _dbc_convertors.get(key)
+    if convertor is None:
+        convertor = _dbc_convertors[key] = DbcMsgConvertor(model)
+    return convertor
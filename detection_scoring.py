@@ -0,0 +1,128 @@
+import numpy as np
+
+from event_table import ATTACK_LABEL_NONE
+
+# Scoring of intrusion detection against the ground truth of attack labels
+# (see get_attack_label() of event_table.py), for one run or many runs at
+# once. Labelled frames are merged into attack episodes, and alerts are
+# joined with the episodes by sorted keys of (run, time), so the cost is
+# that of a few sorts and binary searches whatever the number of runs.
+
+# resolution of times in the join keys [s], runs are kept apart by the
+# bits above 2**RUN_KEY_SHIFT (about 50 days of microseconds)
+SCORING_TIME_RESOLUTION = 1e-6
+RUN_KEY_SHIFT = 42
+
+
+def _get_keys(run, timestamp):
+    # join keys of times of runs, ordered by run first
+    run = np.zeros(len(timestamp), dtype=np.int64) if run is None \
+        else np.broadcast_to(np.asarray(run, dtype=np.int64),
+                             np.shape(timestamp))
+    return (run << RUN_KEY_SHIFT) + np.round(
+        np.asarray(timestamp, dtype=np.float64)
+        / SCORING_TIME_RESOLUTION).astype(np.int64)
+
+
+def get_attack_intervals(timestamp, attack_label, run=None, max_gap=1.0):
+    # Attack episodes of labelled frames (of runs, if given): frames of the
+    # same attack label of a run at most max_gap [s] apart. Return a dict of
+    # arrays of run, start, end [s] and label of the episodes, sorted by
+    # run and start.
+    timestamp = np.asarray(timestamp, dtype=np.float64)
+    attack_label = np.asarray(attack_label, dtype=np.int64)
+    run = np.zeros(len(timestamp), dtype=np.int64) if run is None \
+        else np.broadcast_to(np.asarray(run, dtype=np.int64),
+                             timestamp.shape)
+    attack = attack_label != ATTACK_LABEL_NONE
+    timestamp, attack_label, run = \
+        timestamp[attack], attack_label[attack], run[attack]
+    order = np.lexsort((timestamp, attack_label, run))
+    timestamp, attack_label, run = \
+        timestamp[order], attack_label[order], run[order]
+    begin = np.ones(len(timestamp), dtype=bool)
+    begin[1:] = (run[1:] != run[:-1]) \
+        | (attack_label[1:] != attack_label[:-1]) \
+        | (np.diff(timestamp) > max_gap)
+    first = np.flatnonzero(begin)
+    last = np.append(first[1:], len(timestamp))[:len(first)] - 1
+    intervals = {"run": run[first], "start": timestamp[first],
+                 "end": timestamp[last], "label": attack_label[first],
+                 "frame_num": last - first + 1}
+    order = np.lexsort((intervals["start"], intervals["run"]))
+    return {name: column[order] for name, column in intervals.items()}
+
+
+def get_alert_columns(alerts):
+    # arrays of timestamp and detector name of IdsAlerts
+    return (np.array([i.timestamp for i in alerts], dtype=np.float64),
+            np.array([i.detector for i in alerts], dtype=object))
+
+
+def score_detection(intervals, alert_time, alert_run=None, grace=1.0,
+                    run_num=None):
+    # Score alerts (times, of runs if given) against attack episodes of
+    # get_attack_intervals(). An alert is true if it falls into an episode
+    # of its run, up to grace [s] after its end. An episode is detected by
+    # its first alert from its start on, up to grace after its end, which
+    # gives its time to detect. Return a dict of overall precision, recall
+    # and time to detect, with the counts per run (run_num runs, by
+    # default up to the highest run seen) and the time to detect of every
+    # episode (nan if missed).
+    alert_key = np.sort(_get_keys(alert_run, alert_time))
+    start_key = _get_keys(intervals["run"], intervals["start"])
+    end_key = _get_keys(intervals["run"],
+                        np.asarray(intervals["end"]) + grace)
+
+    # alerts in an episode: the latest episode starting before, with the
+    # furthest end of the episodes before it, as episodes could overlap
+    reach = np.maximum.accumulate(end_key) if len(end_key) else end_key
+    i = np.searchsorted(start_key, alert_key, 'right') - 1
+    true_alert = (i >= 0) & (alert_key <= reach[np.maximum(i, 0)]) \
+        if len(start_key) else np.zeros(len(alert_key), dtype=bool)
+
+    # first alert of every episode
+    j = np.searchsorted(alert_key, start_key, 'left')
+    first_key = alert_key[np.minimum(j, len(alert_key) - 1)] \
+        if len(alert_key) else np.zeros(len(start_key), dtype=np.int64)
+    detected = (j < len(alert_key)) & (first_key <= end_key)
+    time_to_detect = np.where(
+        detected, (first_key - start_key) * SCORING_TIME_RESOLUTION, np.nan)
+
+    alert_run_sorted = alert_key >> RUN_KEY_SHIFT
+    if run_num is None:
+        run_num = int(max(alert_run_sorted.max(initial=-1),
+                          np.max(intervals["run"], initial=-1))) + 1
+    alert_num = len(alert_key)
+    true_num = int(np.count_nonzero(true_alert))
+    episode_num = len(start_key)
+    detected_num = int(np.count_nonzero(detected))
+    return {
+        "alert_num": alert_num,
+        "true_alert_num": true_num,
+        "episode_num": episode_num,
+        "detected_num": detected_num,
+        "precision": true_num / alert_num if alert_num else np.nan,
+        "recall": detected_num / episode_num if episode_num else np.nan,
+        "time_to_detect_mean": float(np.nanmean(time_to_detect))
+        if detected_num else np.nan,
+        "time_to_detect_median": float(np.nanmedian(time_to_detect))
+        if detected_num else np.nan,
+        "time_to_detect": time_to_detect,
+        "run_alert_num": np.bincount(alert_run_sorted, minlength=run_num),
+        "run_true_alert_num": np.bincount(alert_run_sorted[true_alert],
+                                          minlength=run_num),
+        "run_episode_num": np.bincount(intervals["run"], minlength=run_num),
+        "run_detected_num": np.bincount(intervals["run"][detected],
+                                        minlength=run_num)}
+
+
+def score_alerts(intervals, alerts, grace=1.0):
+    # score IdsAlerts of one run, by all and by every detector
+    alert_time, detector = get_alert_columns(alerts)
+    scores = {"all": score_detection(intervals, alert_time, grace=grace)}
+    for name in sorted(set(detector.tolist())):
+        scores[name] = score_detection(intervals,
+                                       alert_time[detector == name],
+                                       grace=grace)
+    return scores
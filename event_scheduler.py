@@ -0,0 +1,88 @@
+from event_table import EventTable
+from itertools import islice
+import numpy as np
+import heapq
+
+
+def iter_event_rows(source):
+    # iterate over (timestamp, ID, value, label) rows of an event source,
+    # which could be an EventTable, a list of CarEvent or an iterable of
+    # rows already
+    if isinstance(source, EventTable):
+        return source.rows()
+    if isinstance(source, list):
+        return EventTable.from_events(source).rows()
+    return iter(source)
+
+
+def iter_event_chunks(source, chunk_size=4096, with_label=False):
+    # iterate over (timestamp, ID, value) column arrays of chunks of up to
+    # chunk_size events of an event source, followed by the label column
+    # with_label
+    if isinstance(source, EventTable):
+        for i in range(0, len(source), chunk_size):
+            chunk = (source.timestamp[i:i+chunk_size],
+                     source.ID[i:i+chunk_size], source.value[i:i+chunk_size])
+            yield chunk + (source.label[i:i+chunk_size],) \
+                if with_label else chunk
+        return
+    rows = iter_event_rows(source)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        columns = list(zip(*chunk))
+        chunk = (np.array(columns[0], dtype=np.float64),
+                 np.array(columns[1], dtype=np.int64),
+                 np.array(columns[2], dtype=np.float64))
+        yield chunk + (np.array(columns[3], dtype=np.int64),) \
+            if with_label else chunk
+
+
+class EventScheduler:
+    # Merge event sources, each sorted by timestamp, into one time sorted
+    # stream of (timestamp, ID, value, label) rows. Sources are merged
+    # lazily with a heap (k-way merge), so a source could also be a
+    # generator producing its events on the fly. Events with the same
+    # timestamp keep the order in which their sources were added, events
+    # pushed into the scheduler come after them.
+
+    PUSHED_EVENT_ORDER = 1 << 30
+
+    def __init__(self, *sources):
+        self.__heap = []
+        self.__source_num = 0
+        self.__push_num = 0
+        for source in sources:
+            self.add_source(source)
+
+    def __next_row(self, order, rows):
+        row = next(rows, None)
+        if row is not None:
+            heapq.heappush(self.__heap, (row[0], order, 0, row, rows))
+
+    def add_source(self, source):
+        self.__next_row(self.__source_num, iter_event_rows(source))
+        self.__source_num += 1
+
+    def push(self, timestamp, ID, value, label=0):
+        # inject a single event into the stream
+        self.__push_num += 1
+        heapq.heappush(self.__heap,
+                       (timestamp, EventScheduler.PUSHED_EVENT_ORDER,
+                        self.__push_num, (timestamp, ID, value, label), None))
+
+    def __len__(self):
+        # number of sources and pushed events still pending
+        return len(self.__heap)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.__heap:
+            raise StopIteration
+        _, order, _, row, rows = heapq.heappop(self.__heap)
+        if rows is not None:
+            self.__next_row(order, rows)
+        return row
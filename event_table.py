@@ -0,0 +1,234 @@
+from glob_def import CarEvent
+from glob_def import ATTACK_TYPE_DDOS, ATTACK_TYPE_REVERSE_GAS
+from glob_def import ATTACK_TYPE_KILL_ENGINE
+from enum import Enum
+import numpy as np
+
+
+# Text labels (the CarEvent.desc strings) are stored as small integer codes.
+# Labels used by the simulator are registered up front, so that the codes
+# are identical in every process.
+_label_text = []
+_label_code = {}
+
+
+def get_label_code(desc):
+    code = _label_code.get(desc)
+    if code is None:
+        code = len(_label_text)
+        _label_text.append(desc)
+        _label_code[desc] = code
+    return code
+
+
+def get_label_text(code):
+    return _label_text[code]
+
+
+for _desc in ("Invalid", "", "Free", "Accelerating", "braking",
+              "Diagnostic", "DOS attack", "Shut down engine",
+              "Set gearshift to Drive", "query speed", "query enginespeed",
+              "query torque", "Reverse gas attack"):
+    get_label_code(_desc)
+
+# Ground truth of events: the attack label is the attack type (ATTACK_TYPE_*)
+# plus one of injected events, ATTACK_LABEL_NONE of the others. Unlike the
+# desc, it's kept in the frames of captures (see packet_proc.py).
+ATTACK_LABEL_NONE = 0
+_attack_label = np.zeros(len(_label_text), dtype=np.uint8)
+for _desc, _type in (("DOS attack", ATTACK_TYPE_DDOS),
+                     ("Reverse gas attack", ATTACK_TYPE_REVERSE_GAS),
+                     ("Shut down engine", ATTACK_TYPE_KILL_ENGINE)):
+    _attack_label[get_label_code(_desc)] = _type + 1
+
+
+def get_attack_label(label):
+    # attack labels of an array of label codes
+    label = np.asarray(label, dtype=np.int64)
+    known = label < len(_attack_label)
+    return np.where(known, _attack_label[np.where(known, label, 0)],
+                    ATTACK_LABEL_NONE).astype(np.uint8)
+
+
+def _event_value(value):
+    # enum values (e.g. gear shift status) are stored by their number
+    return value.value if isinstance(value, Enum) else value
+
+
+class EventView(CarEvent):
+    # Thin CarEvent compatible view on one row of an EventTable. Reading or
+    # writing the attributes goes straight to the table columns.
+    __slots__ = ('_table', '_index')
+
+    def __init__(self, table, index):
+        self._table = table
+        self._index = index
+
+    @property
+    def timestamp(self):
+        return float(self._table._timestamp[self._index])
+
+    @timestamp.setter
+    def timestamp(self, value):
+        self._table._timestamp[self._index] = value
+
+    @property
+    def ID(self):
+        return int(self._table._id[self._index])
+
+    @ID.setter
+    def ID(self, value):
+        self._table._id[self._index] = value
+
+    @property
+    def value(self):
+        return float(self._table._value[self._index])
+
+    @value.setter
+    def value(self, value):
+        self._table._value[self._index] = _event_value(value)
+
+    @property
+    def desc(self):
+        return get_label_text(self._table._label[self._index])
+
+    @desc.setter
+    def desc(self, value):
+        self._table._label[self._index] = get_label_code(value)
+
+
+class EventTable:
+    # Array-backed list of car events, with one column per CarEvent field:
+    # timestamp [s], ID, value and label (code of the desc string).
+    # Rows are appended into preallocated columns which grow on demand.
+
+    def __init__(self, capacity=0):
+        self._size = 0
+        self._timestamp = np.empty(capacity, dtype=np.float64)
+        self._id = np.empty(capacity, dtype=np.int64)
+        self._value = np.empty(capacity, dtype=np.float64)
+        self._label = np.empty(capacity, dtype=np.int16)
+
+    @classmethod
+    def from_columns(cls, timestamp, ID, value, label=0):
+        timestamp = np.asarray(timestamp, dtype=np.float64)
+        table = cls(len(timestamp))
+        table._size = len(timestamp)
+        table._timestamp[:] = timestamp
+        table._id[:] = ID
+        table._value[:] = value
+        if isinstance(label, str):
+            label = get_label_code(label)
+        table._label[:] = label
+        return table
+
+    @classmethod
+    def from_events(cls, event_list):
+        if isinstance(event_list, EventTable):
+            return event_list
+        table = cls(len(event_list))
+        for event in event_list:
+            table.append_event(event)
+        return table
+
+    @classmethod
+    def from_rows(cls, rows):
+        # collect (timestamp, ID, value, label) rows, e.g. an event stream
+        table = cls()
+        for row in rows:
+            table.append(*row)
+        return table
+
+    @classmethod
+    def concatenate(cls, tables):
+        tables = [cls.from_events(i) for i in tables]
+        table = cls(sum(len(i) for i in tables))
+        for i in tables:
+            table.extend(i)
+        return table
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        for i in range(self._size):
+            yield EventView(self, i)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            if key < 0:
+                key += self._size
+            if not 0 <= key < self._size:
+                raise IndexError("event index out of range")
+            return EventView(self, key)
+        # slices, masks and index arrays select a new table
+        return EventTable.from_columns(self.timestamp[key], self.ID[key],
+                                       self.value[key], self.label[key])
+
+    @property
+    def timestamp(self):
+        return self._timestamp[:self._size]
+
+    @property
+    def ID(self):
+        return self._id[:self._size]
+
+    @property
+    def value(self):
+        return self._value[:self._size]
+
+    @property
+    def label(self):
+        return self._label[:self._size]
+
+    def __reserve(self, size):
+        if size <= len(self._timestamp):
+            return
+        capacity = max(size, 2 * len(self._timestamp), 64)
+        for name in ('_timestamp', '_id', '_value', '_label'):
+            column = getattr(self, name)
+            grown = np.empty(capacity, dtype=column.dtype)
+            grown[:self._size] = column[:self._size]
+            setattr(self, name, grown)
+
+    def append(self, timestamp, ID, value, label=0):
+        size = self._size
+        if size == len(self._timestamp):
+            self.__reserve(size + 1)
+        self._timestamp[size] = timestamp
+        self._id[size] = ID
+        self._value[size] = value
+        self._label[size] = label
+        self._size = size + 1
+
+    def append_event(self, event):
+        self.append(event.timestamp, event.ID, _event_value(event.value),
+                    get_label_code(event.desc))
+
+    def extend(self, events):
+        if not isinstance(events, EventTable):
+            for event in events:
+                self.append_event(event)
+            return
+        start, stop = self._size, self._size + len(events)
+        self.__reserve(stop)
+        self._timestamp[start:stop] = events.timestamp
+        self._id[start:stop] = events.ID
+        self._value[start:stop] = events.value
+        self._label[start:stop] = events.label
+        self._size = stop
+
+    def clear(self):
+        self._size = 0
+
+    def sort_by_timestamp(self):
+        # stable sort, events with same timestamp keep their order
+        order = np.argsort(self.timestamp, kind='stable')
+        for name in ('_timestamp', '_id', '_value', '_label'):
+            column = getattr(self, name)
+            column[:self._size] = column[:self._size][order]
+
+    def rows(self):
+        # iterate over (timestamp, ID, value, label) tuples of python scalars
+        return zip(self.timestamp.tolist(), self.ID.tolist(),
+                   self.value.tolist(), self.label.tolist())
@@ -0,0 +1,343 @@
+import os
+import glob
+import json
+import numpy as np
+
+from glob_def import CarEvent
+from vehicle_model import Vehicle
+from event_table import get_attack_label
+from event_scheduler import iter_event_chunks
+from packet_proc import map_canou_frames
+from pcap_file import write_npy_header
+from intrusion_detection import get_frame_columns
+from timing_profile import get_intervals
+
+# Windowed features of CAN traffic for training detectors. Frames are cut
+# into tumbling windows of FEATURE_WINDOW [s], and every window is a sample
+# of FEATURE_NAMES per CAN ID (the IDs of the database, and one bucket of
+# all others), with the highest attack label of its frames. Samples are
+# appended to shards of .npy files, one per array, which are read
+# memory-mapped; a manifest lists the shards of a dataset directory.
+
+FEATURE_WINDOW = 0.1
+FEATURE_NAMES = ("count", "interval_mean", "interval_std", "value")
+FEATURE_DATASET_VERSION = 1
+FEATURE_MANIFEST = "manifest.json"
+
+# arrays of a shard and their dtypes, features are (N, ID, feature)
+SHARD_ARRAYS = {"time": np.float64, "features": np.float32,
+                "label": np.uint8}
+
+
+def get_feature_can_ids(car: Vehicle):
+    # CAN IDs of the messages of the vehicle database
+    codec = car.dbc_data.get_batch_codec()
+    return np.unique(codec.can_id[:-1]).astype(np.int64)
+
+
+class WindowFeatureExtractor:
+    # Features of tumbling windows of frames fed in time order, chunk by
+    # chunk. A window is complete once a frame of a later one is fed, the
+    # last one by flush(). Windows without frames are samples too, values
+    # hold the last one decoded of the ID (nan before the first).
+
+    def __init__(self, can_ids, window=FEATURE_WINDOW):
+        self.can_ids = np.unique(np.asarray(can_ids, dtype=np.int64))
+        self.window = window
+        self.id_num = len(self.can_ids) + 1
+        self.__next_window = None
+        self.__last_time = {}
+        self.__last_value = np.full(self.id_num, np.nan)
+        self.__tail = None
+
+    def __get_slot(self, can_id):
+        pos = np.searchsorted(self.can_ids, can_id)
+        known = pos < len(self.can_ids)
+        known[known] = self.can_ids[pos[known]] == can_id[known]
+        return np.where(known, pos, len(self.can_ids))
+
+    def __get_samples(self, timestamp, can_id, value, label, end_window):
+        # samples of the windows from the next one up to end_window, of
+        # the frames in them
+        first = self.__next_window
+        n = 0 if first is None else int(end_window - first)
+        id_num = self.id_num
+        if n <= 0:
+            return (np.empty(0), np.empty((0, id_num, len(FEATURE_NAMES)),
+                                          dtype=np.float32),
+                    np.empty(0, dtype=np.uint8))
+        row = np.floor(timestamp / self.window).astype(np.int64) - first
+        key = row * id_num + self.__get_slot(can_id)
+        size = n * id_num
+        count = np.bincount(key, minlength=size)
+
+        # inter-arrival times, of the frames in the windows
+        interval_time, interval_id, interval = \
+            get_intervals(timestamp, can_id, self.__last_time)
+        interval_key = (np.floor(interval_time / self.window)
+                        .astype(np.int64) - first) * id_num \
+            + self.__get_slot(interval_id)
+        interval_num = np.bincount(interval_key, minlength=size)
+        interval_sum = np.bincount(interval_key, interval, size)
+        interval_sq = np.bincount(interval_key, interval**2, size)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = np.where(interval_num > 0, interval_sum / interval_num, 0)
+            std = np.sqrt(np.maximum(
+                np.where(interval_num > 0, interval_sq / interval_num, 0)
+                - mean**2, 0))
+
+        # last value of every window and ID, held over windows without
+        value_grid = np.full((n + 1, id_num), np.nan)
+        value_grid[0] = self.__last_value
+        last = len(key) - 1 - np.unique(key[::-1], return_index=True)[1]
+        value_grid.reshape(-1)[id_num + key[last]] = value[last]
+        filled = np.where(np.isnan(value_grid), 0,
+                          np.arange(n + 1)[:, None])
+        filled = np.maximum.accumulate(filled, axis=0)
+        value_grid = value_grid[filled, np.arange(id_num)]
+        self.__last_value = value_grid[-1]
+
+        features = np.stack([count, mean, std], axis=1) \
+            .reshape(n, id_num, 3)
+        features = np.concatenate([features, value_grid[1:, :, None]],
+                                  axis=2).astype(np.float32)
+        window_label = np.zeros(n, dtype=np.uint8)
+        np.maximum.at(window_label, row, label)
+        self.__next_window = end_window
+        return (first + np.arange(n)) * self.window, features, window_label
+
+    def process(self, timestamp, can_id, value, label):
+        # feed a chunk of frames, return the (time, features, label) arrays
+        # of the windows completed
+        columns = [np.asarray(timestamp, dtype=np.float64),
+                   np.asarray(can_id, dtype=np.int64),
+                   np.asarray(value, dtype=np.float64),
+                   np.asarray(label, dtype=np.uint8)]
+        if self.__tail is not None:
+            columns = [np.concatenate(i) for i in zip(self.__tail, columns)]
+        if not len(columns[0]):
+            self.__tail = columns
+            return self.__get_samples(*columns, self.__next_window)
+        window = np.floor(columns[0] / self.window).astype(np.int64)
+        if self.__next_window is None:
+            self.__next_window = int(window[0])
+        # the window of the last frame stays open
+        end = int(np.searchsorted(window, window[-1]))
+        self.__tail = [i[end:] for i in columns]
+        return self.__get_samples(*[i[:end] for i in columns],
+                                  int(window[-1]))
+
+    def flush(self):
+        # samples of the open window
+        if self.__tail is None or not len(self.__tail[0]):
+            return self.process([], [], [], [])
+        tail, self.__tail = self.__tail, None
+        end = int(np.floor(tail[0][-1] / self.window)) + 1
+        return self.__get_samples(*tail, end)
+
+
+class FeatureShardWriter:
+    # Append samples to shards <directory>/<name>_<index>.<array>.npy of
+    # SHARD_ARRAYS, a new shard every shard_size samples. The samples are
+    # appended before the shape in the header is updated (by flush(), and
+    # on every chunk of samples), so a shard memory-mapped while written
+    # holds whole samples only. A closed shard is described by its sidecar
+    # <name>_<index>.json, from which the manifest is built; writers of
+    # different names (e.g. sweep workers) never share a file.
+
+    def __init__(self, directory, name, can_ids, window=FEATURE_WINDOW,
+                 shard_size=1 << 20, meta=None):
+        self.directory = directory
+        self.name = name
+        self.can_ids = [int(i) for i in can_ids]
+        self.window = window
+        self.shard_size = shard_size
+        self.meta = meta or {}
+        self.shards = []
+        self.__files = None
+        self.__sample_num = 0
+        self.__label_num = None
+        os.makedirs(directory, exist_ok=True)
+
+    def __get_shape(self, name, sample_num):
+        if name == "features":
+            return (sample_num, len(self.can_ids) + 1, len(FEATURE_NAMES))
+        return (sample_num,)
+
+    def __open(self):
+        shard = f"{self.name}_{len(self.shards):04d}"
+        self.__files = {}
+        for name, dtype in SHARD_ARRAYS.items():
+            f = open(os.path.join(self.directory, f"{shard}.{name}.npy"),
+                     "wb")
+            write_npy_header(f, dtype, self.__get_shape(name, 0))
+            self.__files[name] = f
+        self.__sample_num = 0
+        self.__label_num = np.zeros(256, dtype=np.int64)
+        self.shards.append(shard)
+
+    def flush(self):
+        if self.__files is None:
+            return
+        for name, f in self.__files.items():
+            f.flush()
+            end = f.tell()
+            write_npy_header(f, SHARD_ARRAYS[name],
+                              self.__get_shape(name, self.__sample_num))
+            f.seek(end)
+            f.flush()
+
+    def __close_shard(self):
+        self.flush()
+        for f in self.__files.values():
+            f.close()
+        self.__files = None
+        shard = self.shards[-1]
+        info = {"version": FEATURE_DATASET_VERSION,
+                "shard": shard,
+                "sample_num": self.__sample_num,
+                "window": self.window,
+                "can_ids": self.can_ids,
+                "feature_names": list(FEATURE_NAMES),
+                "label_num": {str(i): int(n) for i, n in
+                              enumerate(self.__label_num) if n},
+                "meta": self.meta}
+        filename = os.path.join(self.directory, shard + ".json")
+        with open(filename + ".tmp", "w") as f:
+            json.dump(info, f)
+        os.replace(filename + ".tmp", filename)
+
+    def write(self, time, features, label):
+        # append samples, as returned by WindowFeatureExtractor
+        i = 0
+        while i < len(time):
+            if self.__files is None:
+                self.__open()
+            k = min(len(time), i + self.shard_size - self.__sample_num)
+            arrays = {"time": time[i:k], "features": features[i:k],
+                      "label": label[i:k]}
+            for name, f in self.__files.items():
+                f.write(np.ascontiguousarray(
+                    arrays[name], dtype=SHARD_ARRAYS[name]).tobytes())
+            self.__label_num += np.bincount(label[i:k], minlength=256)
+            self.__sample_num += k - i
+            self.flush()
+            if self.__sample_num == self.shard_size:
+                self.__close_shard()
+            i = k
+
+    def close(self):
+        if self.__files is not None:
+            self.__close_shard()
+
+
+def write_manifest(directory):
+    # build the manifest of the closed shards of a dataset directory from
+    # their sidecars, all of the same window, CAN IDs and features
+    shards = []
+    for filename in sorted(glob.glob(os.path.join(directory, "*.json"))):
+        if os.path.basename(filename) == FEATURE_MANIFEST:
+            continue
+        with open(filename) as f:
+            shards.append(json.load(f))
+    layout = [(i["window"], i["can_ids"], i["feature_names"])
+              for i in shards]
+    if len(set(json.dumps(i) for i in layout)) > 1:
+        raise ValueError(f"shards of different layouts in {directory}")
+    manifest = {"version": FEATURE_DATASET_VERSION,
+                "window": shards[0]["window"] if shards else FEATURE_WINDOW,
+                "can_ids": shards[0]["can_ids"] if shards else [],
+                "feature_names": list(FEATURE_NAMES),
+                "sample_num": sum(i["sample_num"] for i in shards),
+                "shards": [{"shard": i["shard"],
+                            "sample_num": i["sample_num"],
+                            "label_num": i["label_num"],
+                            "meta": i["meta"]} for i in shards]}
+    filename = os.path.join(directory, FEATURE_MANIFEST)
+    with open(filename + ".tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(filename + ".tmp", filename)
+    return manifest
+
+
+class FeatureDataset:
+    # Reader of the shards listed in the manifest of a dataset directory,
+    # memory-mapped: samples are only read as they are used.
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, FEATURE_MANIFEST)) as f:
+            self.manifest = json.load(f)
+        self.shards = [i["shard"] for i in self.manifest["shards"]]
+        self.can_ids = np.array(self.manifest["can_ids"], dtype=np.int64)
+        self.window = self.manifest["window"]
+
+    def __len__(self):
+        return self.manifest["sample_num"]
+
+    def get_shard(self, index):
+        # dict of the memory-mapped arrays of a shard
+        return {name: np.load(os.path.join(
+                    self.directory, f"{self.shards[index]}.{name}.npy"),
+                    mmap_mode="r") for name in SHARD_ARRAYS}
+
+    def iter_batches(self, batch_size=4096, shuffle=False, random_seed=None):
+        # (time, features, label) arrays of batches of samples, shard by
+        # shard. Shuffled, the shards and the batches within a shard are
+        # taken in random order, every batch still being a contiguous run
+        # of samples.
+        rng = np.random.default_rng(random_seed)
+        order = rng.permutation(len(self.shards)) if shuffle \
+            else range(len(self.shards))
+        for index in order:
+            shard = self.get_shard(index)
+            size = len(shard["time"])
+            starts = np.arange(0, size, batch_size)
+            if shuffle:
+                starts = rng.permutation(starts)
+            for i in starts.tolist():
+                yield (shard["time"][i:i+batch_size],
+                       shard["features"][i:i+batch_size],
+                       shard["label"][i:i+batch_size])
+
+
+def iter_labelled_simulation_frames(car: Vehicle, event_list,
+                                    chunk_size=4096):
+    # (timestamp, CAN ID, value, attack label) arrays of simulated events
+    # in chunks, CAN IDs as iter_simulation_frames() of
+    # intrusion_detection.py. Free events are left out as in captures.
+    codec = car.dbc_data.get_batch_codec()
+    for timestamp, event_id, value, label in \
+            iter_event_chunks(event_list, chunk_size, with_label=True):
+        keep = event_id != CarEvent.CAR_EVENT_FREE
+        timestamp, event_id, value, label = \
+            timestamp[keep], event_id[keep], value[keep], label[keep]
+        yield (timestamp, codec.get_frame_id(event_id), value,
+               get_attack_label(label))
+
+
+def iter_labelled_capture_frames(car: Vehicle, filename="udp_packet.pcap",
+                                 chunk_size=4096, **selection):
+    # (timestamp, CAN ID, value, attack label) arrays of the frames of a
+    # CANoU capture in chunks, see map_canou_frames() for the selection
+    frame, _ = map_canou_frames(filename, **selection)
+    for i in range(0, len(frame), chunk_size):
+        chunk = frame[i:i+chunk_size]
+        yield get_frame_columns(car, chunk) + (chunk['type'],)
+
+
+def export_features(car: Vehicle, source, directory, name,
+                    window=FEATURE_WINDOW, meta=None, shard_size=1 << 20):
+    # write the window features of a source of labelled frames (e.g.
+    # iter_labelled_capture_frames()) into shards of name in directory,
+    # return the names of the shards
+    extractor = WindowFeatureExtractor(get_feature_can_ids(car), window)
+    writer = FeatureShardWriter(directory, name, extractor.can_ids, window,
+                                shard_size, meta)
+    try:
+        for columns in source:
+            writer.write(*extractor.process(*columns))
+        writer.write(*extractor.flush())
+    finally:
+        writer.close()
+    return writer.shards
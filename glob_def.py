@@ -8,6 +8,11 @@ CAN_DATA_RATE = 1e6  # CAN bus 2.0B data rate = 1Mbps
 CAN_FRAME_LEN = 128  # Exten
 BUS_LOAD = 0.3
 
+# .dbc files of vehicle models (<model>.dbc), and the cache of their
+# compiled form
+DBC_PATH = "dbc"
+DBC_CACHE_PATH = "dbc/cache"
+
 ACCE_RATIO = 0.2
 BRAK_RATIO = 0.03
 DOS_RATIO = 0.9
@@ -22,6 +27,43 @@ TIME_OFFSET = 0.0
 SIMULATION_GENERATE_CAR_DATA = True
 SIMULATION_ANALYZE_CAR_DATA = True
 SIMULATION_SHOW_ANIMATION = True
+# Send the events of simulations over a model of the CAN bus (can_bus.py),
+# with ID arbitration and frame lengths by DLC and bit stuffing, the car
+# perceiving events at their delivery time
+SIMULATION_BUS_ARBITRATION = False
+# Run the intrusion detection (intrusion_detection.py) on the capture
+SIMULATION_RUN_IDS = False
+# Inter-arrival time profile of CAN IDs (timing_profile.py) for the
+# intrusion detection, e.g. "timing_profile.json", which the capture is
+# checked against. If the file doesn't exist, the profile is learned from
+# a run of the scenario without its attack and saved first. None for no
+# timing check.
+SIMULATION_TIMING_PROFILE = None
+# Stream events through generation, driving, capture and analysis instead
+# of keeping whole runs in memory, for long simulation durations
+SIMULATION_STREAMING = False
+# Captures exported along with the CANoU capture (udp_packet.pcap), from the
+# same encoding pass: SocketCAN capture (can_packet.pcap) and raw binary
+# CANoU frames (can_frame.bin)
+SIMULATION_EXPORT_CAN_PACKET = False
+SIMULATION_EXPORT_RAW_FRAME = False
+# Directory of the windowed feature dataset (feature_dataset.py) exported
+# from the capture for training detectors, e.g. "features". None for no
+# export.
+SIMULATION_EXPORT_FEATURES = None
+# Records per block of the sidecar index of captures (e.g.
+# udp_packet.pcap.idx), to read time ranges and CAN IDs of them without
+# reading whole captures. None for no index.
+CAPTURE_INDEX_BLOCK_SIZE = 1024
+# Index the records of streaming captures by CAN ID as well, otherwise they
+# are only indexed by time. The posting lists are flushed into the sidecar
+# as the capture is written, but take 8 bytes per record on disk.
+CAPTURE_INDEX_STREAMING_KEYS = False
+# Run the attack scenarios in a pool of worker processes when above 1, with
+# per scenario outputs and a summary instead of plots
+SIMULATION_PROCESS_NUM = 1
+# Base seed, from which the independent seed of every scenario is derived
+SIMULATION_RANDOM_SEED = 1
 
 ATTACK_TYPE_DDOS = 0
 ATTACK_TYPE_REVERSE_GAS = 1
@@ -0,0 +1,465 @@
+import math
+from time import perf_counter
+import numpy as np
+
+from vehicle_model import Vehicle
+from event_scheduler import iter_event_chunks
+from packet_proc import map_canou_frames
+from timing_profile import get_intervals
+
+# Online intrusion detection on the frames of a CAN bus. Frames are fed in
+# time order as (timestamp, CAN ID, value) column arrays, in chunks of any
+# size, from a capture, the live CANoU collector or the simulator. Every
+# detector keeps its state between chunks and processes a chunk with numpy
+# at a constant cost per frame. Alerts are raised when a detector crosses
+# its threshold, not on every frame beyond it.
+
+
+class IdsAlert:
+
+    def __init__(self, timestamp, detector, ID, score, desc=""):
+        self.timestamp = timestamp
+        self.detector = detector
+        self.ID = ID
+        self.score = score
+        self.desc = desc
+
+    def __repr__(self):
+        return (f"IdsAlert({self.timestamp:.6f}, {self.detector}, "
+                f"ID={self.ID:#x}, score={self.score:g}, {self.desc!r})")
+
+
+def get_bus_frame_rate(bitrate=1e6, data_len=8):
+    # frames per second of a fully loaded CAN bus of standard (11 bit ID)
+    # data frames, without stuff bits: 44 bits of frame and 3 bits of
+    # interframe space besides the data
+    return bitrate / (47 + 8*data_len)
+
+
+def _lookup(keys, table, default):
+    # values of keys in table (a dict), default for keys not in it
+    if not table:
+        return np.full(len(keys), default, dtype=np.float64)
+    known = np.array(sorted(table), dtype=np.int64)
+    value = np.array([table[i] for i in known.tolist()] + [default],
+                     dtype=np.float64)
+    pos = np.searchsorted(known, keys)
+    pos[pos == len(known)] = 0
+    return np.where(known[pos] == keys, value[pos], default)
+
+
+class SlidingWindowCounter:
+    # Number of frames of every key in the sliding window (t - window, t]
+    # of each frame. The times of every key in the window are kept in a
+    # ring buffer of its own, from a head moved on as they drop out of the
+    # window, so the counts of a chunk are exact and the cost per frame
+    # doesn't depend on the window or chunk size. Keys without frames in a
+    # window are dropped.
+
+    def __init__(self, window=1.0):
+        self.window = window
+        # buffer, head and tail of the times of every key
+        self.__rings = {}
+        self.__sweep_time = -np.inf
+
+    def __append(self, k, time):
+        # append times of a key to its buffer, return the buffer with the
+        # times in the window before them and those times, and their number
+        ring = self.__rings.get(k)
+        if ring is None:
+            ring = self.__rings[k] = [np.empty(max(16, 2*len(time))), 0, 0]
+        buf, head, tail = ring
+        if tail + len(time) > len(buf):
+            # move the times in the window to the start, into a buffer of
+            # twice their number at least
+            live = tail - head
+            if 2 * (live + len(time)) > len(buf):
+                buf = np.empty(2 * (live + len(time)))
+            buf[:live] = ring[0][head:tail]
+            head, tail = 0, live
+        buf[tail:tail+len(time)] = time
+        ring[:] = buf, head, tail + len(time)
+        return buf[head:tail+len(time)], tail - head
+
+    def count(self, timestamp, key):
+        # return the count of every frame, itself included
+        count = np.empty(len(key), dtype=np.int64)
+        if not len(key):
+            return count
+        order = np.argsort(key, kind='stable')
+        key_sorted = key[order]
+        # frames of each key in the chunk
+        bounds = (np.flatnonzero(key_sorted[1:] != key_sorted[:-1])
+                  + 1).tolist()
+        for s, e in zip([0] + bounds, bounds + [len(order)]):
+            k = int(key_sorted[s])
+            index = order[s:e]
+            time = timestamp[index]
+            window, history_num = self.__append(k, time)
+            lower = np.searchsorted(window, time - self.window, 'right')
+            count[index] = history_num + np.arange(1, e - s + 1) - lower
+            self.__rings[k][1] += int(lower[-1])
+
+        # drop the keys of no frame in the last window, once per window
+        now = float(timestamp[-1])
+        if now - self.__sweep_time >= self.window:
+            self.__sweep_time = now
+            self.__rings = {k: ring for k, ring in self.__rings.items()
+                            if ring[0][ring[2]-1] > now - self.window}
+        return count
+
+
+def _get_crossing_alerts(detector, timestamp, ID, key, count, threshold,
+                         last_alert_time, desc):
+    # alerts of the frames whose count crosses over the threshold, that is
+    # which were at most the threshold without the frame. A count hovering
+    # around the threshold is alerted once per window of the key, by
+    # last_alert_time (a dict by key).
+    alerts = []
+    cross = np.flatnonzero((count > threshold) & (count - 1 <= threshold))
+    for i in cross.tolist():
+        k = int(key[i])
+        if timestamp[i] - last_alert_time.get(k, -np.inf) < \
+                detector.counter.window:
+            continue
+        last_alert_time[k] = timestamp[i]
+        alerts.append(IdsAlert(timestamp[i], detector.name, int(ID[i]),
+                               int(count[i]), desc))
+    return alerts
+
+
+class RateDetector:
+    # Frames of a CAN ID in a sliding window above the rate learned for the
+    # ID, in its training period (training_time [s] from the first frame):
+    # tolerance times the highest count in a window, at least min_count.
+    # IDs not seen in training are allowed new_id_max_count frames.
+
+    name = "rate"
+
+    def __init__(self, window=1.0, training_time=10.0, tolerance=1.5,
+                 min_count=10, new_id_max_count=10):
+        self.counter = SlidingWindowCounter(window)
+        self.training_time = training_time
+        self.tolerance = tolerance
+        self.min_count = min_count
+        self.new_id_max_count = new_id_max_count
+        self.max_count = {}
+        self.__training_end = None
+        self.__threshold = None
+        self.__last_alert_time = {}
+
+    def process(self, timestamp, ID, value):
+        count = self.counter.count(timestamp, ID)
+        if self.__training_end is None and len(timestamp):
+            self.__training_end = timestamp[0] + self.training_time
+        training = timestamp < self.__training_end
+        if np.any(training):
+            # highest count of every ID in training
+            order = np.argsort(ID[training], kind='stable')
+            ids = ID[training][order]
+            start = np.flatnonzero(np.concatenate(
+                ([True], ids[1:] != ids[:-1])))
+            max_count = np.maximum.reduceat(count[training][order], start)
+            for i, n in zip(ids[start].tolist(), max_count.tolist()):
+                self.max_count[i] = max(self.max_count.get(i, 0), n)
+            self.__threshold = None
+        if np.all(training):
+            return []
+
+        if self.__threshold is None:
+            self.__threshold = {i: max(math.ceil(n * self.tolerance),
+                                       self.min_count)
+                                for i, n in self.max_count.items()}
+        threshold = _lookup(ID, self.__threshold, self.new_id_max_count)
+        threshold[training] = np.inf
+        return _get_crossing_alerts(self, timestamp, ID, ID, count,
+                                    threshold, self.__last_alert_time,
+                                    "frame rate of ID")
+
+
+class LowIdFloodDetector:
+    # Flooding of the bus with the highest priority IDs (at most max_id),
+    # which win the arbitration over all others: at least max_count of
+    # those frames in a sliding window. The same check as the DoS detection
+    # of the vehicle, on a sliding instead of a fixed window; max_count is
+    # Vehicle.invalid_msg_threshold at the time of creation by default.
+
+    name = "low_id_flood"
+
+    def __init__(self, max_id=0x10, window=1.0, max_count=None):
+        self.counter = SlidingWindowCounter(window)
+        self.max_id = max_id
+        if max_count is None:
+            max_count = Vehicle.invalid_msg_threshold
+        self.max_count = max_count
+        self.__last_alert_time = {}
+
+    def process(self, timestamp, ID, value):
+        low = ID <= self.max_id
+        timestamp, ID = timestamp[low], ID[low]
+        key = np.zeros_like(ID)
+        count = self.counter.count(timestamp, key)
+        # counts are whole, count >= max_count as count > ceil(max_count)-1
+        return _get_crossing_alerts(self, timestamp, ID, key, count,
+                                    np.ceil(self.max_count) - 1,
+                                    self.__last_alert_time,
+                                    "low ID flooding")
+
+
+class EntropyDetector:
+    # Shannon entropy [bit] of the distribution of the CAN IDs of frames in
+    # tumbling windows, off the mean of the training_window_num windows
+    # first by more than tolerance times their standard deviation (and at
+    # least min_delta). Flooding with one ID lowers the entropy, with
+    # random IDs raises it. A window is checked once the next one begins.
+
+    name = "entropy"
+
+    def __init__(self, window=1.0, training_window_num=10, tolerance=4.0,
+                 min_delta=0.2):
+        self.window = window
+        self.training_window_num = training_window_num
+        self.tolerance = tolerance
+        self.min_delta = min_delta
+        self.entropy = []
+        self.__index = None
+        self.__counts = {}
+        self.__mean = self.__std = None
+
+    def __close_window(self):
+        count = np.array(list(self.__counts.values()), dtype=np.float64)
+        p = count / count.sum()
+        entropy = float(-np.sum(p * np.log2(p)))
+        self.entropy.append(entropy)
+        timestamp = (self.__index + 1) * self.window
+        self.__counts = {}
+        if len(self.entropy) <= self.training_window_num:
+            if len(self.entropy) == self.training_window_num:
+                self.__mean = float(np.mean(self.entropy))
+                self.__std = float(np.std(self.entropy))
+            return []
+        delta = entropy - self.__mean
+        if abs(delta) > max(self.tolerance * self.__std, self.min_delta):
+            return [IdsAlert(timestamp, self.name, -1, entropy,
+                             "ID entropy " + ("low" if delta < 0 else "high"))]
+        return []
+
+    def process(self, timestamp, ID, value):
+        alerts = []
+        index = np.floor(timestamp / self.window).astype(np.int64)
+        # frames of each window in the chunk
+        bounds = np.flatnonzero(np.diff(index)) + 1
+        for begin, end in zip([0] + bounds.tolist(),
+                              bounds.tolist() + [len(index)]):
+            if begin == end:
+                continue
+            if self.__index is not None and index[begin] != self.__index:
+                alerts += self.__close_window()
+            self.__index = int(index[begin])
+            ids, count = np.unique(ID[begin:end], return_counts=True)
+            for i, n in zip(ids.tolist(), count.tolist()):
+                self.__counts[i] = self.__counts.get(i, 0) + n
+        return alerts
+
+
+class SignalDetector:
+    # Values of signals out of range or changing faster than allowed.
+    # limits maps CAN IDs to (minimum, maximum, max_rate) of their values,
+    # max_rate in units per second, None for no limit.
+
+    name = "signal"
+
+    def __init__(self, limits):
+        self.limits = dict(limits)
+        self.ids = np.array(sorted(self.limits), dtype=np.int64)
+        self.__last_time = {}
+        self.__last_value = {}
+        self.__violating = {}
+
+    def __get_limit(self, ID, k, default):
+        return _lookup(ID, {i: self.limits[i][k] for i in self.limits
+                            if self.limits[i][k] is not None}, default)
+
+    def process(self, timestamp, ID, value):
+        checked = np.isin(ID, self.ids)
+        timestamp, ID, value = timestamp[checked], ID[checked], value[checked]
+        if not len(ID):
+            return []
+        order = np.argsort(ID, kind='stable')
+        timestamp, ID, value = timestamp[order], ID[order], value[order]
+        is_first = np.empty(len(ID), dtype=bool)
+        is_first[0] = True
+        is_first[1:] = ID[1:] != ID[:-1]
+
+        # rate of change from the previous frame of the ID
+        first_ids = ID[is_first].tolist()
+        prev_time = np.roll(timestamp, 1)
+        prev_value = np.roll(value, 1)
+        prev_time[is_first] = [self.__last_time.get(i, np.nan)
+                               for i in first_ids]
+        prev_value[is_first] = [self.__last_value.get(i, np.nan)
+                                for i in first_ids]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rate = np.abs(value - prev_value) / (timestamp - prev_time)
+        violating = (value < self.__get_limit(ID, 0, -np.inf)) \
+            | (value > self.__get_limit(ID, 1, np.inf)) \
+            | (rate > self.__get_limit(ID, 2, np.inf))
+
+        # alerts on frames starting a run of violations
+        prev_violating = np.roll(violating, 1)
+        prev_violating[is_first] = [self.__violating.get(i, False)
+                                    for i in first_ids]
+        alerts = [IdsAlert(timestamp[i], self.name, int(ID[i]),
+                           float(value[i]), "signal value out of limits")
+                  for i in np.flatnonzero(violating & ~prev_violating)]
+        alerts.sort(key=lambda alert: alert.timestamp)
+
+        is_last = np.roll(is_first, -1)
+        for i in np.flatnonzero(is_last).tolist():
+            self.__last_time[ID[i]] = timestamp[i]
+            self.__last_value[ID[i]] = value[i]
+            self.__violating[ID[i]] = bool(violating[i])
+        return alerts
+
+
+class TimingDetector:
+    # Inter-arrival times of CAN IDs off their profile (a TimingProfile of
+    # timing_profile.py learned from clean traffic): shorter than the
+    # low_percentile interval by more than tolerance times, e.g. frames
+    # injected between the periodic ones, or longer than the
+    # high_percentile interval by more than tolerance times. IDs profiled
+    # on less than min_count intervals are not checked (new IDs are left
+    # to RateDetector).
+
+    name = "timing"
+
+    def __init__(self, profile, low_percentile=0.1, high_percentile=99.9,
+                 tolerance=2.0, min_count=100):
+        lower, upper = {}, {}
+        for i in profile.ids[profile.count >= min_count].tolist():
+            low, high = profile.get_percentile(
+                i, [low_percentile, high_percentile]).tolist()
+            lower[i], upper[i] = low / tolerance, high * tolerance
+        self.lower = lower
+        self.upper = upper
+        self.__last_time = {}
+        self.__violating = {}
+
+    def process(self, timestamp, ID, value):
+        timestamp, ID, interval = get_intervals(timestamp, ID,
+                                                self.__last_time)
+        if not len(ID):
+            return []
+        short = interval < _lookup(ID, self.lower, -np.inf)
+        violating = short | (interval > _lookup(ID, self.upper, np.inf))
+
+        # alerts on frames starting a run of violations
+        is_first = np.empty(len(ID), dtype=bool)
+        is_first[0] = True
+        is_first[1:] = ID[1:] != ID[:-1]
+        prev_violating = np.roll(violating, 1)
+        prev_violating[is_first] = [self.__violating.get(i, False)
+                                    for i in ID[is_first].tolist()]
+        alerts = [IdsAlert(timestamp[i], self.name, int(ID[i]),
+                           float(interval[i]),
+                           "inter-arrival time " +
+                           ("short" if short[i] else "long"))
+                  for i in np.flatnonzero(violating & ~prev_violating)]
+        alerts.sort(key=lambda alert: alert.timestamp)
+
+        is_last = np.roll(is_first, -1)
+        self.__violating.update(zip(ID[is_last].tolist(),
+                                    violating[is_last].tolist()))
+        return alerts
+
+
+def get_default_detectors(signal_limits=None):
+    detectors = [RateDetector(), LowIdFloodDetector(), EntropyDetector()]
+    if signal_limits:
+        detectors.append(SignalDetector(signal_limits))
+    return detectors
+
+
+class IdsEngine:
+    # Run detectors on chunks of frames, collecting their alerts and the
+    # processing time
+
+    def __init__(self, detectors=None):
+        self.detectors = get_default_detectors() \
+            if detectors is None else detectors
+        self.alerts = []
+        self.frame_num = 0
+        self.chunk_num = 0
+        self.busy_time = 0.0
+
+    def process(self, timestamp, ID, value):
+        # process a chunk of frames, return its alerts in time order
+        start = perf_counter()
+        timestamp = np.asarray(timestamp, dtype=np.float64)
+        ID = np.asarray(ID, dtype=np.int64)
+        value = np.asarray(value, dtype=np.float64)
+        alerts = []
+        for detector in self.detectors:
+            alerts += detector.process(timestamp, ID, value)
+        alerts.sort(key=lambda alert: alert.timestamp)
+        self.alerts += alerts
+        self.frame_num += len(timestamp)
+        self.chunk_num += 1
+        self.busy_time += perf_counter() - start
+        return alerts
+
+    def run(self, source):
+        # process all chunks of a source of (timestamp, ID, value) arrays
+        for timestamp, ID, value in source:
+            self.process(timestamp, ID, value)
+        return self.alerts
+
+    def get_stats(self, bitrate=1e6):
+        # throughput, and its headroom over a fully loaded bus of bitrate
+        frame_rate = self.frame_num / self.busy_time \
+            if self.busy_time else 0.0
+        alert_num = {i.name: 0 for i in self.detectors}
+        for alert in self.alerts:
+            alert_num[alert.detector] += 1
+        return {"frame_num": self.frame_num,
+                "chunk_num": self.chunk_num,
+                "busy_time": self.busy_time,
+                "frame_rate": frame_rate,
+                "bus_load_headroom": frame_rate / get_bus_frame_rate(bitrate),
+                "alert_num": alert_num}
+
+
+def get_frame_columns(car: Vehicle, frame):
+    # (timestamp, CAN ID, value) arrays of CANoU frames, values of CAN IDs
+    # unknown to the vehicle are decoded by the default layout
+    codec = car.dbc_data.get_batch_codec()
+    event_id = codec.get_event_id_by_can_id(frame['identifier'])
+    timestamp = ((frame['timestamp_upper'].astype(np.int64) << 32)
+                 + frame['timestamp_lower']) * 1e-3
+    return (timestamp, frame['identifier'].astype(np.int64),
+            codec.decode(event_id, frame['data']))
+
+
+def iter_capture_frames(car: Vehicle, filename="udp_packet.pcap",
+                        chunk_size=4096, **selection):
+    # frames of a CANoU capture in chunks, see map_canou_frames() for the
+    # selection by time range and CAN IDs
+    frame, _ = map_canou_frames(filename, **selection)
+    for i in range(0, len(frame), chunk_size):
+        yield get_frame_columns(car, frame[i:i+chunk_size])
+
+
+def iter_simulation_frames(car: Vehicle, event_list, chunk_size=4096):
+    # frames of simulated events in chunks, event_list could also be a
+    # stream of event rows. Events are mapped to the CAN IDs of their
+    # messages, IDs of events not in the database are taken as CAN IDs.
+    codec = car.dbc_data.get_batch_codec()
+    for timestamp, event_id, value in \
+            iter_event_chunks(event_list, chunk_size):
+        yield timestamp, codec.get_frame_id(event_id), value
+
+
+async def iter_collector_frames(collector, idle_timeout=1.0):
+    # frames received by a CanouCollector (see canou_stream.py) in chunks
+    async for frame in collector.iter_frames(idle_timeout):
+        yield get_frame_columns(collector.car, frame)
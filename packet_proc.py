@@ -1,50 +1,210 @@
 from glob_def import CarEvent
-from scapy.layers.can import CAN
-from scapy.layers.inet import IP, UDP
-from scapy.utils import wrpcap, rdpcap
 from vehicle_model import Vehicle
-from dbc_msg_conversion import DbcMsgConvertor
-
-import struct
-
-
-def write_car_event_to_can_packet(car: Vehicle, event_list: CarEvent):
-    pkt_list = []
-    for event in event_list:
-        if event.ID == CarEvent.CAR_EVENT_FREE:
-            continue
-        data = car.dbc_data.simple_msg_encode(event.ID, event.value)
-
-        # extend to 8 bytes by padding zero
-        data = data+'00'*(8-car.dbc_data.get_msg_length_in_byte(event.ID))
-
-        byte0, byte1, byte2, byte3, byte4, byte5, byte6, byte7 = \
-            int(data[0:2], 16), \
-            int(data[2:4], 16), \
-            int(data[4:6], 16), \
-            int(data[6:8], 16), \
-            int(data[8:10], 16), \
-            int(data[10:12], 16), \
-            int(data[12:14], 16), \
-            int(data[14:], 16)
-
-        can_payload = \
-            struct.pack('<8B', byte0, byte1, byte2, byte3,
-                        byte4, byte5, byte6, byte7)
-        pkt = CAN(identifier=event.ID, length=len(data), data=can_payload)
-        pkt.time = event.timestamp
-        pkt_list.append(pkt)
-
-    wrpcap("can_packet.pcap", pkt_list)
+from event_table import EventTable, get_label_code, get_attack_label
+from event_scheduler import iter_event_chunks
+from pcap_file import PcapFileWriter, LINKTYPE_CAN_SOCKETCAN, LINKTYPE_IPV4
+from pcap_file import build_udp_packets, build_socketcan_frames
+from pcap_file import map_udp_payloads, load_pcap_index
+from itertools import repeat
+import numpy as np
+
+# CANoU frame, the UDP payload of a CAN frame (see
+# write_car_event_to_udp_packet). The type field, 0 in the reference
+# format, carries the attack label of the event (see get_attack_label()).
+CANOU_FRAME_DTYPE = np.dtype([('timestamp_upper', '<u4'),
+                              ('timestamp_lower', '<u4'),
+                              ('identifier', '<u4'),
+                              ('type', 'u1'),
+                              ('info_a', 'u1'),
+                              ('info_b', 'u1'),
+                              ('data_len', 'u1'),
+                              ('data', 'u1', (8,))])
+
+
+def _build_canou_frame(codec, timestamp, event_id, slot, payload,
+                       attack_label=0):
+    # CANoU frames of events by their table slots and encoded payloads.
+    # Frames of events not in the database carry their event ID as CAN ID.
+    timestamp_ms = (np.asarray(timestamp) * 1e3).astype(np.int64)
+    frame = np.zeros(len(timestamp_ms), dtype=CANOU_FRAME_DTYPE)
+    frame['timestamp_upper'] = timestamp_ms >> 32
+    frame['timestamp_lower'] = timestamp_ms & 0xffffffff
+    frame['identifier'] = codec.get_frame_id(event_id, slot)
+    frame['type'] = attack_label
+    frame['info_a'] = 0x05
+    frame['info_b'] = 0x05
+    frame['data_len'] = codec.byte_len[slot]
+    frame['data'] = payload
+    return frame
+
+
+def encode_canou_frame(car: Vehicle, timestamp, event_id, value):
+    # encode arrays of events into an array of CANoU frames
+    codec = car.dbc_data.get_batch_codec()
+    slot = codec.get_slot(event_id)
+    return _build_canou_frame(codec, timestamp, event_id, slot,
+                              codec.encode(event_id, value, slot))
+
+
+def decode_canou_frame(car: Vehicle, frame):
+    # decode an array of CANoU frames into arrays of timestamp, event ID and
+    # value, frames of unknown events are dropped
+    codec = car.dbc_data.get_batch_codec()
+    event_id = codec.get_event_id_by_can_id(frame['identifier'])
+    frame = frame[event_id != CarEvent.CAR_EVENT_UNKNOWN]
+    event_id = event_id[event_id != CarEvent.CAR_EVENT_UNKNOWN]
+    timestamp = ((frame['timestamp_upper'].astype(np.int64) << 32)
+                 + frame['timestamp_lower']) * 1e-3
+    return timestamp, event_id, codec.decode(event_id, frame['data'])
+
+
+class EncodedEventChunk:
+    # A chunk of events encoded once for all outputs of an export: the
+    # events (free events left out), their codec table slots, CAN payloads
+    # and attack labels (of the label codes, if given). The CANoU frames
+    # are built on first use and shared by the outputs. Arrays of the event
+    # source are never modified.
+
+    def __init__(self, codec, timestamp, event_id, value, label=None):
+        keep = event_id != CarEvent.CAR_EVENT_FREE
+        self.codec = codec
+        self.timestamp = timestamp[keep]
+        self.event_id = event_id[keep]
+        self.value = value[keep]
+        self.attack_label = 0 if label is None else \
+            get_attack_label(label[keep])
+        self.slot = codec.get_slot(self.event_id)
+        # payload of 8 bytes padded with zero
+        self.payload = codec.encode(self.event_id, self.value, self.slot)
+        self.__canou_frame = None
+
+    def __len__(self):
+        return len(self.event_id)
+
+    def get_canou_frame(self):
+        # timestamps and CANoU frames of the events except gear status
+        # broadcasts, with the value of ICE gas acceleration pre-processed
+        if self.__canou_frame is None:
+            keep = self.event_id != CarEvent.CAR_EVENT_BROADCAST_GEAR_STATUS
+            event_id = self.event_id[keep]
+            payload = self.payload[keep]
+            gas = event_id == CarEvent.CAR_EVENT_GAS_ACC_VIA_ICE
+            if np.any(gas):
+                # re-encode only those few, payload is a copy already
+                payload[gas] = self.codec.encode(
+                    event_id[gas], (0x58 << 16) + self.value[keep][gas]*0xFFFF)
+            timestamp = self.timestamp[keep]
+            attack_label = self.attack_label if np.isscalar(
+                self.attack_label) else self.attack_label[keep]
+            self.__canou_frame = timestamp, _build_canou_frame(
+                self.codec, timestamp, event_id, self.slot[keep], payload,
+                attack_label)
+        return self.__canou_frame
+
+
+class CanPacketOutput:
+    # SocketCAN capture of the events, written to pcap_writer if given
+    # (e.g. a BackgroundCaptureWriter of a PcapSegmentWriter with the link
+    # type LINKTYPE_CAN_SOCKETCAN) instead of filename. With
+    # index_block_size set, the capture is indexed (PcapIndex), by CAN ID
+    # too with index_keys.
+
+    def __init__(self, filename="can_packet.pcap", pcap_writer=None,
+                 index_block_size=None, index_keys=True):
+        self.filename = filename
+        self.pcap_writer = pcap_writer or \
+            PcapFileWriter(filename, LINKTYPE_CAN_SOCKETCAN,
+                           index_block_size=index_block_size,
+                           index_keys=index_keys)
+
+    def write(self, chunk: EncodedEventChunk):
+        # length is kept as the number of hex digits of the padded data,
+        # which were doubled for unknown events
+        hex_len = np.where(chunk.codec.byte_len[chunk.slot] > 0, 16, 32)
+        self.pcap_writer.write_array(
+            chunk.timestamp,
+            build_socketcan_frames(chunk.event_id, hex_len, chunk.payload),
+            chunk.event_id)
+
+    def close(self):
+        self.pcap_writer.close()
+
+
+class UdpPacketOutput:
+    # CANoU capture of the events, see write_car_event_to_udp_packet().
+    # Written to pcap_writer if given (link type LINKTYPE_IPV4) instead of
+    # filename. With index_block_size set, the capture is indexed
+    # (PcapIndex), by CAN ID too with index_keys.
+
+    def __init__(self, filename="udp_packet.pcap", src_ip="192.168.3.31",
+                 dst_ip="192.168.3.1", src_port=1236, dst_port=0x0cb0,
+                 pcap_writer=None, index_block_size=None, index_keys=True):
+        self.filename = filename
+        self.address = (src_ip, dst_ip, src_port, dst_port)
+        self.pcap_writer = pcap_writer or \
+            PcapFileWriter(filename, LINKTYPE_IPV4,
+                           index_block_size=index_block_size,
+                           index_keys=index_keys)
+
+    def write(self, chunk: EncodedEventChunk):
+        timestamp, frame = chunk.get_canou_frame()
+        self.pcap_writer.write_array(
+            timestamp,
+            build_udp_packets(frame.view(np.uint8).reshape(len(frame), -1),
+                              *self.address),
+            frame['identifier'])
+
+    def close(self):
+        self.pcap_writer.close()
+
+
+class RawFrameOutput:
+    # Raw binary file of the CANoU frames of the events, back to back
+    # without headers (see map_raw_canou_frames())
+
+    def __init__(self, filename="can_frame.bin", buffer_size=1 << 20):
+        self.filename = filename
+        self.f = open(filename, 'wb', buffer_size)
+
+    def write(self, chunk: EncodedEventChunk):
+        self.f.write(chunk.get_canou_frame()[1].tobytes())
+
+    def close(self):
+        self.f.close()
+
+
+def export_car_event(car: Vehicle, event_list: EventTable, outputs,
+                     chunk_size=4096):
+    # Encode the events once and write them into every output
+    # (CanPacketOutput, UdpPacketOutput, RawFrameOutput, ...) from the same
+    # payloads. event_list could also be a stream of event rows, events are
+    # encoded and written in chunks. Outputs are closed at the end.
+    codec = car.dbc_data.get_batch_codec()
+    try:
+        for timestamp, event_id, value, label in \
+                iter_event_chunks(event_list, chunk_size, with_label=True):
+            chunk = EncodedEventChunk(codec, timestamp, event_id, value,
+                                      label)
+            for output in outputs:
+                output.write(chunk)
+    finally:
+        for output in outputs:
+            output.close()
+
+
+def write_car_event_to_can_packet(car: Vehicle, event_list: EventTable,
+                                  filename="can_packet.pcap"):
+    export_car_event(car, event_list, [CanPacketOutput(filename)])
     return
 
 
 def write_car_event_to_udp_packet(car: Vehicle,
-                                  event_list: CarEvent,
+                                  event_list: EventTable,
                                   src_ip="192.168.3.31",
                                   dst_ip="192.168.3.1",
                                   src_port=1236,
-                                  dst_port=0x0cb0):
+                                  dst_port=0x0cb0,
+                                  filename="udp_packet.pcap"):
     # UDP packet format is defined in:
     # National Instrument. Compact RIO Reference and Procedures
     # (FPGA Interface).
@@ -58,58 +218,63 @@ def write_car_event_to_udp_packet(car: Vehicle,
     # | Type    | InfoA   | InfoB   | DataLength |
     # | Data[0] | Data[1] | Data[2] | Data[3]    |
     # | Data[4] | Data[5] | Data[6] | Data[7]    |
-
-    pkt_list = []
-    for event in event_list:
-        if event.ID == CarEvent.CAR_EVENT_FREE:
-            continue
-        if event.ID == CarEvent.CAR_EVENT_BROADCAST_GEAR_STATUS:
-            continue
-        if event.ID == CarEvent.CAR_EVENT_GAS_ACC_VIA_ICE:
-            # pre-process the message value
-            event.value = (0x58 << 16) + event.value*0xFFFF
-
-        data = car.dbc_data.simple_msg_encode(event.ID, event.value)
-        # convert data into 8 bytes
-        data = data+'00'*(8-car.dbc_data.get_msg_length_in_byte(event.ID))
-        byte0, byte1, byte2, byte3, byte4, byte5, byte6, byte7 = \
-            int(data[0:2], 16), \
-            int(data[2:4], 16), \
-            int(data[4:6], 16), \
-            int(data[6:8], 16), \
-            int(data[8:10], 16), \
-            int(data[10:12], 16), \
-            int(data[12:14], 16), \
-            int(data[14:], 16)
-
-        udp_time_upper32 = int(event.timestamp*1e3) >> 32
-        udp_time_lower32 = int(event.timestamp*1e3) & 0xffffffff
-        udp_identifier = car.dbc_data.get_msg_can_id(event.ID)
-        udp_type = 0x0
-        udp_infoA = 0x05
-        udp_infoB = 0x05
-        udp_datalen = car.dbc_data.get_msg_length_in_byte(event.ID)
-
-        udp_payload = struct.pack('<3I4B8B',
-                                  udp_time_upper32,
-                                  udp_time_lower32,
-                                  udp_identifier,
-                                  udp_type,
-                                  udp_infoA, udp_infoB, udp_datalen,
-                                  byte0, byte1, byte2, byte3,
-                                  byte4, byte5, byte6, byte7)
-        pkt = IP(src=src_ip, dst=dst_ip) \
-            / UDP(sport=src_port, dport=dst_port) \
-            / udp_payload
-        pkt.time = event.timestamp
-        pkt_list.append(pkt)
-
-    wrpcap("udp_packet.pcap", pkt_list)
+    export_car_event(car, event_list, [UdpPacketOutput(
+        filename, src_ip, dst_ip, src_port, dst_port)])
     # send(pkt, inter=1, count=5)
     return
 
 
-def read_car_event_from_udp_packet(car: Vehicle) -> CarEvent:
+def map_raw_canou_frames(filename="can_frame.bin"):
+    # CANoU frames of a raw binary file (see RawFrameOutput) as a
+    # memory-mapped array of CANOU_FRAME_DTYPE
+    return np.memmap(filename, dtype=CANOU_FRAME_DTYPE, mode='r')
+
+
+def map_canou_frames(filename="udp_packet.pcap", dst_port=None,
+                     start_time=None, end_time=None, can_ids=None):
+    # CANoU frames of a capture as an array of CANOU_FRAME_DTYPE, which is a
+    # view of the memory-mapped capture file (see map_udp_payloads()), and
+    # the timestamps of their records. Frames could be selected by time
+    # range [start_time, end_time) and CAN IDs, if the capture has an index
+    # (PcapIndex) only the records which could be those are read.
+    byte_range = record_offsets = None
+    if start_time is not None or end_time is not None or can_ids is not None:
+        index = load_pcap_index(filename)
+        if index is not None and can_ids is not None:
+            record_offsets = index.get_record_offsets(start_time, end_time,
+                                                      can_ids)
+        if index is not None and record_offsets is None:
+            byte_range = index.get_byte_range(start_time, end_time)
+    frame, record_time = map_udp_payloads(filename, CANOU_FRAME_DTYPE,
+                                          dst_port, start_time, end_time,
+                                          byte_range, record_offsets)
+    if can_ids is not None:
+        keep = np.isin(frame['identifier'], list(can_ids))
+        frame, record_time = frame[keep], record_time[keep]
+    return frame, record_time
+
+
+def read_attack_labels(filename="udp_packet.pcap", **selection):
+    # ground truth of the frames of a CANoU capture: arrays of timestamp
+    # [s], CAN ID and attack label, see map_canou_frames() for the selection
+    frame, _ = map_canou_frames(filename, **selection)
+    timestamp = ((frame['timestamp_upper'].astype(np.int64) << 32)
+                 + frame['timestamp_lower']) * 1e-3
+    return (timestamp, frame['identifier'].astype(np.int64),
+            frame['type'].copy())
+
+
+def _iter_udp_packet_chunks(car, filename, chunk_size, **selection):
+    # (timestamp, ID, value) arrays of decoded events in chunks of packets
+    frame, _ = map_canou_frames(filename, **selection)
+    for i in range(0, len(frame), chunk_size):
+        yield decode_canou_frame(car, frame[i:i+chunk_size])
+
+
+def iter_car_event_from_udp_packet(car: Vehicle,
+                                   filename="udp_packet.pcap",
+                                   chunk_size=4096, start_time=None,
+                                   end_time=None, can_ids=None):
     # UDP packet format is defined in:
     # National Instrument. Compact RIO Reference and Procedures
     # (FPGA Interface).
@@ -124,31 +289,28 @@ def read_car_event_from_udp_packet(car: Vehicle) -> CarEvent:
     # | Data[0] | Data[1] | Data[2] | Data[3]    |
     # | Data[4] | Data[5] | Data[6] | Data[7]    |
 
-    event_out = []
-    pkt_list = rdpcap("udp_packet.pcap")
-
-    for pkt in pkt_list:
-        udp_pkt = pkt[UDP]
-
-        udp_time_upper32, udp_time_lower32, udp_identifier, \
-            udp_type, udp_infoA, udp_infoB, udp_datalen, \
-            byte0, byte1, byte2, byte3, byte4, byte5, byte6, byte7 \
-            = struct.unpack('<3I4B8B', udp_pkt.payload.original)
-
-        event_id = car.dbc_data.get_event_id_by_can_id(udp_identifier)
-        if event_id == CarEvent.CAR_EVENT_UNKNOWN:
-            # ignore unknown event
-            continue
-
-        event_time = ((udp_time_upper32 << 32) + udp_time_lower32) * 1e-3
-        hex_str = '{0:02x}{1:02x}{2:02x}{3:02x}{4:02x}{5:02x}{6:02x}{7:02x}' \
-            .format(byte0, byte1, byte2, byte3, byte4, byte5, byte6, byte7)
-        event_value = car.dbc_data.simple_msg_decode(event_id, hex_str)
+    # the capture is memory-mapped and decoded in chunks, events are
+    # yielded as (timestamp, ID, value, label) rows. Events could be
+    # selected by time range and CAN IDs, see map_canou_frames().
+    no_desc = get_label_code("")
+    for timestamp, event_id, value in \
+            _iter_udp_packet_chunks(car, filename, chunk_size,
+                                    start_time=start_time,
+                                    end_time=end_time, can_ids=can_ids):
+        yield from zip(timestamp.tolist(), event_id.tolist(),
+                       value.tolist(), repeat(no_desc))
 
-        event_out.append(CarEvent(desc="", timestamp=event_time,
-                                  ID=event_id, value=event_value))
 
-    return event_out
+def read_car_event_from_udp_packet(car: Vehicle,
+                                   filename="udp_packet.pcap",
+                                   start_time=None, end_time=None,
+                                   can_ids=None) -> EventTable:
+    # events could be selected by time range and CAN IDs, see
+    # map_canou_frames()
+    timestamp, event_id, value = decode_canou_frame(
+        car, map_canou_frames(filename, None, start_time, end_time,
+                              can_ids)[0])
+    return EventTable.from_columns(timestamp, event_id, value, "")
 
 
 if __name__ == '__main__':
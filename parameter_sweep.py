@@ -0,0 +1,223 @@
+import os
+import csv
+import copy
+import json
+import hashlib
+import itertools
+import multiprocessing
+
+from vehicle_model import Vehicle, set_simulation_parameters
+from can_bus_security_simulation import schedule_car_events
+from can_bus_security_simulation import get_scenario_seeds, get_status_changes
+from glob_def import BUS_LOAD, ATTACK_TYPE_DDOS
+from glob_def import SIMULATION_START_TIME, SIMULATION_DURATION
+from glob_def import SIMULATION_RANDOM_SEED, AttackModel
+from feature_dataset import export_features, write_manifest
+from feature_dataset import iter_labelled_simulation_frames
+import numpy as np
+
+# Parameters of a sweep point and their defaults. Attack parameters
+# override those of the attack model swept, the others the globals of
+# the simulation. The rate of DoS frames is set by the strength, as they
+# are injected by the attack model of the car.
+SWEEP_PARAMETERS = {
+    "strength": None,
+    "speed_low": None,
+    "speed_high": None,
+    "bus_load": BUS_LOAD,
+    "invalid_msg_threshold": Vehicle.invalid_msg_threshold,
+    "duration": SIMULATION_DURATION,
+}
+
+
+def _python_value(value):
+    # numpy scalars to python, to keep points json serializable
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def get_grid_points(grid):
+    # all combinations of parameter values, grid maps every parameter to
+    # a list of values
+    names = list(grid)
+    return [dict(zip(names, map(_python_value, values)))
+            for values in itertools.product(*(grid[i] for i in names))]
+
+
+def get_random_points(spec, point_num, random_seed=SIMULATION_RANDOM_SEED):
+    # point_num points sampled at random, spec maps every parameter to a
+    # (low, high) range sampled uniformly or to a list of values to choose
+    rng = np.random.default_rng(random_seed)
+    columns = {}
+    for name, values in spec.items():
+        if isinstance(values, tuple):
+            columns[name] = rng.uniform(values[0], values[1], point_num)
+        else:
+            columns[name] = [values[i] for i in
+                             rng.integers(0, len(values), point_num)]
+    return [{name: _python_value(columns[name][i]) for name in spec}
+            for i in range(point_num)]
+
+
+def _get_run_key(attack_model, point, random_seed):
+    # the cache key of a run identifies everything the run depends on
+    point = dict(SWEEP_PARAMETERS, **point)
+    text = json.dumps({"attack": vars(attack_model), "point": point,
+                       "seed": random_seed}, sort_keys=True)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def run_sweep_point(task):
+    # simulate one run of a sweep point in a worker process, and save the
+    # result into the cache directory, and the features of its traffic as
+    # a shard of the run into the feature directory
+    key, attack_model, point, random_seed, cache_dir, feature_dir = task
+    param = dict(SWEEP_PARAMETERS, **point)
+
+    set_simulation_parameters(
+        bus_load=param["bus_load"],
+        invalid_msg_threshold=param["invalid_msg_threshold"])
+    attack_model = copy.copy(attack_model)
+    if param["strength"] is not None:
+        attack_model.strength = param["strength"]
+    for name in ("speed_low", "speed_high"):
+        if param[name] is not None:
+            attack_model.is_speed_check = True
+            setattr(attack_model, name, param[name])
+
+    car = Vehicle("Toyota_prius", speed=0.0, random_seed=random_seed)
+    car.register_attack_model(attack_model)
+    sim_start = SIMULATION_START_TIME
+    sim_time = param["duration"]
+    scheduler = schedule_car_events(car, attack_model, sim_start, sim_time)
+    event_list = car.drive_stream(scheduler, sim_start, sim_start+sim_time)
+    if feature_dir:
+        shards = export_features(
+            car, iter_labelled_simulation_frames(car, event_list),
+            feature_dir, key, meta={"point": point, "seed": random_seed})
+    else:
+        for _ in event_list:
+            pass
+
+    # time to the first change into a status, nan if never
+    first_time = {}
+    for timestamp, status in get_status_changes(car):
+        first_time.setdefault(status, timestamp - sim_start)
+    result = {"seed": random_seed,
+              "attack_event_num": car.attack_event_num,
+              "time_to_dos_detected": first_time.get("DOS_DETECTED", np.nan),
+              "time_to_engine_shutdown":
+                  first_time.get("ENGINE_SHUTDOWN", np.nan)}
+    if feature_dir:
+        result["feature_shards"] = shards
+
+    if cache_dir:
+        filename = os.path.join(cache_dir, key + ".json")
+        with open(filename + ".tmp", "w") as f:
+            json.dump(result, f)
+        os.replace(filename + ".tmp", filename)
+    return key, result
+
+
+def _has_features(result, feature_dir):
+    # whether the shards of the features of a cached run are closed in
+    # feature_dir, runs cached without exporting them have none listed
+    shards = result.get("feature_shards")
+    return shards is not None and all(
+        os.path.exists(os.path.join(feature_dir, i + ".json"))
+        for i in shards)
+
+
+def _run_tasks(tasks, process_num):
+    if process_num == 1:
+        yield from map(run_sweep_point, tasks)
+        # restore the simulation parameters of this process
+        set_simulation_parameters()
+    elif tasks:
+        with multiprocessing.Pool(process_num) as pool:
+            yield from pool.imap_unordered(run_sweep_point, tasks)
+
+
+def _mean(values):
+    values = [i for i in values if not np.isnan(i)]
+    return float(np.mean(values)) if values else np.nan
+
+
+def run_parameter_sweep(points, seed_num=10, attack_model=None,
+                        process_num=None, cache_dir="sweep_cache",
+                        base_seed=SIMULATION_RANDOM_SEED, feature_dir=None):
+    # Simulate every parameter point with seed_num seeds in a pool of
+    # worker processes, and return a table (list of dicts) with one row of
+    # aggregated results per point. Results of runs are cached in
+    # cache_dir, so an interrupted sweep resumes with the runs missing.
+    # The same seeds are used for every point. With a feature_dir, every
+    # run also exports its features as shards named by its key (see
+    # feature_dataset.py), listed in the manifest after the sweep; cached
+    # runs without their shards in feature_dir are simulated again.
+    if attack_model is None:
+        attack_model = AttackModel()
+        attack_model.type = ATTACK_TYPE_DDOS
+        attack_model.strength = "medium"
+        # speed > 60 kmph, as the DDoS attack of attack_conf.txt
+        attack_model.is_speed_check = True
+        attack_model.speed_low = 60
+    for point in points:
+        unknown = set(point) - set(SWEEP_PARAMETERS)
+        if unknown:
+            raise ValueError(f"unknown sweep parameters {sorted(unknown)}")
+    seeds = get_scenario_seeds(seed_num, base_seed)
+
+    results = {}
+    tasks = []
+    for point in points:
+        for random_seed in seeds:
+            key = _get_run_key(attack_model, point, random_seed)
+            filename = os.path.join(cache_dir or "", key + ".json")
+            if key in results:
+                continue
+            result = None
+            if cache_dir and os.path.exists(filename):
+                with open(filename) as f:
+                    result = json.load(f)
+                if feature_dir and not _has_features(result, feature_dir):
+                    result = None
+            if result is not None:
+                results[key] = result
+            else:
+                results[key] = None
+                tasks.append((key, attack_model, point, random_seed,
+                              cache_dir, feature_dir))
+
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+    for key, result in _run_tasks(tasks, process_num):
+        results[key] = result
+    if feature_dir:
+        write_manifest(feature_dir)
+
+    table = []
+    for point in points:
+        runs = [results[_get_run_key(attack_model, point, i)] for i in seeds]
+        dos_time = [i["time_to_dos_detected"] for i in runs]
+        shutdown_time = [i["time_to_engine_shutdown"] for i in runs]
+        attack_event_num = [i["attack_event_num"] for i in runs]
+        row = dict(point)
+        row.update({
+            "run_num": len(runs),
+            "dos_detected_ratio": float(np.mean(~np.isnan(dos_time))),
+            "time_to_dos_detected": _mean(dos_time),
+            "engine_shutdown_ratio":
+                float(np.mean(~np.isnan(shutdown_time))),
+            "time_to_engine_shutdown": _mean(shutdown_time),
+            "attack_event_num": float(np.mean(attack_event_num))})
+        table.append(row)
+    return table
+
+
+def write_sweep_table(table, filename="sweep_result.csv"):
+    names = []
+    for row in table:
+        names += [i for i in row if i not in names]
+    with open(filename, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=names)
+        writer.writeheader()
+        writer.writerows(table)
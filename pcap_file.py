@@ -0,0 +1,690 @@
+import os
+import gzip
+import logging
+import lzma
+import queue
+import shutil
+import socket
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# link types of the captures (http://www.tcpdump.org/linktypes.html)
+LINKTYPE_CAN_SOCKETCAN = 227
+LINKTYPE_IPV4 = 228
+
+PCAP_MAGIC = 0xa1b2c3d4
+PCAP_SNAPLEN = 65535
+
+PCAP_RECORD_HEADER_DTYPE = np.dtype([('ts_sec', '<u4'),
+                                     ('ts_usec', '<u4'),
+                                     ('caplen', '<u4'),
+                                     ('wirelen', '<u4')])
+
+
+def _get_record_time(timestamp):
+    # seconds and microseconds of record timestamps, rounded as by scapy
+    timestamp = np.asarray(timestamp, dtype=np.float64)
+    sec = np.trunc(timestamp)
+    usec = np.round((timestamp - sec) * 1e6)
+    return sec.astype(np.uint32), usec.astype(np.uint32)
+
+
+# the .npy header of files written while their length isn't known is of
+# a fixed size, so that it can be rewritten with their shape in the end
+NPY_HEADER_SIZE = 128
+
+
+def write_npy_header(f, dtype, shape):
+    # a version 1.0 .npy header of NPY_HEADER_SIZE bytes at the start of f
+    header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (
+        np.lib.format.dtype_to_descr(np.dtype(dtype)), tuple(shape))
+    header = header.ljust(NPY_HEADER_SIZE - 11) + "\n"
+    f.seek(0)
+    f.write(b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header))
+            + header.encode("latin1"))
+
+
+def get_index_filename(filename):
+    # sidecar index of a pcap file, its posting lists are kept in a .npy
+    # file of their own to be memory-mapped
+    return filename + ".idx"
+
+
+def _get_posting_filename(index_filename):
+    return index_filename + ".npy"
+
+
+class PcapIndex:
+    # Sparse index of a pcap file with records in time order: a checkpoint
+    # of the timestamp and byte offset of the first record of every block
+    # of block_size records, with the record size of the block if all its
+    # records are of the same size (otherwise 0), and, if records are added
+    # with keys (e.g. CAN IDs), posting lists of the numbers of the records
+    # of every key. Postings are flushed into the posting file every
+    # flush_size records, sorted by key, so only the checkpoints and a run
+    # of every key per flush are kept in memory; the posting list of a key
+    # is the concatenation of its runs.
+
+    def __init__(self, block_size=1024, flush_size=1 << 20):
+        self.block_size = block_size
+        self.flush_size = flush_size
+        self.record_num = 0
+        self.end_offset = 24
+        self.checkpoint_time = []
+        self.checkpoint_offset = []
+        self.block_record_size = []
+        self.keyed = False
+        # key and start in the posting file of every run
+        self.posting_key = []
+        self.posting_start = [0]
+        self.posting_record = None
+        self.__posting_file = None
+        self.__buffer = []
+        self.__buffer_num = 0
+
+    def open(self, filename):
+        # write the postings into the posting file of the index filename
+        # while records are added
+        self.__posting_file = open(_get_posting_filename(filename), 'wb')
+        write_npy_header(self.__posting_file, np.int64, (0,))
+
+    def add(self, timestamp, offset, record_size, key=None):
+        # add records of record_size by their timestamps, byte offsets and
+        # keys (arrays)
+        position = self.record_num + np.arange(len(timestamp))
+        first = position % self.block_size == 0
+        self.checkpoint_time += np.asarray(timestamp)[first].tolist()
+        self.checkpoint_offset += np.asarray(offset)[first].tolist()
+        if len(timestamp) and not first[0] \
+                and self.block_record_size[-1] != record_size:
+            self.block_record_size[-1] = 0
+        self.block_record_size += [record_size] * int(np.sum(first))
+        if key is not None:
+            self.keyed = True
+            self.__buffer.append((np.asarray(key, dtype=np.int64),
+                                  position))
+            self.__buffer_num += len(position)
+            if self.__buffer_num >= self.flush_size:
+                self.__flush_postings()
+        self.record_num += len(timestamp)
+
+    def __flush_postings(self):
+        if not self.__buffer:
+            return
+        key = np.concatenate([i[0] for i in self.__buffer])
+        position = np.concatenate([i[1] for i in self.__buffer])
+        self.__buffer, self.__buffer_num = [], 0
+        order = np.argsort(key, kind='stable')
+        keys, start = np.unique(key[order], return_index=True)
+        self.__posting_file.write(
+            position[order].astype(np.int64).tobytes())
+        end = np.append(start[1:], len(key)) + self.posting_start[-1]
+        self.posting_key += keys.tolist()
+        self.posting_start += end.tolist()
+
+    def save(self, filename):
+        if self.__posting_file is None:
+            self.open(filename)
+        self.__flush_postings()
+        write_npy_header(self.__posting_file, np.int64,
+                         (self.posting_start[-1],))
+        self.__posting_file.close()
+        self.__posting_file = None
+        with open(filename, 'wb') as f:
+            np.savez(f, block_size=self.block_size,
+                     record_num=self.record_num, end_offset=self.end_offset,
+                     checkpoint_time=np.array(self.checkpoint_time),
+                     checkpoint_offset=np.array(self.checkpoint_offset,
+                                                dtype=np.int64),
+                     block_record_size=np.array(self.block_record_size,
+                                                dtype=np.int64),
+                     keyed=self.keyed,
+                     posting_key=np.array(self.posting_key, dtype=np.int64),
+                     posting_start=np.array(self.posting_start,
+                                            dtype=np.int64))
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            index = cls(int(data['block_size']))
+            index.record_num = int(data['record_num'])
+            index.end_offset = int(data['end_offset'])
+            index.checkpoint_time = data['checkpoint_time']
+            index.checkpoint_offset = data['checkpoint_offset']
+            index.block_record_size = data['block_record_size']
+            index.keyed = bool(data['keyed'])
+            index.posting_key = data['posting_key']
+            index.posting_start = data['posting_start']
+        index.posting_record = np.load(_get_posting_filename(filename),
+                                       mmap_mode='r')
+        return index
+
+    def get_postings(self, keys):
+        # numbers of the records of any of keys of a loaded index, sorted
+        run = np.flatnonzero(np.isin(self.posting_key, list(keys)))
+        return np.sort(np.concatenate(
+            [self.posting_record[self.posting_start[i]:
+                                 self.posting_start[i+1]]
+             for i in run.tolist()] + [np.empty(0, dtype=np.int64)]))
+
+    def __get_blocks(self, start_time, end_time):
+        # first and last (exclusive) block which could hold records in
+        # [start_time, end_time)
+        first, last = 0, len(self.checkpoint_time)
+        if start_time is not None:
+            first = max(int(np.searchsorted(self.checkpoint_time,
+                                            start_time)) - 1, 0)
+        if end_time is not None:
+            last = int(np.searchsorted(self.checkpoint_time, end_time))
+        return first, last
+
+    def get_byte_range(self, start_time=None, end_time=None):
+        # (begin, end) byte offsets of the records which could be in
+        # [start_time, end_time)
+        first, last = self.__get_blocks(start_time, end_time)
+        offset = np.append(self.checkpoint_offset, self.end_offset)
+        return int(offset[first]), int(offset[max(first, last)])
+
+    def get_record_offsets(self, start_time=None, end_time=None, keys=()):
+        # byte offsets of the records of any of keys which could be in
+        # [start_time, end_time), None if the records aren't indexed by key
+        # or some are in blocks of records of various sizes
+        if not self.keyed:
+            return None
+        first, last = self.__get_blocks(start_time, end_time)
+        position = self.get_postings(keys)
+        position = position[(position >= first * self.block_size)
+                            & (position < last * self.block_size)]
+        block = position // self.block_size
+        record_size = np.asarray(self.block_record_size)[block]
+        if not np.all(record_size):
+            return None
+        return np.asarray(self.checkpoint_offset)[block] \
+            + (position - block * self.block_size) * record_size
+
+
+def load_pcap_index(filename):
+    # the sidecar index of a pcap file, None if it has none or the index is
+    # of another version of the file
+    try:
+        index = PcapIndex.load(get_index_filename(filename))
+    except OSError:
+        return None
+    except KeyError:
+        logging.warning(f"Index of {filename} of an older layout is ignored")
+        return None
+    if index.end_offset != os.path.getsize(filename):
+        logging.warning(f"Outdated index of {filename} is ignored")
+        return None
+    return index
+
+
+class PcapFileWriter:
+    # Writer of classic (little endian, microsecond) pcap files, with the
+    # records of whole arrays of packets packed at once. With
+    # index_block_size set, a sidecar index (PcapIndex) of the records is
+    # written as well, with their keys unless index_keys is off.
+
+    def __init__(self, filename, linktype, snaplen=PCAP_SNAPLEN,
+                 buffer_size=1 << 20, index_block_size=None,
+                 index_keys=True):
+        self.filename = filename
+        self.linktype = linktype
+        self.offset = 24
+        self.index = PcapIndex(index_block_size) \
+            if index_block_size else None
+        self.index_keys = index_keys
+        if self.index is not None:
+            self.index.open(get_index_filename(filename))
+        self.f = open(filename, 'wb', buffer_size)
+        self.f.write(struct.pack('<IHHiIII', PCAP_MAGIC, 2, 4, 0, 0,
+                                 snaplen, linktype))
+
+    def write(self, timestamp, packet, key=None):
+        # write one packet (bytes) captured at timestamp [s]
+        sec, usec = _get_record_time(timestamp)
+        if self.index is not None:
+            self.index.add([timestamp], [self.offset], 16 + len(packet),
+                           None if key is None or not self.index_keys
+                           else [key])
+        self.f.write(struct.pack('<IIII', sec, usec, len(packet),
+                                 len(packet)))
+        self.f.write(packet)
+        self.offset += 16 + len(packet)
+
+    def write_array(self, timestamp, packets, key=None):
+        # write N packets of the same length, given as an (N, L) uint8
+        # array, with an array of their timestamps [s] and of their keys
+        # for the index
+        packets = np.ascontiguousarray(packets, dtype=np.uint8)
+        record = np.empty(len(packets), dtype=np.dtype(
+            PCAP_RECORD_HEADER_DTYPE.descr + [('data', 'u1',
+                                               packets.shape[1:])]))
+        record['ts_sec'], record['ts_usec'] = _get_record_time(timestamp)
+        record['caplen'] = record['wirelen'] = packets.shape[1]
+        record['data'] = packets
+        if self.index is not None:
+            self.index.add(timestamp, self.offset + record.itemsize
+                           * np.arange(len(record), dtype=np.int64),
+                           record.itemsize,
+                           key if self.index_keys else None)
+        self.f.write(record.tobytes())
+        self.offset += record.nbytes
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+        if self.index is not None:
+            self.index.end_offset = self.offset
+            self.index.save(get_index_filename(self.filename))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# extension and open function of the compressions of closed segments
+_SEGMENT_COMPRESSION = {
+    "gzip": (".gz", lambda f, mode: gzip.open(f, mode, compresslevel=6)),
+    "xz": (".xz", lzma.open)}
+
+
+def _compress_file(filename, compression):
+    # compress a file next to it, and remove the original
+    extension, open_compressed = _SEGMENT_COMPRESSION[compression]
+    with open(filename, 'rb') as f_in, \
+            open_compressed(filename + extension, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out, 1 << 20)
+    os.remove(filename)
+    return filename + extension
+
+
+class PcapSegmentWriter:
+    # Writer of a capture rotated into segment files of up to segment_size
+    # bytes and/or segment_duration seconds of records, named after
+    # filename with the segment index, e.g. udp_packet_0001.pcap. Closed
+    # segments are compressed (compression "gzip" or "xz") by a thread of
+    # their own, or indexed (see PcapFileWriter). Records are expected in
+    # time order.
+
+    def __init__(self, filename, linktype, segment_size=None,
+                 segment_duration=None, compression=None,
+                 buffer_size=1 << 20, index_block_size=None,
+                 index_keys=True):
+        assert(compression is None or compression in _SEGMENT_COMPRESSION)
+        assert(compression is None or index_block_size is None)
+        self.root, self.extension = os.path.splitext(filename)
+        self.linktype = linktype
+        self.segment_size = segment_size
+        self.segment_duration = segment_duration
+        self.compression = compression
+        self.buffer_size = buffer_size
+        self.index_block_size = index_block_size
+        self.index_keys = index_keys
+        self.filenames = []
+        self.__writer = None
+        self.__size = 0
+        self.__record_num = 0
+        self.__start_time = None
+        self.__end_time = np.inf
+        self.__compressions = []
+        self.__executor = ThreadPoolExecutor(1) if compression else None
+
+    def __open_segment(self, timestamp):
+        filename = f"{self.root}_{len(self.filenames):04d}{self.extension}"
+        self.__writer = PcapFileWriter(filename, self.linktype,
+                                       buffer_size=self.buffer_size,
+                                       index_block_size=self.index_block_size,
+                                       index_keys=self.index_keys)
+        self.filenames.append(filename)
+        self.__size = 24
+        self.__record_num = 0
+        if self.segment_duration is not None:
+            # segments cover aligned intervals from the first record on
+            if self.__start_time is None:
+                self.__start_time = timestamp
+            index = (timestamp - self.__start_time) // self.segment_duration
+            self.__end_time = \
+                self.__start_time + (index+1) * self.segment_duration
+
+    def __close_segment(self):
+        self.__writer.close()
+        self.__writer = None
+        if self.compression:
+            self.__compressions.append((len(self.filenames) - 1,
+                                        self.__executor.submit(
+                                            _compress_file,
+                                            self.filenames[-1],
+                                            self.compression)))
+
+    def write(self, timestamp, packet, key=None):
+        self.write_array(np.array([timestamp]),
+                         np.frombuffer(packet, dtype=np.uint8)[None],
+                         None if key is None else np.array([key]))
+
+    def write_array(self, timestamp, packets, key=None):
+        timestamp = np.asarray(timestamp, dtype=np.float64)
+        record_size = 16 + packets.shape[1]
+        i = 0
+        while i < len(timestamp):
+            if self.__writer is None:
+                self.__open_segment(timestamp[i])
+            end = i + int(np.searchsorted(timestamp[i:], self.__end_time))
+            if self.segment_size is not None:
+                end = min(end, i + max(self.segment_size - self.__size, 0)
+                          // record_size)
+            if end == i:
+                if self.__record_num:
+                    self.__close_segment()
+                    continue
+                # a record larger than a segment gets a segment of its own
+                end = i + 1
+            self.__writer.write_array(timestamp[i:end], packets[i:end],
+                                      None if key is None else key[i:end])
+            self.__size += (end-i) * record_size
+            self.__record_num += end - i
+            i = end
+
+    def flush(self):
+        if self.__writer is not None:
+            self.__writer.flush()
+
+    def close(self):
+        # close the last segment and wait for the compression of segments
+        if self.__writer is not None:
+            self.__close_segment()
+        if self.__executor is not None:
+            for index, compression in self.__compressions:
+                self.filenames[index] = compression.result()
+            self.__compressions = []
+            self.__executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class BackgroundCaptureWriter:
+    # Double buffered writer of a capture in a background thread. Arrays of
+    # records are collected into a buffer of about buffer_size bytes, a
+    # filled buffer is handed to the thread, which writes it to writer (a
+    # PcapFileWriter or PcapSegmentWriter) while the next one fills. The
+    # caller waits only if it gets a whole buffer ahead of the disk. Arrays
+    # handed to write_array() must not be modified afterwards.
+
+    def __init__(self, writer, buffer_size=1 << 22):
+        self.writer = writer
+        self.buffer_size = buffer_size
+        self.__buffer = []
+        self.__buffer_bytes = 0
+        self.__error = None
+        self.__queue = queue.Queue(maxsize=1)
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def __run(self):
+        while True:
+            buffer = self.__queue.get()
+            if buffer is None:
+                return
+            if self.__error is not None:
+                continue
+            try:
+                for timestamp, packets, key in buffer:
+                    self.writer.write_array(timestamp, packets, key)
+            except Exception as error:
+                # raised in the caller thread by its next call
+                self.__error = error
+
+    def __check_error(self):
+        if self.__error is not None:
+            raise self.__error
+
+    def write(self, timestamp, packet, key=None):
+        self.write_array(np.array([timestamp]),
+                         np.frombuffer(packet, dtype=np.uint8)[None],
+                         None if key is None else np.array([key]))
+
+    def write_array(self, timestamp, packets, key=None):
+        self.__check_error()
+        self.__buffer.append((timestamp, packets, key))
+        self.__buffer_bytes += packets.nbytes + 16 * len(packets)
+        if self.__buffer_bytes >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        # hand the buffer to the writer thread
+        if self.__buffer:
+            self.__queue.put(self.__buffer)
+            self.__buffer = []
+            self.__buffer_bytes = 0
+
+    def close(self):
+        # write what is left, stop the thread and close the writer
+        self.flush()
+        self.__queue.put(None)
+        self.__thread.join()
+        self.writer.close()
+        self.__check_error()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _fold_checksum(total):
+    # one's complement sum of 16 bit words folded into 16 bits
+    while np.any(total >> 16):
+        total = (total & 0xffff) + (total >> 16)
+    return total
+
+
+def build_udp_packets(payload, src_ip, dst_ip, src_port, dst_port):
+    # Build IPv4/UDP packets of (N, L) uint8 payloads into an (N, 28+L)
+    # uint8 array. The headers are a template built once, only the UDP
+    # checksum is computed for every packet. Fields are set as by scapy:
+    # IP ID 1, TTL 64, no fragmentation.
+    payload = np.ascontiguousarray(payload, dtype=np.uint8)
+    packet_num, payload_len = len(payload), payload.shape[1]
+    udp_len = 8 + payload_len
+    src, dst = socket.inet_aton(src_ip), socket.inet_aton(dst_ip)
+
+    ip_header = bytearray(struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + udp_len,
+                                      1, 0, 64, socket.IPPROTO_UDP, 0,
+                                      src, dst))
+    ip_checksum = _fold_checksum(
+        np.frombuffer(bytes(ip_header), dtype='>u2').sum(dtype=np.uint64))
+    ip_header[10:12] = struct.pack('!H', ~int(ip_checksum) & 0xffff)
+    udp_header = bytearray(struct.pack('!HHHH', src_port, dst_port,
+                                       udp_len, 0))
+
+    # UDP checksum over the pseudo header, UDP header and payload
+    pseudo_header = src + dst + struct.pack('!BBH', 0, socket.IPPROTO_UDP,
+                                            udp_len)
+    header_sum = np.frombuffer(pseudo_header + bytes(udp_header),
+                               dtype='>u2').sum(dtype=np.uint64)
+    words = payload if payload_len % 2 == 0 else \
+        np.pad(payload, ((0, 0), (0, 1)))
+    total = words.view('>u2').sum(axis=1, dtype=np.uint64) + header_sum
+    checksum = ~_fold_checksum(total) & 0xffff
+    checksum[checksum == 0] = 0xffff
+
+    packets = np.empty((packet_num, 20 + udp_len), dtype=np.uint8)
+    packets[:, :20] = np.frombuffer(bytes(ip_header), dtype=np.uint8)
+    packets[:, 20:28] = np.frombuffer(bytes(udp_header), dtype=np.uint8)
+    packets[:, 26:28] = checksum.astype('>u2').view(np.uint8).reshape(-1, 2)
+    packets[:, 28:] = payload
+    return packets
+
+
+def build_socketcan_frames(identifier, length, data):
+    # Build SocketCAN frames (as by scapy's CAN layer) of N frames into an
+    # (N, 16) uint8 array: identifier (big endian, flags in the top 3
+    # bits), length, 3 reserved bytes and 8 bytes of data
+    identifier = np.asarray(identifier, dtype=np.uint32)
+    frames = np.zeros((len(identifier), 16), dtype=np.uint8)
+    frames[:, 0:4] = identifier.astype('>u4').view(np.uint8).reshape(-1, 4)
+    frames[:, 4] = length
+    frames[:, 8:16] = data
+    return frames
+
+
+# offset of the IPv4 header in the packets of a link type
+_IPV4_OFFSET = {LINKTYPE_IPV4: 0, 101: 0, 1: 14}
+
+_UDP_HEADER_DTYPE = np.dtype([('sport', '>u2'), ('dport', '>u2'),
+                              ('len', '>u2'), ('chksum', '>u2')])
+
+
+class PcapFileReader:
+    # Memory-mapped classic pcap file. Records are walked through their
+    # headers, and uniform records are viewed as a numpy structured array
+    # without copying them.
+
+    def __init__(self, filename):
+        self.data = np.memmap(filename, dtype=np.uint8, mode='r')
+        magic = bytes(self.data[:4])
+        if magic in (b'\xd4\xc3\xb2\xa1', b'\x4d\x3c\xb2\xa1'):
+            self.endian = '<'
+        elif magic in (b'\xa1\xb2\xc3\xd4', b'\xa1\xb2\x3c\x4d'):
+            self.endian = '>'
+        else:
+            raise ValueError(f"{filename} is not a pcap file")
+        # timestamps of nanosecond resolution
+        self.nano = magic in (b'\x4d\x3c\xb2\xa1', b'\xa1\xb2\x3c\x4d')
+        self.linktype = struct.unpack_from(self.endian + 'I', self.data, 20)[0]
+        self.header_dtype = PCAP_RECORD_HEADER_DTYPE.newbyteorder(self.endian)
+
+    def get_record_time(self, header):
+        # timestamps [s] of records by their headers
+        return header['ts_sec'] \
+            + header['ts_usec'] * (1e-9 if self.nano else 1e-6)
+
+    def get_uniform_records(self, record_dtype, begin=24, end=None):
+        # view the records from byte offset begin to end as an array of
+        # record_dtype, which starts with the record header, if every record
+        # there is of that size. Otherwise return None.
+        size = (len(self.data) if end is None else end) - begin
+        if size % record_dtype.itemsize:
+            return None
+        records = np.ndarray(size // record_dtype.itemsize, record_dtype,
+                             self.data, begin)
+        caplen = record_dtype.itemsize - self.header_dtype.itemsize
+        if not np.all(records['header']['caplen'] == caplen):
+            return None
+        return records
+
+    def iter_record_runs(self, begin=24, end=None, max_probe=1 << 16):
+        # walk the records from byte offset begin to end in runs of records
+        # of the same caplen, yield (offset, size, count) of every run.
+        # Record headers are read in strided views of growing length as
+        # long as records keep their size, so the cost is per run rather
+        # than per record. A record cut off at end is left out.
+        end = len(self.data) if end is None else end
+        caplen_dtype = np.dtype(self.endian + 'u4')
+        unpack = struct.Struct(self.endian + '8xI').unpack_from
+        offset = begin
+        while offset + 16 <= end:
+            caplen, = unpack(self.data, offset)
+            size = 16 + caplen
+            start, probe, changed = offset, 1, False
+            while not changed:
+                n = min(probe, (end - offset) // size)
+                if n == 0:
+                    break
+                caplens = np.ndarray(n, caplen_dtype, self.data, offset + 8,
+                                     strides=(size,))
+                mismatch = caplens != caplen
+                k = int(mismatch.argmax())
+                changed = bool(mismatch[k])
+                offset += (k if changed else n) * size
+                probe = min(probe * 2, max_probe)
+            if offset == start:
+                return
+            yield start, size, (offset - start) // size
+
+    def get_records_at(self, record_dtype, offsets):
+        # records of record_dtype at byte offsets, copied out of a view of
+        # the file with a record starting at every byte
+        view = np.ndarray(max(len(self.data) - record_dtype.itemsize + 1, 0),
+                          record_dtype, self.data, 0, strides=(1,))
+        return view[np.asarray(offsets, dtype=np.int64)]
+
+
+def _map_udp_records(reader, record_dtype, begin=24, end=None):
+    # records from byte offset begin to end, a view of the file if all are
+    # of record_dtype size, otherwise the runs of records of that size
+    # copied together
+    records = reader.get_uniform_records(record_dtype, begin, end)
+    if records is None:
+        runs = [(offset, n) for offset, size, n in
+                reader.iter_record_runs(begin, end)
+                if size == record_dtype.itemsize]
+        if len(runs) == 1:
+            return np.ndarray(runs[0][1], record_dtype, reader.data,
+                              runs[0][0])
+        # copied as bytes, which is a plain memory copy
+        size = record_dtype.itemsize
+        records = np.empty(sum(n for _, n in runs), record_dtype)
+        raw = records.view(np.uint8)
+        i = 0
+        for offset, n in runs:
+            raw[i:i+n*size] = reader.data[offset:offset+n*size]
+            i += n*size
+    return records
+
+
+def map_udp_payloads(filename, payload_dtype, dst_port=None,
+                     start_time=None, end_time=None, byte_range=None,
+                     record_offsets=None):
+    # Map the UDP payloads of payload_dtype size in an IPv4 capture as an
+    # array of payload_dtype, and return it with the record timestamps.
+    # Packets of other size or protocol (or to other than dst_port) are
+    # skipped, and so are records out of [start_time, end_time). In a
+    # capture of only such packets the array is a view of the
+    # memory-mapped file, otherwise the payloads are gathered. Only the
+    # records in byte_range (begin, end) or at record_offsets are read if
+    # given (see PcapIndex).
+    reader = PcapFileReader(filename)
+    payload_dtype = np.dtype(payload_dtype)
+    ip_offset = _IPV4_OFFSET.get(reader.linktype)
+    if ip_offset is None:
+        raise ValueError(f"{filename}: unsupported link type "
+                         f"{reader.linktype}")
+
+    record_dtype = np.dtype([('header', reader.header_dtype),
+                             ('link', 'u1', (ip_offset,)),
+                             ('ip', 'u1', (20,)),
+                             ('udp', _UDP_HEADER_DTYPE),
+                             ('payload', payload_dtype)])
+    if record_offsets is not None:
+        records = reader.get_records_at(record_dtype, record_offsets)
+        caplen = record_dtype.itemsize - reader.header_dtype.itemsize
+        records = records[records['header']['caplen'] == caplen]
+    elif byte_range is not None:
+        records = _map_udp_records(reader, record_dtype, *byte_range)
+    else:
+        records = _map_udp_records(reader, record_dtype)
+    record_time = reader.get_record_time(records['header'])
+
+    # IPv4 packets without options carrying UDP
+    keep = (records['ip'][:, 0] == 0x45) & (records['ip'][:, 9] == 17)
+    if dst_port is not None:
+        keep &= records['udp']['dport'] == dst_port
+    if start_time is not None:
+        keep &= record_time >= start_time
+    if end_time is not None:
+        keep &= record_time < end_time
+    if not np.all(keep):
+        records, record_time = records[keep], record_time[keep]
+    return records['payload'], record_time
@@ -0,0 +1,123 @@
+import sys
+import socket
+import logging
+import argparse
+from time import perf_counter, sleep
+import numpy as np
+
+from packet_proc import CANOU_FRAME_DTYPE, map_canou_frames
+from canou_stream import CANOU_PORT
+
+# frames due within the same tick [s] are sent in one batch
+REPLAY_TICK = 1e-4
+# the last part [s] of a wait is spent polling the clock instead of
+# sleeping, as sleeps overshoot by up to about a millisecond
+REPLAY_SPIN_TIME = 2e-3
+
+REPLAY_ERROR_PERCENTILES = (50, 90, 99, 99.9)
+
+
+def _wait_until(target, spin_time):
+    # wait until perf_counter() (monotonic) reaches target
+    remain = target - perf_counter()
+    if remain > spin_time:
+        sleep(remain - spin_time)
+    while perf_counter() < target:
+        pass
+
+
+def replay_canou_frames(frames, timestamp, host="127.0.0.1",
+                        port=CANOU_PORT, speed=1.0, frames_per_datagram=1,
+                        tick=REPLAY_TICK, spin_time=REPLAY_SPIN_TIME):
+    # Replay CANoU frames (an array of CANOU_FRAME_DTYPE) to (host, port)
+    # as UDP datagrams of up to frames_per_datagram frames, at their
+    # timestamps [s] scaled by 1/speed, or as fast as possible with speed
+    # None. The schedule is kept on the monotonic clock, and frames due
+    # within the same tick are sent back to back. Return a dict of
+    # statistics, with percentiles of the timing error (send time behind
+    # schedule, in s) when paced.
+    frame_num = len(frames)
+    data = np.ascontiguousarray(frames, dtype=CANOU_FRAME_DTYPE).tobytes()
+    frame_size = CANOU_FRAME_DTYPE.itemsize
+    timestamp = np.asarray(timestamp, dtype=np.float64)
+    if speed and frame_num:
+        due = (timestamp - timestamp[0]) / speed
+        tick_index = np.floor(due / tick).astype(np.int64)
+        bounds = np.flatnonzero(np.diff(tick_index)) + 1
+    else:
+        due = np.zeros(frame_num)
+        bounds = np.empty(0, dtype=np.int64)
+    bounds = [0] + bounds.tolist() + [frame_num] if frame_num else [0]
+    due = due.tolist()
+    send_time = np.empty(frame_num)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.connect((host, port))
+    send = sock.send
+    datagram_num = dropped_num = 0
+    start = perf_counter()
+    try:
+        for i, end in zip(bounds[:-1], bounds[1:]):
+            _wait_until(start + due[i], spin_time)
+            for j in range(i, end, frames_per_datagram):
+                k = min(j + frames_per_datagram, end)
+                send_time[j:k] = perf_counter()
+                try:
+                    send(data[j*frame_size:k*frame_size])
+                    datagram_num += 1
+                except OSError:
+                    # e.g. no receiver, as reported by an ICMP port
+                    # unreachable of an earlier datagram
+                    dropped_num += 1
+    finally:
+        sock.close()
+    elapsed = perf_counter() - start
+
+    stats = {"frame_num": frame_num,
+             "datagram_num": datagram_num,
+             "dropped_datagram_num": dropped_num,
+             "elapsed_time": elapsed,
+             "frame_rate": frame_num / elapsed if elapsed else 0.0}
+    if speed and frame_num:
+        error = send_time - start - np.array(due)
+        stats["target_frame_rate"] = \
+            frame_num / due[-1] if due[-1] else np.inf
+        for q, value in zip(REPLAY_ERROR_PERCENTILES,
+                            np.percentile(error, REPLAY_ERROR_PERCENTILES)):
+            stats[f"timing_error_p{q:g}"] = float(value)
+        stats["timing_error_max"] = float(error.max())
+    return stats
+
+
+def replay_pcap(filename="udp_packet.pcap", host="127.0.0.1",
+                port=CANOU_PORT, speed=1.0, frames_per_datagram=1,
+                dst_port=None):
+    # replay the CANoU frames of a capture at the timestamps of their
+    # records, see replay_canou_frames()
+    frames, record_time = map_canou_frames(filename, dst_port)
+    return replay_canou_frames(frames, record_time, host, port, speed,
+                               frames_per_datagram)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Replay the CANoU frames of a pcap file over UDP")
+    parser.add_argument("filename", nargs="?", default="udp_packet.pcap")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=CANOU_PORT)
+    parser.add_argument("--speed", default="1",
+                        help="times real time, or 'max' for no pacing")
+    parser.add_argument("--frames-per-datagram", type=int, default=1)
+    args = parser.parse_args(argv)
+
+    speed = None if args.speed == "max" else float(args.speed)
+    stats = replay_pcap(args.filename, args.host, args.port, speed,
+                        args.frames_per_datagram)
+    for name, value in stats.items():
+        logging.info(f"{name}: {value}")
+    return stats
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    main(sys.argv[1:])
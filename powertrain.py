@@ -0,0 +1,53 @@
+from bisect import bisect_left
+from functools import lru_cache
+from math import exp
+import numpy as np
+
+# Gear ratio of the transmission over vehicle speed [kmph]: constant on
+# every gear (1 to 5), and linearly interpolated while shifting gears.
+GEAR_MAP_SPEED = (15.0, 20.0, 30.0, 40.0, 55.0, 60.0, 70.0, 80.0)
+GEAR_MAP_RATIO = (3.545, 1.956, 1.956, 1.303, 1.303, 0.892, 0.892, 0.707)
+
+
+class PiecewiseLinearMap:
+    # A piecewise linear map y(x) through the points (xp, fp), constant
+    # beyond both ends, compiled into tables of slope and intercept per
+    # segment. A scalar is looked up by bisection of the segment, while an
+    # array is interpolated with numpy at once.
+
+    def __init__(self, xp, fp):
+        self.xp = np.asarray(xp, dtype=np.float64)
+        self.fp = np.asarray(fp, dtype=np.float64)
+        # segment k covers xp[k-1] < x <= xp[k]
+        slope = [0.0]
+        intercept = [float(fp[0])]
+        for k in range(1, len(xp)):
+            slope.append((fp[k]-fp[k-1])/(xp[k]-xp[k-1]))
+            intercept.append(fp[k-1] - slope[k]*xp[k-1])
+        slope.append(0.0)
+        intercept.append(float(fp[-1]))
+        self.__breakpoint = tuple(float(x) for x in xp)
+        self.__slope = tuple(slope)
+        self.__intercept = tuple(intercept)
+
+    def lookup(self, x):
+        # scalar lookup
+        k = bisect_left(self.__breakpoint, x)
+        return self.__intercept[k] + self.__slope[k]*x
+
+    def __call__(self, x):
+        if np.ndim(x) == 0:
+            return self.lookup(x)
+        return np.interp(x, self.xp, self.fp)
+
+
+gear_ratio_map = PiecewiseLinearMap(GEAR_MAP_SPEED, GEAR_MAP_RATIO)
+
+
+@lru_cache(maxsize=256)
+def get_brake_loss_factor(value, scale):
+    # share of speed lost by braking with pedal position value [0,1] in
+    # one step. Pedal positions are a few fixed values, so the factors are
+    # cached.
+    assert(value <= 1.0)
+    return exp(value)/exp(1.0) * scale
@@ -0,0 +1,56 @@
+import numpy as np
+
+
+class TelemetryRecorder:
+    # Records of timestamp and field_num parameter values, kept as rows of a
+    # preallocated numpy array. The array grows on demand, or with ring set
+    # it has a fixed capacity and the oldest records are overwritten.
+    # With interval (in s) set, records are decimated to at most one per
+    # interval.
+
+    def __init__(self, field_num=1, capacity=1024, interval=0.0, ring=False):
+        self.interval = interval
+        self.ring = ring
+        self._data = np.empty((max(capacity, 1), field_num+1),
+                              dtype=np.float64)
+        self._size = 0
+        self._pos = 0
+        self._next_time = -np.inf
+
+    def __len__(self):
+        return self._size
+
+    def record(self, timestamp, *values):
+        if timestamp < self._next_time:
+            return False
+        self._next_time = timestamp + self.interval
+
+        pos = self._pos
+        if pos == len(self._data):
+            if self.ring:
+                pos = 0
+            else:
+                grown = np.empty((2*len(self._data), self._data.shape[1]),
+                                 dtype=np.float64)
+                grown[:pos] = self._data
+                self._data = grown
+        self._data[pos] = (timestamp,) + values
+        self._pos = pos + 1
+        if self._size < len(self._data):
+            self._size += 1
+        return True
+
+    def clear(self):
+        self._size = self._pos = 0
+        self._next_time = -np.inf
+
+    def get_record(self, field=0):
+        # [timestamp, value] records of a field in an (N, 2) array. The
+        # array is a view, except for a ring which has wrapped around and
+        # is copied in time order.
+        if self._size == len(self._data) and self._pos < self._size:
+            data = np.concatenate((self._data[self._pos:],
+                                   self._data[:self._pos]))
+        else:
+            data = self._data[:self._size]
+        return data[:, 0:field+2:field+1]
@@ -0,0 +1,225 @@
+import os
+import json
+import numpy as np
+
+# version of the serialized form of profiles
+TIMING_PROFILE_VERSION = 1
+
+
+def get_intervals(timestamp, ID, last_time):
+    # inter-arrival times of frames from the previous frame of their ID,
+    # last_time (a dict by ID) carries the time of the last frame of every
+    # ID over chunks. Return the timestamps, IDs and intervals of frames
+    # grouped by ID (in time order within an ID), frames without a previous
+    # one are left out.
+    timestamp = np.asarray(timestamp, dtype=np.float64)
+    ID = np.asarray(ID, dtype=np.int64)
+    if not len(ID):
+        return timestamp, ID, timestamp
+    order = np.argsort(ID, kind='stable')
+    timestamp, ID = timestamp[order], ID[order]
+    is_first = np.empty(len(ID), dtype=bool)
+    is_first[0] = True
+    is_first[1:] = ID[1:] != ID[:-1]
+    prev_time = np.roll(timestamp, 1)
+    prev_time[is_first] = [last_time.get(i, np.nan)
+                           for i in ID[is_first].tolist()]
+    is_last = np.roll(is_first, -1)
+    last_time.update(zip(ID[is_last].tolist(), timestamp[is_last].tolist()))
+    interval = timestamp - prev_time
+    valid = ~np.isnan(interval)
+    return timestamp[valid], ID[valid], interval[valid]
+
+
+class TimingProfile:
+    # Inter-arrival time profiles of CAN IDs, learned from a stream of
+    # frames in constant memory: count, mean and variance (Welford's
+    # method, merged by Chan's formula), minimum, maximum and a histogram
+    # of intervals in logarithmic bins of bins_per_decade bins from
+    # min_interval to max_interval [s], from which percentiles are
+    # estimated. Profiles of the same bins are merged exactly.
+
+    def __init__(self, bins_per_decade=20, min_interval=1e-6,
+                 max_interval=1e2):
+        self.bins_per_decade = bins_per_decade
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.bin_num = int(np.ceil(np.log10(max_interval/min_interval)
+                                   * bins_per_decade))
+        self.ids = np.empty(0, dtype=np.int64)
+        self.count = np.empty(0, dtype=np.int64)
+        self.mean = np.empty(0)
+        self.m2 = np.empty(0)
+        self.minimum = np.empty(0)
+        self.maximum = np.empty(0)
+        self.histogram = np.empty((0, self.bin_num), dtype=np.int64)
+        self.__last_time = {}
+
+    def __get_rows(self, ID):
+        # rows of the profiles of IDs, profiles of new IDs are added
+        new = np.setdiff1d(ID, self.ids)
+        if len(new):
+            self.ids = np.concatenate([self.ids, new])
+            self.count = np.concatenate([self.count,
+                                         np.zeros(len(new), dtype=np.int64)])
+            self.mean = np.concatenate([self.mean, np.zeros(len(new))])
+            self.m2 = np.concatenate([self.m2, np.zeros(len(new))])
+            self.minimum = np.concatenate([self.minimum,
+                                           np.full(len(new), np.inf)])
+            self.maximum = np.concatenate([self.maximum,
+                                           np.full(len(new), -np.inf)])
+            self.histogram = np.concatenate([self.histogram, np.zeros(
+                (len(new), self.bin_num), dtype=np.int64)])
+        order = np.argsort(self.ids)
+        return order[np.searchsorted(self.ids, ID, sorter=order)]
+
+    def __merge_rows(self, rows, count, mean, m2, minimum, maximum,
+                     histogram):
+        # merge statistics into the profiles of (distinct) rows
+        total = self.count[rows] + count
+        delta = mean - self.mean[rows]
+        self.m2[rows] += m2 + delta**2 * self.count[rows] * count / total
+        self.mean[rows] += delta * count / total
+        self.count[rows] = total
+        self.minimum[rows] = np.minimum(self.minimum[rows], minimum)
+        self.maximum[rows] = np.maximum(self.maximum[rows], maximum)
+        self.histogram[rows] += histogram
+
+    def get_bin(self, interval):
+        # histogram bins of intervals, those out of range in the end bins
+        with np.errstate(divide='ignore'):
+            index = np.floor(np.log10(np.asarray(interval)/self.min_interval)
+                             * self.bins_per_decade)
+        return np.clip(np.nan_to_num(index, neginf=0), 0,
+                       self.bin_num - 1).astype(np.int64)
+
+    def get_bin_edges(self):
+        return self.min_interval * 10.0 ** (np.arange(self.bin_num + 1)
+                                            / self.bins_per_decade)
+
+    def add_intervals(self, ID, interval):
+        # add inter-arrival times of IDs, grouped by ID
+        if not len(ID):
+            return
+        start = np.flatnonzero(np.r_[True, ID[1:] != ID[:-1]])
+        count = np.diff(np.r_[start, len(ID)])
+        mean = np.add.reduceat(interval, start) / count
+        m2 = np.add.reduceat((interval - np.repeat(mean, count))**2, start)
+        histogram = np.zeros((len(start), self.bin_num), dtype=np.int64)
+        np.add.at(histogram, (np.repeat(np.arange(len(start)), count),
+                              self.get_bin(interval)), 1)
+        self.__merge_rows(self.__get_rows(ID[start]), count, mean, m2,
+                          np.minimum.reduceat(interval, start),
+                          np.maximum.reduceat(interval, start), histogram)
+
+    def update(self, timestamp, ID):
+        # learn from a chunk of frames in time order, following the chunk
+        # before
+        _, ID, interval = get_intervals(timestamp, ID, self.__last_time)
+        self.add_intervals(ID, interval)
+
+    def merge(self, other):
+        # merge another profile (e.g. of another run) into this one
+        assert((self.bins_per_decade, self.min_interval, self.max_interval)
+               == (other.bins_per_decade, other.min_interval,
+                   other.max_interval))
+        known = other.count > 0
+        if np.any(known):
+            self.__merge_rows(self.__get_rows(other.ids[known]),
+                              other.count[known], other.mean[known],
+                              other.m2[known], other.minimum[known],
+                              other.maximum[known], other.histogram[known])
+        return self
+
+    def __get_row(self, ID):
+        row = np.flatnonzero(self.ids == ID)
+        return int(row[0]) if len(row) and self.count[row[0]] else None
+
+    def get_percentile(self, ID, q):
+        # percentiles q [%] of the intervals of an ID, interpolated within
+        # histogram bins on the log scale, nan for unknown IDs
+        q = np.asarray(q, dtype=np.float64)
+        row = self.__get_row(ID)
+        if row is None:
+            return np.full(q.shape, np.nan)
+        cumulative = np.cumsum(self.histogram[row])
+        rank = q / 100 * cumulative[-1]
+        k = np.minimum(np.searchsorted(cumulative, rank), self.bin_num - 1)
+        below = np.where(k > 0, cumulative[k-1], 0)
+        fraction = np.clip((rank - below)
+                           / np.maximum(self.histogram[row][k], 1), 0, 1)
+        edges = self.get_bin_edges()
+        value = edges[k] * (edges[k+1]/edges[k]) ** fraction
+        return np.clip(value, self.minimum[row], self.maximum[row])
+
+    def get_stats(self, ID, q=(1, 50, 99)):
+        # summary of the profile of an ID, None if unknown
+        row = self.__get_row(ID)
+        if row is None:
+            return None
+        count = int(self.count[row])
+        stats = {"count": count,
+                 "mean": float(self.mean[row]),
+                 "std": float(np.sqrt(self.m2[row] / count)),
+                 "min": float(self.minimum[row]),
+                 "max": float(self.maximum[row])}
+        for i, value in zip(q, self.get_percentile(ID, q).tolist()):
+            stats[f"p{i:g}"] = value
+        return stats
+
+    def to_dict(self):
+        return {"version": TIMING_PROFILE_VERSION,
+                "bins_per_decade": self.bins_per_decade,
+                "min_interval": self.min_interval,
+                "max_interval": self.max_interval,
+                "ids": self.ids.tolist(),
+                "count": self.count.tolist(),
+                "mean": self.mean.tolist(),
+                "m2": self.m2.tolist(),
+                "minimum": self.minimum.tolist(),
+                "maximum": self.maximum.tolist(),
+                "histogram": self.histogram.tolist()}
+
+    @classmethod
+    def from_dict(cls, data):
+        assert(data["version"] == TIMING_PROFILE_VERSION)
+        profile = cls(data["bins_per_decade"], data["min_interval"],
+                      data["max_interval"])
+        profile.ids = np.array(data["ids"], dtype=np.int64)
+        profile.count = np.array(data["count"], dtype=np.int64)
+        for name in ("mean", "m2", "minimum", "maximum"):
+            setattr(profile, name, np.array(data[name], dtype=np.float64))
+        profile.histogram = np.array(data["histogram"], dtype=np.int64) \
+            .reshape(len(profile.ids), profile.bin_num)
+        return profile
+
+    def save(self, filename):
+        with open(filename + ".tmp", "w") as f:
+            json.dump(self.to_dict(), f)
+        os.replace(filename + ".tmp", filename)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename) as f:
+            return cls.from_dict(json.load(f))
+
+
+def learn_timing_profile(source, profile=None):
+    # learn a profile (a new one by default) from a source of (timestamp,
+    # ID, value) chunks of clean traffic, e.g. iter_capture_frames() of
+    # intrusion_detection.py
+    profile = TimingProfile() if profile is None else profile
+    for timestamp, ID, _ in source:
+        profile.update(timestamp, ID)
+    return profile
+
+
+def merge_timing_profiles(profiles):
+    # merge profiles, e.g. of runs in worker processes, into a new one
+    profiles = list(profiles)
+    merged = TimingProfile(profiles[0].bins_per_decade,
+                           profiles[0].min_interval,
+                           profiles[0].max_interval)
+    for profile in profiles:
+        merged.merge(profile)
+    return merged
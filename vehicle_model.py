@@ -1,12 +1,37 @@
-from random import seed, random, sample, expovariate, randint
+from random import seed, random, expovariate, randint
 from glob_def import CarEvent, CarStatus, GearShiftStatus
 from glob_def import CAN_DATA_RATE, CAN_FRAME_LEN
 from glob_def import BUS_LOAD, ACCE_RATIO, BRAK_RATIO, DOS_RATIO
 from glob_def import ATTACK_TYPE_DDOS, ATTACK_TYPE_REVERSE_GAS, ATTACK_TYPE_KILL_ENGINE
-from dbc_msg_conversion import DbcMsgConvertor
-from math import exp
+from dbc_msg_conversion import get_dbc_convertor
+from event_table import EventTable, get_label_code
+from event_scheduler import iter_event_rows
+from telemetry_recorder import TelemetryRecorder
+from powertrain import gear_ratio_map, get_brake_loss_factor
+import numpy as np
 import logging
 
+# numpy generator drawing the traffic timing, seeded with set_random_seed()
+_rng = np.random.default_rng(1)
+
+
+def set_random_seed(value):
+    global _rng
+    seed(value)
+    _rng = np.random.default_rng(value)
+
+
+def set_simulation_parameters(bus_load=BUS_LOAD, dos_ratio=DOS_RATIO,
+                              invalid_msg_threshold=1e2):
+    # override the bus load and DOS ratio of glob_def, and the message
+    # threshold of attack detection, for the simulations run in this process
+    global BUS_LOAD, DOS_RATIO
+    BUS_LOAD, DOS_RATIO = bus_load, dos_ratio
+    Vehicle.invalid_msg_threshold = invalid_msg_threshold
+    Vehicle.max_acce_power = Vehicle.max_delta_speed*1e-3/BUS_LOAD/ACCE_RATIO
+    Vehicle.torque_to_acce_power_ratio = \
+        Vehicle.max_acce_power/Vehicle.max_torque/3.0
+
 
 class Vehicle:
 
@@ -34,21 +59,31 @@ class Vehicle:
 
     brake_scale = 0.3
 
+    # physics is stepped once per tick on an idle bus
+    tick_interval = 1e-3        # unit: s
+    query_interval = 0.01       # query vehicle status every 10ms
+
     dbc_data = None
 
-    def __init__(self, model="unknown", speed=0.0):
+    def __init__(self, model="unknown", speed=0.0, record_telemetry=True,
+                 record_interval=0.0, record_capacity=None, random_seed=1):
         self.model = model
         self.speed = speed
         self.enginespeed = Vehicle.min_engine_speed
         self.power = .0
         self.torque = 70.0
-        self.dbc_data = DbcMsgConvertor(model)
-        self.speedometer = []
-        self.tachometer = []
-        self.braking_record = []
-        self.torquemeter = []
-        self.accpower_record = []
-        self.status_record = []
+        self.dbc_data = get_dbc_convertor(model)
+        # Telemetry records grow with simulation time, unless a capacity is
+        # set to keep the latest records only. They could be decimated to
+        # one record per record_interval [s], or turned off altogether.
+        recorder_args = dict(
+            interval=record_interval, ring=record_capacity is not None,
+            capacity=record_capacity if record_capacity else 1024)
+        # speed, engine speed, torque and status
+        self.meter_record = TelemetryRecorder(4, **recorder_args)
+        self.braking_record = TelemetryRecorder(1, **recorder_args)
+        self.accpower_record = TelemetryRecorder(1, **recorder_args)
+        self.record_telemetry = record_telemetry
 
         self.gearshift = GearShiftStatus.PARK
         self.status = CarStatus.NORMAL
@@ -57,55 +92,29 @@ class Vehicle:
         self.rlengine = 0
         self.driving_int = -1
         self.speed_int = 0.0
+        self.last_query_time = -100
+        self.attack_event_num = 0
 
-        # set random seed
-        seed(1)
+        # set random seed, give every simulation run its own seed to get
+        # independent results
+        set_random_seed(random_seed)
         return
 
     def __get_gear_ratio(self):
-
-        def linear_interp(x1, x2, y1, y2, x):
-            return (y1*(x-x2)-y2*(x-x1))/(x1-x2)
-        # 1
-        if self.speed <= 15.0:
-            gear_ratio = 3.545
-        elif 15.0 < self.speed <= 20.0:
-            gear_ratio = linear_interp(15.0, 20.0, 3.545, 1.956, self.speed)
-        # 2
-        elif 20.0 < self.speed <= 30.0:
-            gear_ratio = 1.956
-        elif 30.0 < self.speed <= 40.0:
-            gear_ratio = linear_interp(30.0, 40.0, 1.956, 1.303, self.speed)
-        # 3
-        elif 40.0 < self.speed <= 55.0:
-            gear_ratio = 1.303
-        elif 55.0 < self.speed <= 60.0:
-            gear_ratio = linear_interp(55.0, 60.0, 1.303, 0.892, self.speed)
-        # 4
-        elif 60.0 < self.speed <= 70.0:
-            gear_ratio = 0.892
-        elif 70.0 < self.speed <= 80.0:
-            gear_ratio = linear_interp(70.0, 80.0, 0.892, 0.707, self.speed)
-        # 5
-        else:   # self.speed > 80
-            gear_ratio = 0.707
-
-        return gear_ratio
+        return gear_ratio_map.lookup(self.speed)
 
     def __record_car_parameter(self, timestamp):
-        self.speedometer.append([timestamp, self.speed])
-        self.tachometer.append([timestamp, self.enginespeed])
-        self.torquemeter.append([timestamp, self.torque])
-
-        # record car status
-        self.status_record.append([timestamp, self.status])
+        if not self.record_telemetry:
+            return
+        # record car status along
+        self.meter_record.record(timestamp, self.speed, self.enginespeed,
+                                 self.torque, self.status.value)
 
         return
 
     def __get_speed_loss_from_brake(self, value):
-        assert(value <= 1.0)
-        speed_loss = self.speed * exp(value)/exp(1.0) \
-            * 1e-3/BUS_LOAD/Vehicle.brake_scale
+        speed_loss = self.speed * get_brake_loss_factor(
+            value, 1e-3/BUS_LOAD/Vehicle.brake_scale)
         return speed_loss
 
     def __audit_engine_speed(self):
@@ -184,7 +193,8 @@ class Vehicle:
             self.enginespeed = self.speed * self.__get_gear_ratio() \
                 * self.speed_to_enginespeed_ratio
             self.__audit_engine_speed()
-            self.accpower_record.append([timestamp, acce_power])
+            if self.record_telemetry:
+                self.accpower_record.record(timestamp, acce_power)
         return
 
     def record_brake_pedal_action(self, timestamp, value):
@@ -201,7 +211,8 @@ class Vehicle:
             self.torque = Vehicle.max_torque \
                 if self.torque > Vehicle.max_torque else self.torque
 
-            self.braking_record.append([timestamp, value])
+            if self.record_telemetry:
+                self.braking_record.record(timestamp, value)
         return
 
     def query_vehicle_status(self):
@@ -211,21 +222,100 @@ class Vehicle:
         self.__no_driving_action()
         return
 
+    def step(self, events):
+        # Apply a block of pedal events (gas, brake and free) in one call,
+        # with the car state held in local variables. The block is taken as
+        # is: the 1s timer, attack injection and status queries of
+        # drive_car() are not applied, and events of other IDs are skipped.
+        # Results equal those of the per event methods up to float rounding
+        # of the gear ratio lookup (relative error below 1e-12).
+        # events: EventTable, list of CarEvent or (timestamp, ID, value,
+        # label) rows
+        gear_ratio = gear_ratio_map.lookup
+        brake_scale = 1e-3/BUS_LOAD/Vehicle.brake_scale
+        max_rpm, min_rpm = Vehicle.max_engine_speed, Vehicle.min_engine_speed
+        max_torque, max_acce = Vehicle.max_torque, Vehicle.max_acce_power
+        rpm_ratio = self.speed_to_enginespeed_ratio
+        gas_ratio = self.gas_pedal_to_power_ratio
+        acce_ratio = self.torque_to_acce_power_ratio
+        speed_elapsing = Vehicle.speed_elapsing_factor
+        power_elapsing = Vehicle.power_elapsing_factor
+        normal = self.status == CarStatus.NORMAL
+        shutdown = self.status == CarStatus.ENGINE_SHUTDOWN
+        status = self.status.value
+        record = self.record_telemetry
+        meter_record = self.meter_record.record
+        braking_record = self.braking_record.record
+        accpower_record = self.accpower_record.record
+
+        speed, rpm = self.speed, self.enginespeed
+        power, torque = self.power, self.torque
+        for timestamp, ID, value, _ in iter_event_rows(events):
+            if ID == CarEvent.CAR_EVENT_GAS_PEDAL:
+                action = 1 if normal and rpm < max_rpm else 0
+            elif ID == CarEvent.CAR_EVENT_BRAKE_PEDAL:
+                action = 2 if normal else 0
+            elif ID == CarEvent.CAR_EVENT_FREE:
+                action = 0
+            else:
+                continue
+
+            if action == 1:
+                power = value * gas_ratio
+                torque = min(power * 9550.0 / rpm, max_torque)
+                acce_power = min(torque * gear_ratio(speed) * acce_ratio,
+                                 max_acce)
+                speed = speed + acce_power
+                rpm = min(max(speed * gear_ratio(speed) * rpm_ratio,
+                              min_rpm), max_rpm)
+                if record:
+                    accpower_record(timestamp, acce_power)
+            elif action == 2:
+                speed_loss = speed * get_brake_loss_factor(value, brake_scale)
+                speed = (speed-speed_loss) if speed > speed_loss else 0.0
+                rpm = min(max(speed * gear_ratio(speed) * rpm_ratio,
+                              min_rpm), max_rpm)
+                torque = min(power * 9550.0 / rpm, max_torque)
+                if record:
+                    braking_record(timestamp, value)
+            elif speed == 0:
+                pass
+            elif shutdown:
+                speed += speed*(-10)*speed_elapsing
+                power = rpm = torque = 0
+            else:
+                road_force = (random()-0.7)
+                speed += speed*road_force*speed_elapsing
+                if speed <= 0:
+                    speed = rpm = power = torque = 0.0
+                else:
+                    rpm = min(max(speed * gear_ratio(speed) * rpm_ratio,
+                                  min_rpm), max_rpm)
+                    power += power*road_force*power_elapsing
+                    torque = min(power * 9550.0 / rpm, max_torque)
+
+            if record:
+                meter_record(timestamp, speed, rpm, torque, status)
+
+        self.speed, self.enginespeed = speed, rpm
+        self.power, self.torque = power, torque
+        return
+
+    def __attack_condition(self, speed):
+        # check the registered attack model against given speed, which could
+        # also be an array of speed values
+        attack = self.attack_model
+        in_reverse = self.gearshift == GearShiftStatus.REVERSE
+        in_speed = (attack.speed_low < speed) & (speed < attack.speed_high)
+        if attack.is_gearshift_check and in_reverse:
+            return in_speed if attack.is_speed_check else True
+        if attack.is_speed_check:
+            return in_speed & (in_reverse or not attack.is_gearshift_check)
+        return False
+
     def __is_attacked(self, timestamp):
         if (self.is_attack_registered):
-            attack = self.attack_model
-            if attack.is_gearshift_check and (self.gearshift ==
-                                              GearShiftStatus.REVERSE):
-                if attack.is_speed_check:
-                    return (attack.speed_low < self.speed < attack.speed_high)
-                else:
-                    return True
-            if attack.is_speed_check and (attack.speed_low < self.speed
-                                          < attack.speed_high):
-                if attack.is_gearshift_check:
-                    return (self.gearshift == GearShiftStatus.REVERSE)
-                else:
-                    return True
+            return self.__attack_condition(self.speed)
         return False
 
     def __try_to_generate_attack_event(self, timestamp):
@@ -246,7 +336,7 @@ class Vehicle:
             return CarEvent("DOS attack", timestamp=timestamp,
                             ID=randint(0, 0x10), value=random())
         elif attack.type == ATTACK_TYPE_REVERSE_GAS:
-            return CarEvent("Accelerating", timestamp=timestamp,
+            return CarEvent("Reverse gas attack", timestamp=timestamp,
                             ID=CarEvent.CAR_EVENT_GAS_PEDAL, value=0.99)
         elif attack.type == ATTACK_TYPE_KILL_ENGINE:
             return CarEvent("Shut down engine", timestamp=timestamp,
@@ -254,45 +344,180 @@ class Vehicle:
         else:
             return None
 
-    def drive_car(self, event_list):
-        # generate regular query during driving
-        rt_event_list = []
-        last_query_time = -100
-        query_interval = 0.01  # query vehicle status every 10ms
-
-        for event in event_list:
-            # fetch a event from the list
-
-            # check attack model, if the condition is met then attack event
-            # is inserted
-            if self.__is_attacked(event.timestamp):
-                attack_event = self.__try_to_generate_attack_event(event.timestamp)
-                if attack_event:
-                    logging.debug(f"Inject an attacking packet at time {event.timestamp}")
-                    rt_event_list.append(attack_event)
-                    self.__drive_by_event(attack_event)
-
-            # drive the car by event
-            self.__drive_by_event(event)
-
-            # query car status
-            if event.timestamp-last_query_time > query_interval:
-                last_query_time = event.timestamp
-                speed, enginespeed, torque = self.query_vehicle_status()
-                rt_event_list.extend(generate_query_event(event.timestamp,
-                                     speed, enginespeed, torque))
+    def __coast(self, tick_num):
+        # __no_driving_action batched over tick_num idle ticks: only speed
+        # and power are stepped per tick, the rest is updated once at the
+        # end. Coasting stops at the tick where the registered attack would
+        # be triggered, the number of ticks coasted is returned
+        if self.speed == 0:
+            # nothing to do with car stopped
+            return tick_num
+
+        is_shutdown = self.status == CarStatus.ENGINE_SHUTDOWN
+        speed, power = self.speed, self.power
+        for i in range(tick_num):
+            if i and self.is_attack_registered and \
+               self.__attack_condition(speed):
+                tick_num = i
+                break
+            if is_shutdown:
+                speed += speed*(-10)*Vehicle.speed_elapsing_factor
+            else:
+                road_force = (random()-0.7)
+                speed += speed*road_force*Vehicle.speed_elapsing_factor
+                power += power*road_force*Vehicle.power_elapsing_factor
+        self.speed = speed
 
+        if is_shutdown:
+            self.power = 0
+            self.enginespeed = 0
+            self.torque = 0
+        else:
+            self.enginespeed = self.speed * self.__get_gear_ratio() \
+                * self.speed_to_enginespeed_ratio
+            self.__audit_engine_speed()
+            self.power = power
+            self.torque = self.power * 9550.0 / self.enginespeed
+            self.torque = Vehicle.max_torque \
+                if self.torque > Vehicle.max_torque else self.torque
+        return tick_num
+
+    def __first_tick_after(self, tick, timestamp, interval, inclusive):
+        # first tick from given tick on, by which interval elapses since
+        # timestamp
+        ti = Vehicle.tick_interval
+        first = max(tick, int((timestamp+interval)/ti) - 1)
+        while (first*ti-timestamp < interval if inclusive
+               else first*ti-timestamp <= interval):
+            first += 1
+        return first
+
+    def __drive_idle_ticks(self, tick, stop_tick, rt_event_list):
+        # drive the car through the ticks in [tick, stop_tick), when no event
+        # is on the bus. Ticks with query, timer reset or attack are handled
+        # like a CAR_EVENT_FREE event, the others are coasted in one batch
+        while tick < stop_tick:
+            timestamp = tick*Vehicle.tick_interval
+            next_tick = min(
+                stop_tick,
+                self.__first_tick_after(tick, self.last_query_time,
+                                        Vehicle.query_interval, False),
+                self.__first_tick_after(tick, self.driving_int, 1.0, True))
+            if next_tick == tick or self.__is_attacked(timestamp):
+                self.__drive_by_tick(timestamp, CarEvent.CAR_EVENT_FREE, -1,
+                                     rt_event_list)
+                tick += 1
+            else:
+                tick += self.__coast(next_tick-tick)
+                self.__record_car_parameter((tick-1)*Vehicle.tick_interval)
+
+    def __drive_by_tick(self, timestamp, ID, value, rt_event_list):
+        # check attack model, if the condition is met then attack event
+        # is inserted
+        if self.__is_attacked(timestamp):
+            attack_event = self.__try_to_generate_attack_event(timestamp)
+            if attack_event:
+                logging.debug(f"Inject an attacking packet at time {timestamp}")
+                rt_event_list.append_event(attack_event)
+                self.attack_event_num += 1
+                self.__drive_by_event(attack_event.timestamp,
+                                      attack_event.ID, attack_event.value)
+
+        # drive the car by event
+        self.__drive_by_event(timestamp, ID, value)
+
+        # query car status
+        if timestamp-self.last_query_time > Vehicle.query_interval:
+            self.last_query_time = timestamp
+            speed, enginespeed, torque = self.query_vehicle_status()
+            generate_query_event(timestamp, speed, enginespeed, torque,
+                                 rt_event_list)
+
+    def __drive_by_rows(self, rows, start_time, stop_time, rt_event_list):
+        # Drive the car by time sorted (timestamp, ID, value, label) rows from
+        # start_time to stop_time (the first and last event by default). Idle
+        # ticks without any event are coasted, so CAR_EVENT_FREE events
+        # needn't be generated. Real-time events are appended to
+        # rt_event_list, and the generator yields every row after it has
+        # been processed, or None after idle ticks.
+        self.last_query_time = -100
+        tick_per_second = round(1.0/Vehicle.tick_interval)
+
+        next_tick = None
+        if start_time is not None:
+            next_tick = int(start_time*tick_per_second + 1e-6)
+        for row in rows:
+            # fetch a event from the stream
+            timestamp, ID, value = row[0], row[1], row[2]
+            tick = int(timestamp*tick_per_second + 1e-6)
+            if next_tick is None:
+                next_tick = tick
+            if tick > next_tick:
+                self.__drive_idle_ticks(next_tick, tick, rt_event_list)
+                yield None
+            if ID is None:
+                # a clock row of a CanBus, the time has come only
+                next_tick = max(next_tick, tick)
+                continue
+            next_tick = max(next_tick, tick+1)
+
+            self.__drive_by_tick(timestamp, ID, value, rt_event_list)
+            yield row
+
+        if stop_time is not None and next_tick is not None:
+            self.__drive_idle_ticks(
+                next_tick, int(stop_time*tick_per_second + 1e-6),
+                rt_event_list)
+            yield None
+
+    def drive_car(self, event_list, start_time=None, stop_time=None):
+        # drive the car by the event list, and return the real-time query
+        # and attack events generated during driving
+        rt_event_list = EventTable()
+        for _ in self.__drive_by_rows(iter_event_rows(event_list),
+                                      start_time, stop_time, rt_event_list):
+            pass
         return rt_event_list
 
-    def __drive_by_event(self, event: CarEvent):
+    def drive_stream(self, events, start_time=None, stop_time=None,
+                     bus=None):
+        # Drive the car by a time sorted event source (e.g. EventScheduler),
+        # and yield the (timestamp, ID, value, label) rows of all events on
+        # the bus: each input event followed by the real-time query and
+        # attack events generated along. The stream stays sorted by time.
+        # With a bus (CanBus of can_bus.py) the events are perceived by the
+        # car at their delivery time on the bus, and the real-time events
+        # are sent on it as well (attacks injected by the car still act on
+        # it right away); rows are yielded at delivery time.
+        rt_event_list = EventTable()
+        if bus is not None:
+            events = bus.iter_delivered(
+                events, clock_interval=Vehicle.tick_interval)
+        for row in self.__drive_by_rows(iter_event_rows(events),
+                                        start_time, stop_time, rt_event_list):
+            if bus is not None:
+                yield from bus.take_pushed()
+                for rt_row in rt_event_list.rows():
+                    bus.push(*rt_row)
+                rt_event_list.clear()
+            if row is not None:
+                yield row
+            if len(rt_event_list):
+                yield from rt_event_list.rows()
+                rt_event_list.clear()
+        if bus is not None:
+            bus.flush()
+            yield from bus.take_pushed()
+
+    def __drive_by_event(self, timestamp, ID, value):
         # reset timer
-        if event.timestamp - self.driving_int >= 1.0:
-            self.driving_int = int(event.timestamp)
+        if timestamp - self.driving_int >= 1.0:
+            self.driving_int = int(timestamp)
             speed_delta = self.speed - self.speed_int
             self.speed_int = self.speed
             if (self.status == CarStatus.NORMAL and speed_delta > 10):
                 self.status = CarStatus.REVERSE_HIGH_FUEllING
-                logging.info(f"Car status changed: high reverse fuelling at {event.timestamp}")
+                logging.info(f"Car status changed: high reverse fuelling at {timestamp}")
             if (self.status == CarStatus.REVERSE_HIGH_FUEllING
                     and speed_delta < 10):
                 # Car recovered from a high_fuelling_reverse error
@@ -306,112 +531,204 @@ class Vehicle:
             self.hpmsg = self.rlengine = 0
 
         # drive the car by event fed in
-        if event.ID <= 0x10:
+        if ID <= 0x10:
             # detect DOS attack
             # count number of messages with high priority
             self.hpmsg += 1
             if self.status == CarStatus.NORMAL and \
                self.hpmsg >= Vehicle.invalid_msg_threshold:
                 self.status = CarStatus.DOS_DETECTED
-                logging.info(f"Car status changed: DOS attack detected at {event.timestamp}")
-        elif event.ID == CarEvent.CAR_EVENT_BROADCAST_GEAR_STATUS:
-            self.set_gear_shift(event.value)
-        elif event.ID == CarEvent.CAR_EVENT_GAS_PEDAL:
-            self.record_gas_pedal_action(event.timestamp, event.value)
-        elif event.ID == CarEvent.CAR_EVENT_GAS_ACC_VIA_ICE:
-            if event.value == 1:
+                logging.info(f"Car status changed: DOS attack detected at {timestamp}")
+        elif ID == CarEvent.CAR_EVENT_BROADCAST_GEAR_STATUS:
+            self.set_gear_shift(GearShiftStatus(int(value)))
+        elif ID == CarEvent.CAR_EVENT_GAS_PEDAL:
+            self.record_gas_pedal_action(timestamp, value)
+        elif ID == CarEvent.CAR_EVENT_GAS_ACC_VIA_ICE:
+            if value == 1:
                 # overwrought the engine until it is killed
                 self.rlengine += 1
                 if self.status == CarStatus.NORMAL and \
                    self.rlengine >= Vehicle.invalid_msg_threshold:
                     self.status = CarStatus.ENGINE_SHUTDOWN
                     print("Car status changed: engine killed !",
-                          event.timestamp)
-        elif event.ID == CarEvent.CAR_EVENT_BRAKE_PEDAL:
-            self.record_brake_pedal_action(event.timestamp, event.value)
-        elif event.ID == CarEvent.CAR_EVENT_FREE:
-            self.record_no_action(event.timestamp)
+                          timestamp)
+        elif ID == CarEvent.CAR_EVENT_BRAKE_PEDAL:
+            self.record_brake_pedal_action(timestamp, value)
+        elif ID == CarEvent.CAR_EVENT_FREE:
+            self.record_no_action(timestamp)
 
         # record car parameters and status
-        self.__record_car_parameter(event.timestamp)
+        self.__record_car_parameter(timestamp)
 
+    # records are returned as (N, 2) arrays of [timestamp, value]
     def get_speedometer_record(self):
-        return self.speedometer
+        return self.meter_record.get_record(0)
 
     def get_tachometer_record(self):
-        return self.tachometer
+        return self.meter_record.get_record(1)
 
     def get_braking_record(self):
-        return self.braking_record
+        return self.braking_record.get_record()
 
     def get_torque_record(self):
-        return self.torquemeter
-
-    def get_accpower_record(self):
-        return self.accpower_record
+        return self.meter_record.get_record(2)
 
+    def get_status_record(self):
+        # status is recorded by the value of CarStatus
+        return self.meter_record.get_record(3)
 
-def get_event_timing_from_interval(start_second, stop_second, load_ratio):
+    def get_accpower_record(self):
+        return self.accpower_record.get_record()
+
+
+def _sample_distinct_keys(key_base, key_num, event_num):
+    # draw event_num[i] distinct keys out of
+    # [key_base[i], key_base[i]+key_num[i]) for every interval i at once,
+    # return all keys sorted. Draws are made with replacement and
+    # collisions are drawn again until every interval has enough keys. With
+    # event_num <= key_num/2 each round at least halves the expected deficit.
+    keys = np.empty(0, dtype=np.int64)
+    redrawn = np.empty(0, dtype=np.int64)
+    count = np.zeros(len(key_num), dtype=np.int64)
+    deficit = event_num
+    while deficit.any():
+        # the key ranges are disjoint, so sorting the draws keeps them
+        # grouped by interval
+        interval = np.repeat(np.arange(len(key_num)), deficit)
+        draw = key_base[interval] \
+            + (_rng.random(len(interval))*key_num[interval]).astype(np.int64)
+        draw.sort()
+        is_new = np.concatenate(([True], draw[1:] != draw[:-1]))
+        for drawn in (keys, redrawn):
+            if len(drawn):
+                pos = np.searchsorted(drawn, draw).clip(max=len(drawn)-1)
+                is_new &= drawn[pos] != draw
+        if len(keys):
+            redrawn = np.sort(np.concatenate((redrawn, draw[is_new])),
+                              kind='stable')
+        else:
+            keys = draw[is_new]
+        count += np.bincount(interval[is_new], minlength=len(key_num))
+        deficit = event_num - count
+    return np.sort(np.concatenate((keys, redrawn)), kind='stable')
+
+
+def get_event_timing_from_profile(start_seconds, stop_seconds, load_ratio,
+                                  resolution=1e-3):
+    # generate events on random timing points for a whole drive profile,
+    # given as arrays of [start_second, stop_second) intervals and the load
+    # ratio of each interval. Timing points are multiples of resolution
+    # (in unit of s) and hold one event at most. Return the sorted timing
+    # points as an array.
+    start_seconds, stop_seconds, load_ratio = np.broadcast_arrays(
+        np.atleast_1d(np.asarray(start_seconds, dtype=np.float64)),
+        np.asarray(stop_seconds, dtype=np.float64),
+        np.asarray(load_ratio, dtype=np.float64))
+    slot_per_second = round(1.0/resolution)
+    slot_start = (start_seconds*slot_per_second).astype(np.int64)
+    slot_num = np.maximum(
+        (stop_seconds*slot_per_second).astype(np.int64)-slot_start, 0)
+    event_num = np.trunc(CAN_DATA_RATE/CAN_FRAME_LEN
+                         * (stop_seconds-start_seconds) * BUS_LOAD
+                         * load_ratio).astype(np.int64)
+    event_num = np.clip(event_num, 0, slot_num)
+    interval_id = np.arange(len(slot_num))
+
+    # number the slots of all intervals in one key space
+    key_base = np.cumsum(slot_num) - slot_num
+
+    # in crowded intervals the free slots are drawn instead
+    crowded = 2*event_num > slot_num
+    drawn_num = np.where(crowded, slot_num-event_num, event_num)
+    keys = _sample_distinct_keys(key_base, slot_num, drawn_num)
+    if crowded.any():
+        # enumerate the slots of crowded intervals and drop the free ones
+        is_free = np.repeat(crowded, drawn_num)
+        free_interval = np.repeat(interval_id, np.where(crowded, drawn_num, 0))
+        crowded_num = np.where(crowded, slot_num, 0)
+        crowded_base = np.cumsum(crowded_num) - crowded_num
+        keep = np.ones(crowded_num.sum(), dtype=bool)
+        keep[crowded_base[free_interval] + keys[is_free]
+             - key_base[free_interval]] = False
+        taken_interval = np.repeat(interval_id,
+                                   np.where(crowded, event_num, 0))
+        keys = np.sort(np.concatenate((
+            keys[~is_free],
+            key_base[taken_interval] + np.flatnonzero(keep)
+            - crowded_base[taken_interval])), kind='stable')
+
+    interval = np.repeat(interval_id, event_num)
+    slots = slot_start[interval] + keys - key_base[interval]
+    return np.sort(slots, kind='stable') * resolution
+
+
+def get_event_timing_from_interval(start_second, stop_second, load_ratio,
+                                   resolution=1e-3):
     # generate event on random timing point between start_time
-    # and stop_time, in unit of ms
-    timing_interval = range(int(start_second*1e3), int(stop_second*1e3))
-    event_number = int(CAN_DATA_RATE/CAN_FRAME_LEN
-                       * (stop_second-start_second) * BUS_LOAD * load_ratio)
-    event_number = len(timing_interval) \
-        if event_number > len(timing_interval) else event_number
-    timing_seq = [i*1e-3 for i in sample(timing_interval, event_number)]
-    return sorted(timing_seq)
+    # and stop_time, in unit of ms by default
+    return get_event_timing_from_profile(start_second, stop_second,
+                                         load_ratio, resolution)
+
+
+def stream_profile_event(generator, start_times, stop_times, values,
+                         chunk_size=60):
+    # Generate events of a drive profile (intervals in time order) chunk by
+    # chunk, chunk_size profile intervals at a time, and yield them as
+    # (timestamp, ID, value, label) rows, e.g.:
+    #     stream_profile_event(generate_constant_event, start, stop, acce)
+    # Only one chunk of events is kept in memory.
+    start_times, stop_times, values = np.broadcast_arrays(
+        start_times, stop_times, values)
+    for i in range(0, len(start_times), chunk_size):
+        chunk = slice(i, i+chunk_size)
+        yield from generator(start_times[chunk], stop_times[chunk],
+                             values[chunk]).rows()
 
 
 def car_set_gear(start_time, gearshift):
-    return [
-        CarEvent(desc="Set gearshift to Drive", timestamp=start_time,
-                 ID=CarEvent.CAR_EVENT_BROADCAST_GEAR_STATUS,
-                 value=gearshift)
-    ]
-
+    return EventTable.from_columns(
+        [start_time], CarEvent.CAR_EVENT_BROADCAST_GEAR_STATUS,
+        gearshift.value, "Set gearshift to Drive")
 
-def generate_constant_event(start_time=.0, stop_time=10.0, acceleration=0):
-    event_list = []
 
+def generate_constant_event(start_time=.0, stop_time=10.0, acceleration=0,
+                            resolution=1e-3):
+    # start_time, stop_time and acceleration could be arrays describing a
+    # whole drive profile, with events generated in one pass
     # -----------------------------------------------------
     # create accelaration event
-    acce_ratio = ACCE_RATIO
-    time_seq = get_event_timing_from_interval(start_time, stop_time,
-                                              acce_ratio)
-    event_list.extend(
-        [CarEvent(desc="Accelerating", timestamp=i,
-                  ID=CarEvent.CAR_EVENT_GAS_PEDAL, value=0.95)
-         for i in time_seq if acceleration > 0])
+    acce_ratio = np.where(np.asarray(acceleration) > 0, ACCE_RATIO, 0.0)
+    time_seq = get_event_timing_from_profile(start_time, stop_time,
+                                             acce_ratio, resolution)
+    event_list = EventTable.from_columns(
+        time_seq, CarEvent.CAR_EVENT_GAS_PEDAL, 0.95, "Accelerating")
 
     return event_list
 
     # -----------------------------------------------------
     # create diagnostic event
     diag_ratio = 0.1
-    time_seq = get_event_timing_from_interval(start_time, stop_time,
-                                              diag_ratio)
-
-    for i in time_seq:
-        event = CarEvent(desc="Diagnostic", timestamp=i,
-                         ID=CarEvent.CAR_EVENT_BUS_DIAG, value=random())
-        event_list.append(event)
+    time_seq = get_event_timing_from_profile(start_time, stop_time,
+                                             diag_ratio, resolution)
+    event_list.extend(EventTable.from_columns(
+        time_seq, CarEvent.CAR_EVENT_BUS_DIAG, _rng.random(len(time_seq)),
+        "Diagnostic"))
+    event_list.sort_by_timestamp()
 
     return event_list
 
 
-def generate_sporadic_event(start_time=.0, stop_time=10.0, brake=0):
-    event_list = []
-
+def generate_sporadic_event(start_time=.0, stop_time=10.0, brake=0,
+                            resolution=1e-3):
+    # start_time, stop_time and brake could be arrays describing a whole
+    # drive profile, with events generated in one pass
     # -----------------------------------------------------
     # create braking event
-    brak_ratio = BRAK_RATIO
-    time_seq = get_event_timing_from_interval(start_time, stop_time,
-                                              brak_ratio)
-    event_list.extend(
-        [CarEvent("braking", timestamp=i,
-                  ID=CarEvent.CAR_EVENT_BRAKE_PEDAL, value=0.5)
-         for i in time_seq if brake > 0])
+    brak_ratio = np.where(np.asarray(brake) > 0, BRAK_RATIO, 0.0)
+    time_seq = get_event_timing_from_profile(start_time, stop_time,
+                                             brak_ratio, resolution)
+    event_list = EventTable.from_columns(
+        time_seq, CarEvent.CAR_EVENT_BRAKE_PEDAL, 0.5, "braking")
 
     return event_list
 
@@ -426,57 +743,60 @@ def generate_sporadic_event(start_time=.0, stop_time=10.0, brake=0):
         # braking_value = random()
         braking_value = 0.5
         for i in time_seq:
-            event = CarEvent(desc="braking", timestamp=i,
-                             ID=CarEvent.CAR_EVENT_BRAKE_PEDAL,
-                             value=braking_value)
-            event_list.append(event)
+            event_list.append(i, CarEvent.CAR_EVENT_BRAKE_PEDAL,
+                              braking_value, get_label_code("braking"))
 
 
-def generate_DOS_attack_via_odbII(start_time, stop_time):
+def generate_DOS_attack_via_odbII(start_time, stop_time, resolution=1e-3):
 
     # create attack event
     dos_ratio = DOS_RATIO
-    time_seq = get_event_timing_from_interval(start_time, stop_time, dos_ratio)
+    time_seq = get_event_timing_from_profile(start_time, stop_time,
+                                             dos_ratio, resolution)
 
     # generate invalude odb messages with ID ranging from 0 to 0x10 to
     # hold the highest prioritized position
-    dos_list = [CarEvent("DOS attack", timestamp=time, ID=randint(0, 0x10),
-                value=random()) for time in time_seq]
+    dos_list = EventTable.from_columns(
+        time_seq, _rng.integers(0, 0x10, len(time_seq), endpoint=True),
+        _rng.random(len(time_seq)), "DOS attack")
     return dos_list
 
 
-def toyota_prius_force_shutdown_engine(start_time, stop_time):
+def toyota_prius_force_shutdown_engine(start_time, stop_time,
+                                       resolution=1e-3):
     # the command applied to toyota prius, with two options:
     # 1. diagnostic tests to kill the fuel of all cylinders to ICE
     # 2. use 0x0037 CAN ID to redline the ICE and eventurally force the
     # engine to shut down
     # Note: Option 2 can permanently damage the automobile. use caution
-    time_seq = get_event_timing_from_interval(start_time, stop_time, 1)
-    attack_list = [
-        CarEvent("Shut down engine", timestamp=time,
-                 ID=CarEvent.CAR_EVENT_GAS_ACC_VIA_ICE, value=1)
-        for time in time_seq]
+    time_seq = get_event_timing_from_profile(start_time, stop_time, 1,
+                                             resolution)
+    attack_list = EventTable.from_columns(
+        time_seq, CarEvent.CAR_EVENT_GAS_ACC_VIA_ICE, 1, "Shut down engine")
     return attack_list
 
 
 def generate_empty_event(start_time, stop_time, event_list):
-    full_time = range(int(start_time*1e3), int(stop_time*1e3))
-    busy_time = [event.timestamp*1e3 for event in event_list]
-    free_time = set(full_time)-set(busy_time)
-    free_list = [CarEvent("Free", time*1e-3, CarEvent.CAR_EVENT_FREE)
-                 for time in free_time]
+    # Note: Vehicle.drive_car() coasts through idle time itself, free
+    # events are only needed by external consumers
+    full_time = np.arange(int(start_time*1e3), int(stop_time*1e3))
+    busy_time = (EventTable.from_events(event_list).timestamp*1e3
+                 + 1e-6).astype(np.int64)
+    free_time = full_time[~np.isin(full_time, busy_time)]
+    free_list = EventTable.from_columns(
+        free_time*1e-3, CarEvent.CAR_EVENT_FREE, -1, "Free")
     return free_list
 
 
-def generate_query_event(timestamp, speed, enginespeed, torque):
-    query_list = []
-    query_list.append(CarEvent("query speed", timestamp=timestamp,
-                               ID=CarEvent.CAR_EVENT_QUERY_SPEED,
-                               value=speed))
-    query_list.append(CarEvent("query enginespeed", timestamp=timestamp,
-                               ID=CarEvent.CAR_EVENT_QUERY_RPM,
-                               value=enginespeed))
-    query_list.append(CarEvent("query torque", timestamp=timestamp,
-                               ID=CarEvent.CAR_EVENT_QUERY_TORQUE,
-                               value=torque))
+def generate_query_event(timestamp, speed, enginespeed, torque,
+                         query_list=None):
+    # query events are appended to query_list when it is given
+    if query_list is None:
+        query_list = EventTable(3)
+    query_list.append(timestamp, CarEvent.CAR_EVENT_QUERY_SPEED, speed,
+                      get_label_code("query speed"))
+    query_list.append(timestamp, CarEvent.CAR_EVENT_QUERY_RPM, enginespeed,
+                      get_label_code("query enginespeed"))
+    query_list.append(timestamp, CarEvent.CAR_EVENT_QUERY_TORQUE, torque,
+                      get_label_code("query torque"))
     return query_list